@@ -6,11 +6,15 @@ import os
 import socket
 import sys
 
-from twisted.internet.protocol import DatagramProtocol
-from twisted.internet import reactor, defer
+from twisted.internet.protocol import DatagramProtocol, ServerFactory
+from twisted.internet import reactor, defer, task
+from twisted.protocols.basic import LineReceiver
 from txpostgres import txpostgres
 import psycopg2
 
+from mserver_directory import (MserverDirectory, SnapshotError,
+                               open_directory, snapshot_path)
+
 
 REQ_ENV_VARS = ['VAR_DIR',
                 'BDM_PG_HOST',
@@ -28,8 +32,13 @@ OPT_ENV_VARS = [('BDM_PG_PORT', 5432),
                 ('BDMD_TCP_KEEPCNT', 2),
                 ('BDMD_TCP_KEEPINTVL', 10),
                 ('BDMD_DEBUG', 0),
+                ('BDMD_SESSION_TIMEOUT', 180),
+                ('BDMD_SESSION_SWEEP', 60),
+                ('BDMD_PRESENCE_SOCKET', None),
+                ('BDMD_MSERVER_SNAPSHOT', None),
                 ]
 LOG_SUBDIR = 'log/devices'
+PRESENCE_SOCKET = 'run/bdmd.sock'
 
 def print_debug_factory(is_debug):
     if is_debug:
@@ -183,13 +192,252 @@ class Probe(object):
         self.reply = None
 
 
+class DevicePresence(object):
+    __slots__ = ('ip', 'bversion', 'last_seen', 'session_start')
+
+    def __init__(self, ip, bversion, last_seen, session_start):
+        self.ip = ip
+        self.bversion = bversion
+        self.last_seen = last_seen
+        self.session_start = session_start
+
+
+# class PresenceTable
+#
+# Keeps the last check-in of every device that has pinged this bdmd, along
+# with the start of its current session. A session is a run of check-ins with
+# no gap longer than session_timeout; checkin() and expire() hand back the
+# sessions they close as (device_id, ip, bversion, date_start, date_end) so
+# that the caller can store them.
+class PresenceTable(object):
+    def __init__(self, session_timeout):
+        self.devices = {}
+        self.session_timeout = datetime.timedelta(seconds=session_timeout)
+
+    def checkin(self, device_id, ip, bversion, when):
+        closed = None
+        dp = self.devices.get(device_id)
+        if dp is None:
+            self.devices[device_id] = DevicePresence(ip, bversion, when, when)
+            return None
+        if dp.session_start is None:
+            dp.session_start = when
+        elif when - dp.last_seen > self.session_timeout:
+            closed = self._session(device_id, dp)
+            dp.session_start = when
+        dp.ip = ip
+        dp.bversion = bversion
+        if when > dp.last_seen:
+            dp.last_seen = when
+        return closed
+
+    def expire(self, now):
+        closed = []
+        for device_id, dp in self.devices.iteritems():
+            if (dp.session_start is not None and
+                    now - dp.last_seen > self.session_timeout):
+                closed.append(self._session(device_id, dp))
+                dp.session_start = None
+        return closed
+
+    def close_all(self):
+        closed = []
+        for device_id, dp in self.devices.iteritems():
+            if dp.session_start is not None:
+                closed.append(self._session(device_id, dp))
+                dp.session_start = None
+        return closed
+
+    def seen_within(self, seconds, now):
+        horizon = now - datetime.timedelta(seconds=seconds)
+        return sorted((device_id, dp)
+                for device_id, dp in self.devices.iteritems()
+                if dp.last_seen >= horizon)
+
+    def online(self, now):
+        horizon = now - self.session_timeout
+        return sorted((device_id, dp)
+                for device_id, dp in self.devices.iteritems()
+                if dp.session_start is not None and dp.last_seen >= horizon)
+
+    def version_counts(self, now):
+        counts = {}
+        for _, dp in self.online(now):
+            counts[dp.bversion] = counts.get(dp.bversion, 0) + 1
+        return sorted(counts.items())
+
+    @staticmethod
+    def _session(device_id, dp):
+        return (device_id, dp.ip, dp.bversion, dp.session_start, dp.last_seen)
+
+
+class PresenceQueryProtocol(LineReceiver):
+    """
+    Answers a single query on the local presence socket, then hangs up:
+
+        online          devices whose session is open
+        seen <seconds>  devices seen within the last <seconds>
+        versions        count of online devices by bversion
+        mservers        measurement servers: fqdn, id, current IP, M-Lab group
+    """
+    delimiter = '\n'
+
+    def lineReceived(self, line):
+        table = self.factory.presence.table
+        now = datetime.datetime.utcnow()
+        parts = line.strip().split()
+        try:
+            if parts == ['online']:
+                self.send_devices(table.online(now))
+            elif len(parts) == 2 and parts[0] == 'seen':
+                self.send_devices(table.seen_within(int(parts[1]), now))
+            elif parts == ['versions']:
+                for bversion, count in table.version_counts(now):
+                    self.sendLine("%s %d" % (bversion, count))
+            elif parts == ['mservers']:
+                directory = self.factory.mservers.current()
+                ips = directory.current_ips()
+                for target_id, fqdn, group in directory.targets():
+                    self.sendLine("%s %d %s %s" % (
+                            fqdn, target_id, ips.get(fqdn, '-'), group or '-'))
+            else:
+                self.sendLine("error: unknown query '%s'" % line.strip())
+        except ValueError:
+            self.sendLine("error: bad argument in '%s'" % line.strip())
+        self.transport.loseConnection()
+
+    def send_devices(self, devices):
+        for device_id, dp in devices:
+            self.sendLine("%s %s %s %s %s" % (
+                    device_id, dp.ip, dp.bversion, dp.last_seen.isoformat(),
+                    dp.session_start.isoformat() if dp.session_start else '-'))
+
+
+class PresenceQueryFactory(ServerFactory):
+    protocol = PresenceQueryProtocol
+
+    def __init__(self, presence, mservers):
+        self.presence = presence
+        self.mservers = mservers
+
+
+# class MserverSnapshot
+#
+# The mserver directory snapshot (see mserver_directory.py), loaded once at
+# startup and reopened whenever update_device_targets.py or another program
+# has replaced the file with a newer one.
+class MserverSnapshot(object):
+    def __init__(self, config):
+        self.path = snapshot_path(config)
+        dbconn = psycopg2.connect(
+                host=config['BDM_PG_HOST'],
+                port=int(config['BDM_PG_PORT']),
+                database=config['BDM_PG_MGMT_DBNAME'],
+                user=config['BDM_PG_USER'],
+                password=config['BDM_PG_PASSWORD'],
+                )
+        try:
+            self.directory = open_directory(dbconn, self.path)
+        finally:
+            dbconn.close()
+
+    def current(self):
+        if not self.directory.is_current():
+            try:
+                self.directory = MserverDirectory(self.path)
+            except (IOError, OSError, SnapshotError) as e:
+                print_error("Keeping old mserver directory: %s" % e)
+        return self.directory
+
+
+# class PresenceTracker
+#
+# Owns the PresenceTable shared by every ProbeHandler and writes closed
+# sessions to the device_sessions table over its own connection pool. Open
+# sessions are written out on shutdown; after a restart the table is seeded
+# from the devices table, so a session that spans the restart shows up as two
+# sessions separated by less than the session timeout.
+class PresenceTracker(object):
+    def __init__(self, config):
+        self.table = PresenceTable(int(config['BDMD_SESSION_TIMEOUT']))
+        self.sweep_interval = int(config['BDMD_SESSION_SWEEP'])
+        self.dbpool = txpostgres.ConnectionPool(
+                None,
+                min=1,
+                host=config['BDM_PG_HOST'],
+                port=int(config['BDM_PG_PORT']),
+                database=config['BDM_PG_MGMT_DBNAME'],
+                user=config['BDM_PG_USER'],
+                password=config['BDM_PG_PASSWORD'],
+                )
+        self.sweeper = task.LoopingCall(self.sweep)
+
+    def checkin(self, probe):
+        closed = self.table.checkin(
+                probe.id, probe.ip, probe.param, probe.arrival_time)
+        if closed:
+            self.write_sessions([closed])
+
+    def sweep(self):
+        closed = self.table.expire(datetime.datetime.utcnow())
+        if closed:
+            print_debug("Closing %d idle device session(s)" % len(closed))
+            self.write_sessions(closed)
+
+    def write_sessions(self, sessions):
+        d = self.dbpool.runInteraction(self.write_sessions_interaction,
+                                       sessions)
+        d.addErrback(self.db_error_handler)
+        return d
+
+    def write_sessions_interaction(self, cursor, sessions):
+        d = defer.succeed(None)
+        for session in sessions:
+            d.addCallback(lambda _, s: cursor.execute(
+                    "INSERT INTO device_sessions "
+                    "(device_id, ip, bversion, date_start, date_end) "
+                    "VALUES (%s, %s, %s, %s, %s);", s), session)
+        return d
+
+    def db_error_handler(self, failure):
+        failure.trap(psycopg2.Error)
+        print("trapped psycopg2.Error writing device sessions")
+        print(failure.value)
+
+    def start(self):
+        d = self.dbpool.start()
+        d.addCallback(self.seed)
+        d.addCallback(lambda _: self.sweeper.start(self.sweep_interval,
+                                                   now=False))
+        return d
+
+    def seed(self, _):
+        d = self.dbpool.runQuery(
+                "SELECT id, ip, bversion, date_last_seen "
+                "FROM devices WHERE date_last_seen >= %s;",
+                [datetime.datetime.utcnow() - self.table.session_timeout])
+        return d.addCallback(self.seed_qh)
+
+    def seed_qh(self, resultset):
+        for device_id, ip, bversion, date_last_seen in resultset:
+            self.table.checkin(device_id, ip, bversion, date_last_seen)
+        print("Presence table seeded with %d device(s)" % len(resultset))
+
+    def stop(self):
+        if self.sweeper.running:
+            self.sweeper.stop()
+        d = self.write_sessions(self.table.close_all())
+        d.addBoth(lambda _: self.dbpool.close())
+        return d
+
+
 def eb_print(x):
     print("errback!")
     print(x, x.value)
 
 
 class ProbeHandler(DatagramProtocol):
-    def __init__(self, config):
+    def __init__(self, config, presence=None):
         txpostgres.Connection.connectionFactory = self._tcp_connfactory({
                 'tcp_keepidle'  : int(config['BDMD_TCP_KEEPIDLE']),
                 'tcp_keepcnt'   : int(config['BDMD_TCP_KEEPCNT']),
@@ -205,6 +453,7 @@ class ProbeHandler(DatagramProtocol):
                 password=config['BDM_PG_PASSWORD'],
                 )
         self.dbpool_started = False
+        self.presence = presence
         self.config = {}
         self.config['logdir'] = os.path.join(
                 os.path.abspath(config['VAR_DIR']), LOG_SUBDIR)
@@ -481,7 +730,12 @@ class ProbeHandler(DatagramProtocol):
                     "VALUES (%s, %s, %s, %s);")
         d = self.dbpool.runOperation(
                 query, [probe.ip, probe.arrival_time, probe.param, probe.id])
-        return d.addCallback(lambda _: probe)
+        return d.addCallback(self.record_presence, probe)
+
+    def record_presence(self, _, probe):
+        if self.presence:
+            self.presence.checkin(probe)
+        return probe
 
     #@print_entry
     def check_messages(self, probe):
@@ -557,10 +811,14 @@ if __name__ == '__main__':
     print_debug = print_debug_factory(int(conf['BDMD_DEBUG']) != 0)
     print_debug(conf)
 
+    presence = PresenceTracker(conf)
+    mservers = MserverSnapshot(conf)
+    print("Mserver directory %s: %d targets" % (
+            mservers.path, len(mservers.directory.target_ids)))
     probehandlers = []
     for port in (int(x) for x in sys.argv[1:]):
         if 1024 <= port <= 65535:
-            ph = ProbeHandler(conf)
+            ph = ProbeHandler(conf, presence)
             reactor.listenUDP(port, ph)
             probehandlers.append(ph)
             print("Listening on port %d" % port)
@@ -572,4 +830,12 @@ if __name__ == '__main__':
     for ph in probehandlers:
         reactor.addSystemEventTrigger('before', 'startup', ph.start)
         reactor.addSystemEventTrigger('before', 'shutdown', ph.stop)
+
+    presence_socket = conf['BDMD_PRESENCE_SOCKET'] or os.path.join(
+            os.path.abspath(conf['VAR_DIR']), PRESENCE_SOCKET)
+    reactor.listenUNIX(presence_socket, PresenceQueryFactory(presence, mservers),
+                       mode=0600, wantPID=True)
+    print("Presence queries on %s" % presence_socket)
+    reactor.addSystemEventTrigger('before', 'startup', presence.start)
+    reactor.addSystemEventTrigger('before', 'shutdown', presence.stop)
     reactor.run()
@@ -0,0 +1,106 @@
+#!/usr/bin/env python
+#
+# Benchmarks MserverProber against fake_mserver.py: starts a fake control
+# service on --servers local ports, pings --devices addresses from each of
+# them, and reports the wall time, requests per second and how the requests
+# ended. --serial N also times the first N requests one after another the way
+# mserver_ping() does them, for comparison.
+#
+# --connections 0 gives every request a connection of its own; otherwise the
+# requests to a server share that many, pipelined if the fake is run with
+# --pipeline (and falling back to a connection per request if not).
+#
+#   bench_mserver_ping.py --servers 40 --devices 50 --delay 4 --serial 10
+#   bench_mserver_ping.py --servers 40 --devices 50 --pipeline --per-server 16
+
+import argparse
+import os
+import subprocess
+import sys
+import time
+
+from fake_mserver import add_arguments
+from mserver_ping_klatch_devices import netcat
+from mserver_prober import (CONNECTIONS_PER_SERVER, MserverProber,
+                            parse_ping_output)
+
+
+def server_fqdn(i):
+    return 'ndt.bench.mlab%d.bn%03d.measurement-lab.org.' % (i % 3 + 1, i / 3)
+
+
+def device_ip(i):
+    return '192.0.2.%d' % (i % 250 + 1)
+
+
+def start_fake(args):
+    cmd = [sys.executable,
+           os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                        'fake_mserver.py'),
+           '--ports', '%d-%d' % (args.base_port,
+                                 args.base_port + args.servers - 1),
+           '--delay', str(args.delay), '--jitter', str(args.jitter),
+           '--loss', str(args.loss), '--hang', str(args.hang),
+           '--seed', str(args.seed)]
+    if args.pipeline:
+        cmd.append('--pipeline')
+    proc = subprocess.Popen(cmd, stdout=subprocess.PIPE)
+    proc.stdout.readline()  # listening
+    return proc
+
+
+if __name__ == '__main__':
+    argp = argparse.ArgumentParser(
+            description='Time concurrent mserver pings against fake servers')
+    argp.add_argument('--servers', type=int, default=40)
+    argp.add_argument('--devices', type=int, default=50,
+                      help='addresses each server pings (default: 50)')
+    argp.add_argument('--base-port', type=int, default=21101)
+    argp.add_argument('--per-server', type=int, default=4)
+    argp.add_argument('--max-concurrent', type=int, default=256)
+    argp.add_argument('--timeout', type=float, default=25)
+    argp.add_argument('--connections', type=int,
+                      default=CONNECTIONS_PER_SERVER,
+                      help=('connections per server, 0 for one per request '
+                            '(default: %d)' % CONNECTIONS_PER_SERVER))
+    argp.add_argument('--serial', type=int, default=0,
+                      help='also time this many requests one at a time')
+    add_arguments(argp)
+    args = argp.parse_args()
+
+    port_of = dict((server_fqdn(i), args.base_port + i)
+                   for i in xrange(args.servers))
+    requests = [(server_fqdn(s), device_ip(d)) for d in xrange(args.devices)
+                for s in xrange(args.servers)]
+
+    proc = start_fake(args)
+    try:
+        if args.serial:
+            start = time.time()
+            answered = 0
+            for fqdn, ip in requests[:args.serial]:
+                ping_out = parse_ping_output(netcat(
+                        '127.0.0.1', port_of[fqdn], 'ping %s -q\n' % ip))
+                answered += 'rtt_avg' in ping_out
+            elapsed = time.time() - start
+            print("serial:     %d requests in %.1fs, %.2f/s, %d with RTTs" % (
+                    args.serial, elapsed, args.serial / elapsed, answered))
+
+        prober = MserverProber(per_server=args.per_server,
+                               max_concurrent=args.max_concurrent,
+                               request_timeout=args.timeout,
+                               connections_per_server=args.connections,
+                               address=lambda fqdn: ('127.0.0.1',
+                                                     port_of[fqdn]))
+        start = time.time()
+        results = prober.run_blocking(requests)
+        elapsed = time.time() - start
+        print("concurrent: %d requests in %.1fs, %.2f/s, %d with RTTs" % (
+                len(results), elapsed, len(results) / elapsed,
+                len([r for r in results if 'rtt_avg' in r[2]])))
+        print(', '.join(['%s %d' % c for c in sorted(prober.counts.items())]))
+        print("%d connection(s), %d server(s) not pipelining" % (
+                prober.connects(), len(prober.unpipelined())))
+    finally:
+        proc.terminate()
+        proc.wait()
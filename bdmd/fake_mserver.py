@@ -0,0 +1,141 @@
+#!/usr/bin/env python
+#
+# A stand-in for the mservers' control service, for benchmarking mserver
+# pings without touching M-Lab: listens on each of --ports on localhost and
+# answers "ping <ip> -q" with made-up ping -q output after --delay seconds
+# (plus up to --jitter more), then hangs up.
+#
+# --loss of the requests get a reply with nothing received and no rtt line,
+# as for a device that doesn't answer; --hang of them get no reply at all, to
+# exercise the prober's timeouts.
+#
+# With --pipeline the connection stays open and every request line on it is
+# answered, each after its own delay, so answers can come out of order;
+# otherwise lines after the first are ignored, as by the real service.
+#
+#   fake_mserver.py --ports 21101-21140 --delay 4 --jitter 1
+
+import argparse
+import random
+import sys
+
+from twisted.internet import reactor
+from twisted.internet.protocol import Factory
+from twisted.protocols.basic import LineReceiver
+
+PING_COUNT = 5
+
+
+def ping_output(ip, rnd, lost):
+    lines = ['PING %s (%s) 56(84) bytes of data.' % (ip, ip),
+             '',
+             '--- %s ping statistics ---' % ip]
+    if lost:
+        lines.append('%d packets transmitted, 0 received, 100%% packet loss, '
+                     'time %dms' % (PING_COUNT, (PING_COUNT - 1) * 1000))
+    else:
+        base = rnd.lognormvariate(3.5, 0.8)
+        rtts = [base * rnd.uniform(1.0, 1.5) for i in xrange(PING_COUNT)]
+        avg = sum(rtts) / len(rtts)
+        mdev = (sum((x - avg) ** 2 for x in rtts) / len(rtts)) ** 0.5
+        lines.append('%d packets transmitted, %d received, 0%% packet loss, '
+                     'time %dms' % (PING_COUNT, PING_COUNT,
+                                    (PING_COUNT - 1) * 1000))
+        lines.append('rtt min/avg/max/mdev = %.3f/%.3f/%.3f/%.3f ms' % (
+                min(rtts), avg, max(rtts), mdev))
+    return '\n'.join(lines) + '\n'
+
+
+class FakeControlProtocol(LineReceiver):
+    delimiter = '\n'
+
+    def connectionMade(self):
+        self.replies = []
+        self.requests = 0
+        self.factory.connections.add(self)
+
+    def lineReceived(self, line):
+        if self.requests and not self.factory.opts.pipeline:
+            return
+        words = line.split()
+        if len(words) < 2 or words[0] != 'ping':
+            self.transport.loseConnection()
+            return
+        self.requests += 1
+        self.factory.requests += 1
+        reply = self.factory.reply(words[1])
+        if reply is None:
+            return
+        delay, output = reply
+        self.replies.append(reactor.callLater(delay, self.answer, output))
+
+    def answer(self, output):
+        self.transport.write(output)
+        if not self.factory.opts.pipeline:
+            self.transport.loseConnection()
+
+    def connectionLost(self, reason):
+        self.factory.connections.discard(self)
+        for reply in self.replies:
+            if reply.active():
+                reply.cancel()
+
+
+class FakeControlFactory(Factory):
+    protocol = FakeControlProtocol
+
+    def __init__(self, opts, rnd):
+        self.opts = opts
+        self.rnd = rnd
+        self.requests = 0
+        self.connections = set()
+
+    def reply(self, ip):
+        # (delay, output) to answer a ping of ip with, or None to hang
+        rnd = self.rnd
+        if rnd.random() < self.opts.hang:
+            return None
+        return (self.opts.delay + rnd.uniform(0, self.opts.jitter),
+                ping_output(ip, rnd, rnd.random() < self.opts.loss))
+
+
+def parse_ports(val):
+    # "21101" or "21101-21140"
+    lo, _, hi = val.partition('-')
+    return range(int(lo), int(hi or lo) + 1)
+
+
+def listen(ports, opts, rnd, interface='127.0.0.1'):
+    factory = FakeControlFactory(opts, rnd)
+    for port in ports:
+        reactor.listenTCP(port, factory, interface=interface)
+    return factory
+
+
+def add_arguments(argp):
+    argp.add_argument('--delay', type=float, default=4.0,
+                      help='seconds before answering (default: 4)')
+    argp.add_argument('--jitter', type=float, default=1.0,
+                      help='up to this many more seconds (default: 1)')
+    argp.add_argument('--loss', type=float, default=0.1,
+                      help="fraction of pings nothing answers (default: 0.1)")
+    argp.add_argument('--hang', type=float, default=0.0,
+                      help='fraction of requests never answered (default: 0)')
+    argp.add_argument('--pipeline', action='store_true',
+                      help='answer every request on a connection')
+    argp.add_argument('--seed', type=int, default=0)
+
+
+if __name__ == '__main__':
+    argp = argparse.ArgumentParser(
+            description='Answer mserver ping requests with made-up results')
+    argp.add_argument('--ports', type=parse_ports, default=[21101],
+                      help='PORT or FIRST-LAST (default: 21101)')
+    add_arguments(argp)
+    args = argp.parse_args()
+
+    listen(args.ports, args, random.Random(args.seed))
+    print("Listening on 127.0.0.1 ports %d-%d" % (args.ports[0],
+                                                   args.ports[-1]))
+    sys.stdout.flush()
+    reactor.run()
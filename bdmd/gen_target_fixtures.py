@@ -0,0 +1,265 @@
+#!/usr/bin/env python
+#
+# Fills a local Postgres with a synthetic fleet for benchmarking
+# update_device_targets.py: --servers mservers in M-Lab groups of three, and
+# --devices devices with --days of RTT history to some of them.
+#
+# In the management DB each server gets a targets row and an address, and
+# every other device gets enabled targets old enough to be due for
+# retargeting; the rest have none, like newly seen devices. In the data DB,
+# most devices get m_mserver_rtt rows and the others only m_mserver_rping
+# rows, so both of update_device_targets.py's sources are exercised. If the
+# data DB has the mserver_rtt_daily summary, it is rebuilt for the fixture's
+# days.
+#
+# Fixture devices have ids starting with OWFEFE and fixture servers are under
+# .fixture. in their FQDNs; --clear removes them (and nothing else) first.
+#
+#   gen_target_fixtures.py --devices 10000 --servers 60 --days 30
+#   update_device_targets.py --dry-run
+
+import argparse
+import datetime
+import os
+import random
+import sys
+from cStringIO import StringIO
+
+import psycopg2
+
+FIXTURE_PREFIX = 'FEFE'
+FIXTURE_DOMAIN = 'fixture'
+SERVERS_PER_GROUP = 3
+
+REQ_ENV_VARS = ['BDM_PG_HOST',
+                'BDM_PG_USER',
+                'BDM_PG_PASSWORD',
+                'BDM_PG_MGMT_DBNAME',
+                'BDM_PG_DATA_DBNAME',
+                ]
+
+# each optional item consists of a tuple (var_name, default_value)
+OPT_ENV_VARS = [('BDM_PG_PORT', 5432),
+                ]
+
+LOCAL_HOSTS = ('localhost', '127.0.0.1', '::1', '')
+
+RTT_COLUMNS = ('deviceid', 'eventstamp', 'srcip', 'dstip',
+               'average', 'median', 'minimum', 'maximum', 'std')
+
+
+def server_fqdn(i):
+    return 'ndt.%s.mlab%d.fx%03d.measurement-lab.org.' % (
+            FIXTURE_DOMAIN, i % SERVERS_PER_GROUP + 1, i / SERVERS_PER_GROUP)
+
+
+def server_ip(i):
+    return '10.254.%d.%d' % (i / 250, i % 250 + 1)
+
+
+def device_id(i):
+    return 'OW%s%08X' % (FIXTURE_PREFIX, i)
+
+
+def clear(mconn, dconn):
+    mcur = mconn.cursor()
+    fixture_fqdns = '%%.%s.%%' % FIXTURE_DOMAIN
+    mcur.execute((
+            "DELETE FROM device_targets "
+            "WHERE device_id LIKE %s "
+            "OR target_id IN (SELECT id FROM targets WHERE fqdn LIKE %s);"),
+            ['OW' + FIXTURE_PREFIX + '%', fixture_fqdns])
+    mcur.execute("DELETE FROM devices WHERE id LIKE %s;",
+                 ['OW' + FIXTURE_PREFIX + '%'])
+    mcur.execute((
+            "DELETE FROM target_ips WHERE target_id IN ( "
+            "   SELECT id FROM targets WHERE fqdn LIKE %s);"),
+            [fixture_fqdns])
+    mcur.execute("DELETE FROM targets WHERE fqdn LIKE %s;", [fixture_fqdns])
+    mconn.commit()
+    dcur = dconn.cursor()
+    for table in ('m_mserver_rtt', 'm_mserver_rping', 'mserver_rtt_daily'):
+        if table_exists(dcur, table):
+            dcur.execute("DELETE FROM %s WHERE deviceid LIKE %%s;" % table,
+                         [FIXTURE_PREFIX + '%'])
+    dconn.commit()
+
+
+def table_exists(cur, table):
+    cur.execute("SELECT 1 FROM information_schema.tables "
+                "WHERE table_schema = current_schema() AND table_name = %s;",
+                [table])
+    return cur.rowcount > 0
+
+
+def create_servers(mconn, nservers, since):
+    # returns the target ids, by server number
+    mcur = mconn.cursor()
+    ids = []
+    for i in xrange(nservers):
+        mcur.execute((
+                "INSERT INTO targets (fqdn, curr_cli, max_cli, available) "
+                "VALUES (%s, 0, 100, TRUE) RETURNING id;"), [server_fqdn(i)])
+        ids.append(mcur.fetchone()[0])
+    mcur.executemany(
+            "INSERT INTO target_ips (target_id, ip, date_effective) "
+            "VALUES (%s, %s, %s);",
+            [(ids[i], server_ip(i), since) for i in xrange(nservers)])
+    mconn.commit()
+    return ids
+
+
+def create_devices(mconn, ndevices, target_ids, now, stale, rnd):
+    mcur = mconn.cursor()
+    buf = StringIO()
+    for i in xrange(ndevices):
+        buf.write("%s\tfixture\t192.0.2.%d\t%s\n" % (
+                device_id(i), i % 250 + 1, now.isoformat()))
+    buf.seek(0)
+    mcur.copy_from(buf, 'devices',
+                   columns=('id', 'bversion', 'ip', 'date_last_seen'))
+    # every other device has targets due for retargeting
+    buf = StringIO()
+    for i in xrange(0, ndevices, 2):
+        group = rnd.randrange(len(target_ids) / SERVERS_PER_GROUP or 1)
+        for j in xrange(SERVERS_PER_GROUP):
+            n = group * SERVERS_PER_GROUP + j
+            if n < len(target_ids):
+                buf.write("%s\t%d\t30\tt\t%s\tf\n" % (
+                        device_id(i), target_ids[n], stale.isoformat()))
+    buf.seek(0)
+    mcur.copy_from(buf, 'device_targets',
+                   columns=('device_id', 'target_id', 'preference',
+                            'is_enabled', 'date_effective', 'is_permanent'))
+    mconn.commit()
+
+
+def create_rtt_tables(dconn):
+    dcur = dconn.cursor()
+    for table in ('m_mserver_rtt', 'm_mserver_rping'):
+        if not table_exists(dcur, table):
+            dcur.execute((
+                    "CREATE TABLE %s ( "
+                    "   deviceid text, eventstamp timestamp with time zone, "
+                    "   srcip inet, dstip inet, "
+                    "   average double precision, median double precision, "
+                    "   minimum double precision, maximum double precision, "
+                    "   std double precision);") % table)
+            dcur.execute("CREATE INDEX %s_deviceid_eventstamp_idx "
+                         "ON %s (deviceid, eventstamp);" % (table, table))
+    dconn.commit()
+
+
+def write_rtts(dconn, ndevices, nservers, per_device, days, samples, rping,
+               now, rnd):
+    # one COPY per table and batch of devices
+    dcur = dconn.cursor()
+    first = now - datetime.timedelta(days=days)
+    step = 86400.0 / samples
+    total = 0
+    batch = 100
+    for lo in xrange(0, ndevices, batch):
+        bufs = {'m_mserver_rtt': StringIO(), 'm_mserver_rping': StringIO()}
+        for i in xrange(lo, min(lo + batch, ndevices)):
+            table = 'm_mserver_rping' if rnd.random() < rping \
+                    else 'm_mserver_rtt'
+            servers = rnd.sample(xrange(nservers), min(per_device, nservers))
+            base = dict((s, rnd.lognormvariate(3.5, 0.8)) for s in servers)
+            deviceid = device_id(i)[2:]
+            for n in xrange(int(days * samples)):
+                s = servers[n % len(servers)]
+                when = first + datetime.timedelta(
+                        seconds=n * step + rnd.uniform(0, step))
+                minimum = base[s] * rnd.uniform(1.0, 1.2)
+                maximum = minimum * rnd.uniform(1.0, 2.0)
+                average = rnd.uniform(minimum, maximum)
+                bufs[table].write("%s\t%s+00\t192.0.2.%d\t%s\t"
+                                  "%.3f\t%.3f\t%.3f\t%.3f\t%.3f\n" % (
+                        deviceid, when.isoformat(), i % 250 + 1,
+                        server_ip(s), average, average, minimum, maximum,
+                        (maximum - minimum) / 4))
+                total += 1
+        for table, buf in bufs.iteritems():
+            buf.seek(0)
+            dcur.copy_from(buf, table, columns=RTT_COLUMNS)
+        dconn.commit()
+    return total
+
+
+def rebuild_summary(dconn, now, days):
+    dcur = dconn.cursor()
+    if not table_exists(dcur, 'mserver_rtt_daily'):
+        return False
+    first = (now - datetime.timedelta(days=days + 1)).date()
+    for source in ('rtt', 'rping'):
+        dcur.execute("SELECT rebuild_mserver_rtt_daily(%s, %s, %s);",
+                     [source, first, now.date()])
+    dconn.commit()
+    return True
+
+
+if __name__ == '__main__':
+    argp = argparse.ArgumentParser(
+            description='Generate a synthetic fleet for update_device_targets')
+    argp.add_argument('--devices', type=int, default=1000)
+    argp.add_argument('--servers', type=int, default=30)
+    argp.add_argument('--servers-per-device', type=int, default=8,
+                      help='servers each device measures (default: 8)')
+    argp.add_argument('--days', type=float, default=30,
+                      help='days of RTT history (default: 30)')
+    argp.add_argument('--samples', type=float, default=24,
+                      help='RTT samples per device per day (default: 24)')
+    argp.add_argument('--rping', type=float, default=0.2,
+                      help=('fraction of devices with only mserver pings '
+                            '(default: 0.2)'))
+    argp.add_argument('--seed', type=int, default=0)
+    argp.add_argument('--clear', action='store_true',
+                      help='only remove an earlier fixture')
+    argp.add_argument('--allow-remote', action='store_true',
+                      help="write to BDM_PG_HOST even if it isn't local")
+    args = argp.parse_args()
+
+    config = {}
+    for evname in REQ_ENV_VARS:
+        try:
+            config[evname] = os.environ[evname]
+        except KeyError:
+            print(("Environment variable '%s' required and not defined. "
+                    "Terminating.") % evname)
+            sys.exit(1)
+    for (evname, default_val) in OPT_ENV_VARS:
+        config[evname] = os.environ.get(evname) or default_val
+    if config['BDM_PG_HOST'] not in LOCAL_HOSTS and not args.allow_remote:
+        print("BDM_PG_HOST is %s, not a local server; use --allow-remote "
+              "if you mean it." % config['BDM_PG_HOST'])
+        sys.exit(1)
+
+    conns = []
+    for dbname_var in ('BDM_PG_MGMT_DBNAME', 'BDM_PG_DATA_DBNAME'):
+        conns.append(psycopg2.connect(
+                host=config['BDM_PG_HOST'],
+                port=int(config['BDM_PG_PORT']),
+                database=config[dbname_var],
+                user=config['BDM_PG_USER'],
+                password=config['BDM_PG_PASSWORD'],
+                ))
+    mconn, dconn = conns
+
+    clear(mconn, dconn)
+    print("Removed any earlier fixture")
+    if args.clear:
+        sys.exit(0)
+
+    rnd = random.Random(args.seed)
+    now = datetime.datetime.utcnow()
+    since = now - datetime.timedelta(days=args.days + 1)
+    target_ids = create_servers(mconn, args.servers, since)
+    create_devices(mconn, args.devices, target_ids, now,
+                   now - datetime.timedelta(days=60), rnd)
+    print("%d servers, %d devices" % (args.servers, args.devices))
+    create_rtt_tables(dconn)
+    n = write_rtts(dconn, args.devices, args.servers, args.servers_per_device,
+                   args.days, args.samples, args.rping, now, rnd)
+    print("%d RTT rows over %g days" % (n, args.days))
+    if rebuild_summary(dconn, now, args.days):
+        print("Rebuilt mserver_rtt_daily for the fixture's days")
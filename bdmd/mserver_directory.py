@@ -0,0 +1,412 @@
+#!/usr/bin/env python
+#
+# The measurement server directory: every target's FQDN, id and M-Lab group,
+# and the history of its IP addresses, as one snapshot file shared by bdmd,
+# update_device_targets.py and mserver_ping_klatch_devices.py.
+#
+# The snapshot is built from the targets and target_ips tables of the
+# management DB and stamped with a fingerprint of their contents. Programs
+# that have a DB connection call open_directory(), which checks the
+# fingerprint with one cheap query and rebuilds the snapshot only if either
+# table has changed; bdmd just maps the file and picks up a new one when it
+# is replaced.
+#
+# The file is a small header followed by fixed-width columns, mapped with
+# mmap and read straight into arrays:
+#
+#   strings  offsets into a blob of NUL-free FQDN, IP and group strings
+#   targets  target id, FQDN and M-Lab group (string indexes), by FQDN
+#   history  target (index into targets), IP (string index) and epoch of
+#            every target_ips row, ordered by target id and date_effective
+#
+#   mserver_directory.py build [--force] [--snapshot PATH]
+#   mserver_directory.py show [--snapshot PATH]
+
+import argparse
+import array
+import bisect
+import calendar
+import datetime
+import mmap
+import os
+import struct
+import sys
+
+MAGIC = 'BDMMSD01'
+HEADER = struct.Struct('<8s32sdIIII')  # magic, fingerprint, built at,
+                                       # strings, blob bytes, targets, rows
+SNAPSHOT_SUBPATH = 'run/mserver_directory.snapshot'
+
+REQ_ENV_VARS = ['VAR_DIR',
+                'BDM_PG_HOST',
+                'BDM_PG_USER',
+                'BDM_PG_PASSWORD',
+                'BDM_PG_MGMT_DBNAME',
+                ]
+
+# each optional item consists of a tuple (var_name, default_value)
+OPT_ENV_VARS = [('BDM_PG_PORT', 5432),
+                ('BDMD_MSERVER_SNAPSHOT', None),
+                ]
+
+
+class SnapshotError(Exception):
+    pass
+
+
+def snapshot_path(config):
+    return config.get('BDMD_MSERVER_SNAPSHOT') or os.path.join(
+            os.path.abspath(config['VAR_DIR']), SNAPSHOT_SUBPATH)
+
+
+def to_epoch(dt):
+    # naive datetimes are taken to be UTC
+    return calendar.timegm(dt.utctimetuple()) + dt.microsecond / 1e6
+
+
+def mlab_group(fqdn):
+    # e.g. 'atl01' for 'ndt.iupui.mlab1.atl01.measurement-lab.org.'
+    parts = fqdn.split('.')
+    if len(parts) >= 4 and parts[-3]+'.'+parts[-2] == 'measurement-lab.org':
+        return parts[-4]
+    return None
+
+
+def directory_fingerprint(dbconn):
+    cur = dbconn.cursor()
+    cur.execute((
+            "SELECT md5(coalesce(string_agg(x, E'\\n' ORDER BY x), '')) "
+            "FROM ( "
+            "   SELECT 't ' || id || ' ' || fqdn AS x FROM targets "
+            "   UNION ALL "
+            "   SELECT 'i ' || target_id || ' ' || host(ip) || ' ' || "
+            "       date_effective "
+            "   FROM target_ips "
+            ") AS rows;"))
+    return cur.fetchone()[0]
+
+
+def column(typecode, values):
+    a = array.array(typecode, values)
+    if sys.byteorder != 'little':
+        a.byteswap()
+    return a.tostring()
+
+
+def pad8(buf):
+    return buf + '\0' * (-len(buf) % 8)
+
+
+def build_snapshot(dbconn, path, fingerprint=None):
+    cur = dbconn.cursor()
+    if fingerprint is None:
+        fingerprint = directory_fingerprint(dbconn)
+    cur.execute("SELECT id, fqdn FROM targets;")
+    # sorted here rather than by the DB's collation
+    targets = sorted(cur.fetchall(), key=lambda t: t[1])
+    cur.execute((
+            "SELECT ti.target_id, host(ti.ip), ti.date_effective "
+            "FROM target_ips AS ti, targets AS t "
+            "WHERE t.id = ti.target_id "
+            "ORDER BY ti.target_id, ti.date_effective;"))
+    rows = cur.fetchall()
+
+    strings = []
+    string_index = {}
+    def intern(s):
+        if s is None:
+            return -1
+        if s not in string_index:
+            string_index[s] = len(strings)
+            strings.append(s)
+        return string_index[s]
+
+    target_index = dict((t[0], i) for i, t in enumerate(targets))
+    t_ids = [t[0] for t in targets]
+    t_fqdns = [intern(t[1]) for t in targets]
+    t_groups = [intern(mlab_group(t[1])) for t in targets]
+    r_targets = [target_index[r[0]] for r in rows]
+    r_ips = [intern(r[1]) for r in rows]
+    r_epochs = [to_epoch(r[2]) for r in rows]
+    offsets = [0]
+    for s in strings:
+        offsets.append(offsets[-1] + len(s))
+    blob = ''.join(strings)
+
+    sections = [column('I', offsets), blob,
+                column('i', t_ids), column('i', t_fqdns), column('i', t_groups),
+                column('I', r_targets), column('I', r_ips),
+                column('d', r_epochs)]
+    tmp = '%s.%d.tmp' % (path, os.getpid())
+    if not os.path.isdir(os.path.dirname(path)):
+        os.makedirs(os.path.dirname(path))
+    f = open(tmp, 'wb')
+    f.write(HEADER.pack(MAGIC, fingerprint, to_epoch(datetime.datetime.utcnow()),
+                        len(strings), len(blob), len(targets), len(rows)))
+    for section in sections:
+        f.write(pad8(section))
+    f.close()
+    os.rename(tmp, path)  # readers see the old snapshot or the new one
+
+
+# class MserverDirectory
+#
+# A snapshot file, mapped read-only.
+class MserverDirectory(object):
+    def __init__(self, path):
+        self.path = path
+        f = open(path, 'rb')
+        try:
+            st = os.fstat(f.fileno())
+            self.stat = (st.st_ino, st.st_mtime, st.st_size)
+            if st.st_size < HEADER.size:
+                raise SnapshotError("%s: truncated" % path)
+            buf = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        finally:
+            f.close()
+        try:
+            self.load(buf)
+        finally:
+            buf.close()
+
+    def load(self, buf):
+        (magic, self.fingerprint, self.built_at, nstrings, bloblen, ntargets,
+         nrows) = HEADER.unpack_from(buf, 0)
+        if magic != MAGIC:
+            raise SnapshotError("%s: not an mserver directory snapshot"
+                                % self.path)
+        self.pos = HEADER.size
+        def take(typecode, count):
+            a = array.array(typecode)
+            size = a.itemsize * count
+            if self.pos + size > len(buf):
+                raise SnapshotError("%s: truncated" % self.path)
+            a.fromstring(buf[self.pos:self.pos+size])
+            if sys.byteorder != 'little':
+                a.byteswap()
+            self.pos += size + (-size % 8)
+            return a
+        offsets = take('I', nstrings + 1)
+        blob = buf[self.pos:self.pos+bloblen]
+        if len(blob) < bloblen:
+            raise SnapshotError("%s: truncated" % self.path)
+        self.pos += bloblen + (-bloblen % 8)
+        self.strings = [blob[offsets[i]:offsets[i+1]] for i in xrange(nstrings)]
+        self.target_ids = take('i', ntargets)
+        self.target_fqdns = take('i', ntargets)
+        self.target_groups = take('i', ntargets)
+        self.row_targets = take('I', nrows)
+        self.row_ips = take('I', nrows)
+        self.row_epochs = take('d', nrows)
+
+    def is_current(self):
+        # False once the file has been replaced by a newer snapshot
+        try:
+            st = os.stat(self.path)
+        except OSError:
+            return True
+        return (st.st_ino, st.st_mtime, st.st_size) == self.stat
+
+    def targets(self):
+        # (id, fqdn, mlab group or None), by fqdn
+        s = self.strings
+        return [(self.target_ids[i], s[self.target_fqdns[i]],
+                 s[self.target_groups[i]] if self.target_groups[i] >= 0
+                 else None)
+                for i in xrange(len(self.target_ids))]
+
+    def history(self):
+        # (target id, fqdn, ip, epoch), ordered by target id and date
+        s = self.strings
+        ids = self.target_ids
+        fqdns = self.target_fqdns
+        return [(ids[t], s[fqdns[t]], s[ip], epoch)
+                for t, ip, epoch in zip(self.row_targets, self.row_ips,
+                                        self.row_epochs)]
+
+    def current_ips(self):
+        # {fqdn: newest ip}
+        ips = {}
+        for target_id, fqdn, ip, epoch in self.history():
+            ips[fqdn] = ip  # history is oldest first
+        return ips
+
+
+def open_directory(dbconn, path, force=False):
+    # the snapshot at path, rebuilt first if it is missing, unreadable or
+    # older than the targets and target_ips tables
+    fingerprint = directory_fingerprint(dbconn)
+    if not force:
+        try:
+            directory = MserverDirectory(path)
+            if directory.fingerprint == fingerprint:
+                return directory
+        except (IOError, OSError, SnapshotError):
+            pass
+    build_snapshot(dbconn, path, fingerprint)
+    return MserverDirectory(path)
+
+
+def prune_history(history, start):
+    # What the old per-program query kept: for each target, its entries from
+    # its newest date_effective before start (or its oldest, if it has none
+    # before start) onwards.
+    before = {}
+    after = {}
+    for target_id, fqdn, ip, epoch in history:
+        if epoch < start:
+            before[target_id] = max(before.get(target_id, epoch), epoch)
+        else:
+            after[target_id] = min(after.get(target_id, epoch), epoch)
+    min_epoch = after
+    min_epoch.update(before)
+    return [h for h in history if h[3] >= min_epoch[h[0]]]
+
+
+# class MserverDatabase
+#
+# The purpose of this class is to provide a DNS-like interface, along with a
+# notion of history (lookups in the past) for measurement server IP addressses
+# and fully-qualified domain names (FQDNs). This is necessary because
+# measurements sources/destinations are stored as IP addresses, while
+# measurement servers are caonically referred to by name (though their IP
+# address could theoretically change).
+#
+# Each IP (and each FQDN) maps to an ascending array of the epochs at which
+# its entries took effect and a parallel list of FQDNs (IPs), so a lookup is
+# one bisect. An entry applies to times strictly after its date_effective;
+# of entries with the same date_effective, the one loaded first wins.
+class MserverDatabase(object):
+    def __init__(self, directory, start_date=None, now=None):
+        self.now = now
+        self.ptr_index = {}  # ip -> (epochs, fqdns)
+        self.a_index = {}  # fqdn -> (epochs, ips)
+        self.id_by_fqdn = {}
+        self.fqdn_by_id = {}
+        self.fqdn_list = []
+        self.fqdns_by_mlab_group = {}  # group eg. atl01, syd02, etc.
+
+        history = directory.history()
+        if start_date is not None:
+            history = prune_history(history, to_epoch(start_date))
+        fqdns_by_ip = {}
+        ips_by_fqdn = {}
+        for seq, (target_id, fqdn, ip, epoch) in enumerate(history):
+            # -seq puts the first loaded of equal dates last, where bisect
+            # finds it
+            fqdns_by_ip.setdefault(ip, []).append((epoch, -seq, fqdn))
+            ips_by_fqdn.setdefault(fqdn, []).append((epoch, -seq, ip))
+        self.ptr_index = build_history_index(fqdns_by_ip)
+        self.a_index = build_history_index(ips_by_fqdn)
+
+        # every target has an id, whether or not it has any addresses
+        for target_id, fqdn, group in directory.targets():
+            self.id_by_fqdn[fqdn] = target_id
+            self.fqdn_by_id[target_id] = fqdn
+            self.fqdn_list.append(fqdn)
+            if group is not None:
+                self.fqdns_by_mlab_group.setdefault(group, []).append(fqdn)
+
+    def default_epoch(self):
+        return to_epoch(self.now or datetime.datetime.utcnow())
+
+    def lookup_ptr(self, ip, date_effective=None):
+        return lookup_history(self.ptr_index, ip, to_epoch(date_effective)
+                              if date_effective else self.default_epoch())
+
+    def lookup_a(self, fqdn, date_effective=None):
+        return lookup_history(self.a_index, fqdn, to_epoch(date_effective)
+                              if date_effective else self.default_epoch())
+
+    def lookup_ptrs(self, pairs):
+        # lookup_ptr for a sequence of (ip, date_effective) pairs
+        now = self.default_epoch()
+        index = self.ptr_index
+        fqdns = []
+        for ip, date_effective in pairs:
+            try:
+                epochs, values = index[ip]
+            except KeyError:
+                fqdns.append(None)
+                continue
+            i = bisect.bisect_left(
+                    epochs, to_epoch(date_effective) if date_effective else now)
+            fqdns.append(values[i-1] if i > 0 else None)
+        return fqdns
+
+    def lookup_id(self, fqdn):
+        return self.id_by_fqdn.get(fqdn, None)
+
+    def ptr_history(self):
+        # (ip, fqdn, since, until) for every entry: lookup_ptr(ip) returns
+        # fqdn for epochs in (since, until], or after since if until is None
+        for ip, (epochs, fqdns) in self.ptr_index.iteritems():
+            for i in xrange(len(epochs)):
+                until = epochs[i+1] if i+1 < len(epochs) else None
+                yield ip, fqdns[i], epochs[i], until
+
+
+def build_history_index(entries_by_key):
+    index = {}
+    for key, entries in entries_by_key.iteritems():
+        entries.sort()
+        index[key] = (array.array('d', [e[0] for e in entries]),
+                      [e[2] for e in entries])
+    return index
+
+
+def lookup_history(index, key, epoch):
+    # the newest value that took effect strictly before epoch
+    try:
+        epochs, values = index[key]
+    except KeyError:
+        return None
+    i = bisect.bisect_left(epochs, epoch)
+    return values[i-1] if i > 0 else None
+
+
+if __name__ == '__main__':
+    argp = argparse.ArgumentParser(
+            description='Build or show the mserver directory snapshot')
+    argp.add_argument('command', choices=('build', 'show'))
+    argp.add_argument('--snapshot',
+                      help='default: $VAR_DIR/%s' % SNAPSHOT_SUBPATH)
+    argp.add_argument('--force', action='store_true',
+                      help='rebuild even if the tables have not changed')
+    args = argp.parse_args()
+
+    config = {}
+    for evname in REQ_ENV_VARS:
+        if args.command == 'show' and evname != 'VAR_DIR':
+            continue
+        try:
+            config[evname] = os.environ[evname]
+        except KeyError:
+            sys.stderr.write(("Environment variable '%s' required and not "
+                              "defined. Terminating.\n") % evname)
+            sys.exit(1)
+    for (evname, default_val) in OPT_ENV_VARS:
+        config[evname] = os.environ.get(evname) or default_val
+    path = args.snapshot or snapshot_path(config)
+
+    if args.command == 'build':
+        import psycopg2
+        mconn = psycopg2.connect(
+                host=config['BDM_PG_HOST'],
+                port=int(config['BDM_PG_PORT']),
+                database=config['BDM_PG_MGMT_DBNAME'],
+                user=config['BDM_PG_USER'],
+                password=config['BDM_PG_PASSWORD'],
+                )
+        directory = open_directory(mconn, path, force=args.force)
+    else:
+        directory = MserverDirectory(path)
+    print("%s: fingerprint %s, built %s UTC, %d targets, %d addresses" % (
+            path, directory.fingerprint,
+            datetime.datetime.utcfromtimestamp(directory.built_at).isoformat(),
+            len(directory.target_ids), len(directory.row_ips)))
+    if args.command == 'show':
+        ips = directory.current_ips()
+        for target_id, fqdn, group in directory.targets():
+            print("%5d %-50s %-16s %s" % (target_id, fqdn,
+                                          ips.get(fqdn, '-'), group or '-'))
@@ -1,15 +1,26 @@
 #!/usr/bin/env python
 
 import calendar
+import argparse
 import datetime
 import os
 import sys
 import pprint
 import socket
 import re
+import time
 
 import psycopg2
 
+from mserver_directory import MserverDatabase, open_directory, snapshot_path
+from mserver_prober import (CONTROL_PORT, REQUEST_TIMEOUT, MserverProber,
+                            parse_ping_output)
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                '..', 'scripts'))
+import trstore
+
+UPDATE_FREQUENCY = datetime.timedelta(days=30)
 OLD_DEVICE_THRESHOLD = datetime.timedelta(days=7)
 FRESHNESS_THRESHOLD = datetime.timedelta(days=30)
 #FRESHNESS_THRESHOLD = datetime.timedelta(days=730)
@@ -31,101 +42,10 @@ OPT_ENV_VARS = [('BDM_PG_PORT', 5432),
                 ('BDMD_TCP_KEEPCNT', 2),
                 ('BDMD_TCP_KEEPINTVL', 10),
                 ('BDMD_DEBUG', 0),
+                ('BDMD_MSERVER_SNAPSHOT', None),
                 ]
 LOG_SUBDIR = 'log/devices'
-
-
-# class MserverDatabase
-#
-# The purpose of this class is to provide a DNS-like interface, along with a
-# notion of history (lookups in the past) for measurement server IP addressses
-# and fully-qualified domain names (FQDNs). This is necessary because
-# measurements sources/destinations are stored as IP addresses, while
-# measurement servers are caonically referred to by name (though their IP
-# address could theoretically change).
-class MserverDatabase(object):
-    def __init__(self, dbconn, start_date):
-        self.fqdns_by_ip = {}
-        self.ips_by_fqdn = {}
-        self.id_by_fqdn = {}
-        self.fqdn_by_id = {}
-        self.fqdn_list = []
-        self.fqdns_by_mlab_group = {}  # group eg. atl01, syd02, etc.
-
-        cur = dbconn.cursor()
-        cur.execute((
-                "SELECT ti.target_id, t.fqdn, ti.ip, ti.date_effective "
-                "FROM targets as t, target_ips as ti, ( "
-                "    SELECT t.target_id, min(t.min) as min_date "
-                "    FROM (( "
-                "            SELECT target_id, min(date_effective) "
-                "            FROM target_ips "
-                "            WHERE date_effective >= %s "
-                "            GROUP BY target_id "
-                "        ) UNION ( "
-                "            SELECT target_id, max(date_effective) "
-                "            FROM target_ips "
-                "            WHERE date_effective < %s "
-                "            GROUP BY target_id "
-                "    )) as t "
-                "    GROUP BY target_id "
-                ") as tmp "
-                "WHERE ti.target_id = tmp.target_id "
-                "AND t.id = ti.target_id "
-                "AND ti.date_effective >= tmp.min_date "
-                "ORDER BY target_id, date_effective; "),
-                [start_date.isoformat()]*2)
-        for row in cur.fetchall():
-            self.fqdns_by_ip.setdefault(row[2], []).append({
-                    'fqdn': row[1],
-                    'date_effective': row[3]})
-            self.ips_by_fqdn.setdefault(row[1], []).append({
-                    'ip': row[2],
-                    'date_effective': row[3]})
-            self.id_by_fqdn[row[1]] = row[0]
-            self.fqdn_by_id[row[0]] = row[1]
-        for k in self.fqdns_by_ip:
-            self.fqdns_by_ip[k].sort(
-                    key=lambda x: x['date_effective'], reverse=True)
-        for k in self.ips_by_fqdn:
-            self.ips_by_fqdn[k].sort(
-                    key=lambda x: x['date_effective'], reverse=True)
-
-        cur.execute("SELECT fqdn FROM targets")
-        self.fqdn_list = [x[0] for x in cur.fetchall()]
-        self.fqdn_list.sort()
-
-        for fqdn in self.fqdn_list:
-            parts = fqdn.split('.')
-            if parts[-3]+'.'+parts[-2] == 'measurement-lab.org':
-                self.fqdns_by_mlab_group.setdefault(parts[-4], []).append(fqdn)
-
-    def lookup_ptr(self, ip, date_effective=None):
-        if not date_effective:
-            date_effective = datetime.datetime.utcnow()
-        try:
-            fqdn_list = self.fqdns_by_ip[ip]
-            for f in fqdn_list:
-                if f['date_effective'] < date_effective:
-                    return f['fqdn']
-            return None
-        except KeyError:
-            return None
-
-    def lookup_a(self, fqdn, date_effective=None):
-        if not date_effective:
-            date_effective = datetime.datetime.utcnow()
-        try:
-            ip_list = self.ips_by_fqdn[fqdn]
-            for i in ip_list:
-                if i['date_effective'] < date_effective:
-                    return i['ip']
-            return None
-        except KeyError:
-            return None
-
-    def lookup_id(self, fqdn):
-        return self.id_by_fqdn.get(fqdn, None)
+INSERT_BATCH = 1000  # m_mserver_rping rows per INSERT
 
 
 def print_debug_factory(is_debug):
@@ -149,75 +69,153 @@ def print_entry(f):
     return wrapper
 
 def find_update_candidates(dbconn):
+    # devices seen in the last OLD_DEVICE_THRESHOLD whose targets are out of
+    # date, or that have none
+    now = datetime.datetime.utcnow()
     cur = dbconn.cursor()
     cur.execute((
             "SELECT t.id, t.min_date "
             "FROM ( "
             "   SELECT dt.device_id as id, min(dt.date_effective) as min_date "
             "   FROM device_targets as dt "
-            "   WHERE dt.device_id = dt.device_id "
-            "   AND dt.is_permanent = FALSE "
+            "   WHERE dt.is_permanent = FALSE "
             "   AND dt.is_enabled = TRUE "
             "   GROUP BY dt.device_id "
-            "   ) AS t "
-            "WHERE t.min_date < %s;"),
-            [(datetime.datetime.utcnow() - UPDATE_FREQUENCY).isoformat()])
-    outofdate_devices = cur.fetchall()
-    cur.execute(
-            "SELECT t.did as id, NULL as min_date "
-            "FROM ( "
-            "   SELECT d.id as did, dt.device_id as dtid "
-            "   FROM devices as d"
-            "   LEFT OUTER JOIN device_targets as dt ON d.id = dt.device_id "
-            "   ) AS t "
-            "WHERE dtid IS NULL;")
-    unknown_devices = cur.fetchall()
-    cur.execute(
-            "SELECT devices.id FROM devices WHERE last_seen_ts < %s;",
-            [calendar.timegm((datetime.datetime.utcnow() -
-            OLD_DEVICE_THRESHOLD).timetuple())])
-    old_devices = [x[0] for x in cur.fetchall()]
-    return [x for x in (outofdate_devices + unknown_devices)
-            if x[0] not in old_devices]
+            "   ) AS t, devices AS d "
+            "WHERE t.min_date < %s "
+            "AND t.id = d.id "
+            "AND d.date_last_seen >= %s "
+            "UNION ALL "
+            "SELECT d.id, NULL "
+            "FROM devices AS d "
+            "WHERE d.date_last_seen >= %s "
+            "AND NOT EXISTS ( "
+            "   SELECT 1 FROM device_targets AS dt "
+            "   WHERE dt.device_id = d.id);"),
+            [(now - UPDATE_FREQUENCY), (now - OLD_DEVICE_THRESHOLD),
+             (now - OLD_DEVICE_THRESHOLD)])
+    return cur.fetchall()
 
 def filter_devices(mgmt_dbconn, data_dbconn, candidates):
+    # the candidates without RTT data from the last FRESHNESS_THRESHOLD,
+    # which we need to ping from the servers
+    ids = [c[0] for c in candidates if re.match('^OW[0-9A-F]{12}$', c[0])]
+    if not ids:
+        return []
+    dcur = data_dbconn.cursor()
+    dcur.execute((
+            "SELECT c.deviceid "
+            "FROM unnest(%s::text[]) AS c(deviceid) "
+            "WHERE NOT EXISTS ( "
+            "   SELECT 1 FROM m_mserver_rtt AS m "
+            "   WHERE m.deviceid = c.deviceid "
+            "   AND m.eventstamp > %s);"),
+            [[d[2:] for d in ids],
+             datetime.datetime.utcnow() - FRESHNESS_THRESHOLD])
+    stale = set([x[0] for x in dcur.fetchall()])
+    return [d for d in ids if d[2:] in stale]
+
+def ping_devices(mgmt_dbconn, data_dbconn, devices, mserver_db, tr_store,
+                 prober, deadline=None):
+    # Ping each device from every measurement server. A device is pinged at
+    # the source address of its latest traceroute in the store, or failing
+    # that at the address it last checked in to bdmd from. All the pings are
+    # made at once (see MserverProber) and the results written together, with
+    # the device as srcip and the server as dstip, as update_device_targets
+    # reads them.
+    now = datetime.datetime.utcnow()
+    since = calendar.timegm((now - FRESHNESS_THRESHOLD).timetuple())
+    mcur = mgmt_dbconn.cursor()
+    mcur.execute("SELECT id, host(ip) FROM devices WHERE id = ANY(%s);",
+            [list(devices)])
+    checkin_ips = dict(mcur.fetchall())
+    device_by_ip = {}
+    for d in devices:
+        traceroute = tr_store.latest(d[2:], since)
+        if traceroute is not None and traceroute[0][2] != '0.0.0.0':
+            ip = traceroute[0][2]
+        elif d in checkin_ips:
+            ip = checkin_ips[d]
+        else:
+            print_error("ERROR: no address to ping device '%s'." % d)
+            continue
+        device_by_ip.setdefault(ip, []).append(d)
+    server_ips = {}
+    for fqdn in mserver_db.fqdn_list:
+        server_ip = mserver_db.lookup_a(fqdn, now)
+        if server_ip is None:
+            print_error("ERROR: no address for mserver '%s', not pinging "
+                        "from it." % fqdn)
+            continue
+        server_ips[fqdn] = server_ip
+    requests = [(fqdn, ip) for ip in sorted(device_by_ip)
+                for fqdn in mserver_db.fqdn_list if fqdn in server_ips]
+    rows = []
+    for fqdn, ip, ping_out in prober.run_blocking(requests, deadline):
+        if 'rtt_avg' not in ping_out:
+            continue
+        for d in device_by_ip[ip]:
+            rows.append((d[2:], ip, server_ips[fqdn], now,
+                         ping_out['rtt_avg'], ping_out['rtt_min'],
+                         ping_out['rtt_max'], ping_out['rtt_stddev']))
+    write_rpings(data_dbconn, rows)
+    return rows
+
+def write_rpings(data_dbconn, rows):
     dcur = data_dbconn.cursor()
-    devices_to_ping = []
-    candidates = [c for c in candidates if re.match('^OW[0-9A-F]{12}$', c[0])]
-    for c in candidates:
+    for i in xrange(0, len(rows), INSERT_BATCH):
         dcur.execute((
-                "SELECT dstip, eventstamp, "
-                "   average, median, minimum, maximum, std "
-                "FROM m_mserver_rtt "
-                "WHERE deviceid = %s "
-                "AND eventstamp > %s "),
-                [c[0][2:], (datetime.datetime.utcnow() -
-                FRESHNESS_THRESHOLD).isoformat()])
+                "INSERT INTO m_mserver_rping (deviceid, srcip, dstip, "
+                "   eventstamp, average, minimum, maximum, std, "
+                "   toolid, exitstatus) "
+                "VALUES %s;") % ','.join(
+                        [dcur.mogrify("(%s, %s, %s, %s, %s, %s, %s, %s, "
+                                      "'ping', 0)", row)
+                         for row in rows[i:i+INSERT_BATCH]]))
+    data_dbconn.commit()
 
-        if dcur.rowcount is not None and dcur.rowcount == 0:
-            # no rtt data, we need to ping from the servers
-            devices_to_ping.append(c[0])
 
-def ping_devices(mgmt_dbconn, data_dbconn, devices, mserver_db):
-    dcur = data_dbconn.cursor()
-    dcur.execute((
-            # TODO: need to account for direction here!!
-            "SELECT t1.deviceid, t1.id, t1.eventstamp "
-            "FROM traceroutes as t1 "
-            "WHERE t1.eventstamp >= ( "
-            "   SELECT max(t2.eventstamp) "
-            "   FROM traceroutes as t2 "
-            "   WHERE t2.deviceid = t1.deviceid "
-            "   ) "
-            "AND t1.eventstamp > %s "
-            "ORDER BY t1.eventstamp;"),
-            [(datetime.datetime.utcnow() - FRESHNESS_THRESHOLD).isoformat()])
-    rows = dcur.fetchall()
-    traceroute_ids = dict([r[0:20 for r in rows])
-    for d in devices:
+def mserver_ping(ip, mserver_hostname):
+    # one blocking request, as MserverProber makes many at once
+    return parse_ping_output(
+            netcat(mserver_hostname, CONTROL_PORT, 'ping %s -q\n' % ip))
+
+# based on
+# http://stackoverflow.com/questions/1908878/netcat-implementation-in-python
+def netcat(hostname, port, content):
+    s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    s.settimeout(5)
+    output = []
+    try:
+        s.connect((hostname, port))
+        s.sendall(content)
+        s.settimeout(20)
+        while 1:
+            data = s.recv(1024)
+            if data == "":
+                break
+            output.extend(data.strip().split('\n'))
+        s.close()
+    except socket.timeout:
+        output = []
+    return [x for x in output if x]
 
 
 if __name__ == '__main__':
+    argp = argparse.ArgumentParser(
+            description='Ping devices without RTT data from the mservers')
+    argp.add_argument('--per-server', type=int, default=4,
+                      help='requests outstanding per mserver (default: 4)')
+    argp.add_argument('--max-concurrent', type=int, default=256,
+                      help='requests outstanding in all (default: 256)')
+    argp.add_argument('--timeout', type=float, default=REQUEST_TIMEOUT,
+                      help=('seconds allowed per request, connecting '
+                            'included (default: %d)' % REQUEST_TIMEOUT))
+    argp.add_argument('--deadline', type=float,
+                      help="seconds after which requests that haven't "
+                           "started are skipped")
+    args = argp.parse_args()
+
     config = {}
     for evname in REQ_ENV_VARS:
         try:
@@ -248,7 +246,7 @@ if __name__ == '__main__':
             )
 
     mdb = MserverDatabase(
-            mconn,
+            open_directory(mconn, snapshot_path(config)),
             start_date=(datetime.datetime.utcnow() - FRESHNESS_THRESHOLD))
     update_candidates = find_update_candidates(mconn)
     pprint.pprint(update_candidates)
@@ -258,6 +256,17 @@ if __name__ == '__main__':
     #pprint.pprint(update_candidates)
     ping_candidates = filter_devices(mconn, dconn, update_candidates)
     pprint.pprint(ping_candidates)
+    if ping_candidates:
+        trstore.init()
+        prober = MserverProber(per_server=args.per_server,
+                               max_concurrent=args.max_concurrent,
+                               request_timeout=args.timeout)
+        start = time.time()
+        rows = ping_devices(mconn, dconn, ping_candidates, mdb, trstore.store,
+                            prober, args.deadline)
+        print("%d ping result(s) written for %d device(s) in %.1fs: %s" % (
+                len(rows), len(ping_candidates), time.time() - start,
+                ', '.join(['%s %d' % c for c in sorted(prober.counts.items())])))
     #update_targets(conn, updated_device_targets)
 
 
@@ -275,47 +284,3 @@ if __name__ == '__main__':
 # INSERT INTO device_targets (device_id, target_id, preference, date_effective,
 # is_enabled) VALUES (%s, %s, %s, %s, TRUE)
 # COMMIT;
-
-def mserver_ping(ip, mserver_hostname):
-    ping_out = {}
-    output = netcat(mserver_hostname, 1101, 'ping %s -q\n' % ip)
-    try:
-        groups = re.match(
-                '(\d+) packets transmitted, (\d+) received',
-                output[2]).groups()
-        ping_out['count_sent'] = int(groups[0])
-        ping_out['count_recv'] = int(groups[1])
-    except (AttributeError, IndexError):
-        pass
-    try:
-        groups = re.match(
-                'rtt min/avg/max/mdev = '
-                '((?:\d+(?:\.\d+)?/){3}(?:\d+(?:\.\d+)?))',
-                output[3]).groups()[0].split('/')
-        ping_out['rtt_min']    = float(groups[0])
-        ping_out['rtt_avg']    = float(groups[1])
-        ping_out['rtt_max']    = float(groups[2])
-        ping_out['rtt_stddev'] = float(groups[3])
-    except (AttributeError, IndexError):
-        pass
-    return ping_out
-
-# based on
-# http://stackoverflow.com/questions/1908878/netcat-implementation-in-python
-def netcat(hostname, port, content):
-    s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-    s.settimeout(5)
-    output = []
-    try:
-        s.connect((hostname, port))
-        s.sendall(content)
-        s.settimeout(20)
-        while 1:
-            data = s.recv(1024)
-            if data == "":
-                break
-            output.extend(data.strip().split('\n'))
-        s.close()
-    except socket.timeout:
-        output = []
-    return [x for x in output if x]
@@ -0,0 +1,401 @@
+#!/usr/bin/env python
+#
+# Concurrent pings from measurement servers. Each mserver runs a control
+# service on port 1101 that answers "ping <ip> -q" with the output of ping -q
+# and then hangs up. MserverProber sends many of these requests at once from
+# a Twisted reactor, with at most per_server outstanding against any one
+# server and at most max_concurrent in all, so that a few dozen servers can
+# ping hundreds of devices in the time the slowest few requests take instead
+# of one request after another.
+#
+# Every request has a connect timeout and an overall timeout; a request that
+# runs out of time, fails to connect or gets unparsable output yields {}, as
+# the blocking mserver_ping() does. A run can also be given a deadline after
+# which requests that haven't started are skipped.
+#
+# Rather than a connection per request, the requests to a server can share a
+# pool of up to connections_per_server long-lived connections, several
+# requests outstanding on each (see ControlConnectionPool). Answers are
+# matched to requests by the address in their PING header. A server that
+# hangs up after one answer with more requests outstanding doesn't pipeline:
+# those requests, and all later ones to it, get a connection each.
+
+import re
+import time
+
+from twisted.internet import defer, reactor
+from twisted.internet.protocol import ClientFactory, Protocol
+from twisted.protocols.basic import LineReceiver
+
+CONTROL_PORT = 1101
+CONNECT_TIMEOUT = 5
+REQUEST_TIMEOUT = 25
+CONNECTIONS_PER_SERVER = 2
+
+PING_HEADER = re.compile('PING (\S+) ')
+PING_PACKETS = re.compile('\d+ packets transmitted, (\d+) received')
+
+
+def parse_ping_output(output):
+    # output is the non-empty lines of ping -q, e.g.
+    #   PING 192.0.2.1 (192.0.2.1) 56(84) bytes of data.
+    #   --- 192.0.2.1 ping statistics ---
+    #   5 packets transmitted, 5 received, 0% packet loss, time 4005ms
+    #   rtt min/avg/max/mdev = 10.120/12.208/14.301/1.511 ms
+    ping_out = {}
+    try:
+        groups = re.match(
+                '(\d+) packets transmitted, (\d+) received',
+                output[2]).groups()
+        ping_out['count_sent'] = int(groups[0])
+        ping_out['count_recv'] = int(groups[1])
+    except (AttributeError, IndexError):
+        pass
+    try:
+        groups = re.match(
+                'rtt min/avg/max/mdev = '
+                '((?:\d+(?:\.\d+)?/){3}(?:\d+(?:\.\d+)?))',
+                output[3]).groups()[0].split('/')
+        ping_out['rtt_min']    = float(groups[0])
+        ping_out['rtt_avg']    = float(groups[1])
+        ping_out['rtt_max']    = float(groups[2])
+        ping_out['rtt_stddev'] = float(groups[3])
+    except (AttributeError, IndexError):
+        pass
+    return ping_out
+
+
+def split_output(data):
+    return [x for x in data.strip().split('\n') if x.strip()]
+
+
+class PingProtocol(Protocol):
+    def connectionMade(self):
+        self.chunks = []
+        self.transport.write('ping %s -q\n' % self.factory.ip)
+
+    def dataReceived(self, data):
+        self.chunks.append(data)
+
+    def connectionLost(self, reason):
+        self.factory.done(''.join(self.chunks))
+
+
+class PingClientFactory(ClientFactory):
+    protocol = PingProtocol
+
+    def __init__(self, ip):
+        self.ip = ip
+        self.connector = None
+        self.cancelled = False
+        self.deferred = defer.Deferred(self.cancel)
+
+    def done(self, data):
+        if not self.cancelled and not self.deferred.called:
+            self.deferred.callback(data)
+
+    def clientConnectionFailed(self, connector, reason):
+        if not self.cancelled and not self.deferred.called:
+            self.deferred.errback(reason)
+
+    def cancel(self, d):
+        # like netcat(), output cut short by the timeout is discarded
+        self.cancelled = True
+        self.connector.disconnect()
+
+
+class PipelinedPingProtocol(LineReceiver):
+    # Splits what the server sends into answers: an answer starts with its
+    # PING header and ends with the rtt line, or with the packets line if
+    # nothing was received.
+    delimiter = '\n'
+
+    def connectionMade(self):
+        self.ip = None
+        self.lines = []
+        self.factory.connected(self)
+
+    def send(self, ip):
+        self.transport.write('ping %s -q\n' % ip)
+
+    def lineReceived(self, line):
+        line = line.strip()
+        if not line:
+            return
+        m = PING_HEADER.match(line)
+        if m:
+            self.finish()
+            self.ip, self.lines = m.group(1), [line]
+            return
+        if self.ip is None:
+            return  # not part of an answer
+        self.lines.append(line)
+        m = PING_PACKETS.match(line)
+        if line.startswith('rtt ') or (m and m.group(1) == '0'):
+            self.finish()
+
+    def finish(self):
+        if self.ip is not None:
+            ip, lines = self.ip, self.lines
+            self.ip, self.lines = None, []
+            self.factory.answer(ip, '\n'.join(lines))
+
+    def connectionLost(self, reason):
+        self.finish()
+
+
+# class PipelinedClientFactory
+#
+# One long-lived connection of a ControlConnectionPool and the requests
+# outstanding on it. Requests made while connecting are sent once connected.
+class PipelinedClientFactory(ClientFactory):
+    protocol = PipelinedPingProtocol
+
+    def __init__(self, pool):
+        self.pool = pool
+        self.connector = None
+        self.client = None
+        self.pending = {}   # ip -> [Deferred, ...], oldest first
+        self.unsent = []    # ips requested before the connection was made
+        self.retried = {}   # Deferred -> its request on a connection of its own
+        self.outstanding = 0
+        self.answered = 0
+        self.retired = False
+        self.closing = False
+
+    def request(self, ip):
+        d = defer.Deferred(lambda d: self.cancel(ip, d))
+        self.pending.setdefault(ip, []).append(d)
+        self.outstanding += 1
+        if self.client is None:
+            self.unsent.append(ip)
+        else:
+            self.client.send(ip)
+        return d
+
+    def connected(self, client):
+        self.client = client
+        for ip in self.unsent:
+            client.send(ip)
+        self.unsent = []
+
+    def answer(self, ip, data):
+        ds = self.pending.get(ip)
+        if not ds:
+            return  # cancelled, or not asked for
+        d = ds.pop(0)
+        if not ds:
+            del self.pending[ip]
+        self.outstanding -= 1
+        self.answered += 1
+        d.callback(data)
+        if self.retired and self.outstanding == 0:
+            self.close()
+
+    def cancel(self, ip, d):
+        if d in self.retried:
+            self.retried.pop(d).cancel()
+            return
+        ds = self.pending.get(ip, [])
+        if d in ds:
+            ds.remove(d)
+            if not ds:
+                del self.pending[ip]
+            self.outstanding -= 1
+        # the server may be stuck, so send nothing more this way
+        self.retire()
+
+    def retire(self):
+        self.retired = True
+        self.pool.discard(self)
+        if self.outstanding == 0:
+            self.close()
+
+    def close(self):
+        if not self.closing:
+            self.closing = True
+            self.connector.disconnect()
+
+    def clientConnectionFailed(self, connector, reason):
+        self.closing = True
+        self.lost(reason, retry=False)
+
+    def clientConnectionLost(self, connector, reason):
+        # hanging up after an answer with requests outstanding is what a
+        # server that doesn't pipeline does
+        retry = not self.closing and self.answered > 0 and self.outstanding > 0
+        if retry:
+            self.pool.pipelining = False
+        self.lost(reason, retry)
+
+    def lost(self, reason, retry):
+        self.pool.discard(self)
+        left = [(ip, d) for ip, ds in self.pending.iteritems() for d in ds]
+        self.pending = {}
+        self.outstanding = 0
+        for ip, d in left:
+            if retry:
+                self.retried[d] = self.pool.single(ip)
+                self.retried[d].chainDeferred(d)
+            else:
+                d.errback(reason)
+
+
+# class ControlConnectionPool
+#
+# The connections to one server's control service: up to size pipelined
+# connections, each request going to an idle one, a new one or else the one
+# with fewest outstanding. Once the server turns out not to pipeline (or if
+# pipelining is False to begin with), each request gets a connection of its
+# own instead. connects counts the connections made.
+class ControlConnectionPool(object):
+    def __init__(self, host, port, size, connect_timeout, pipelining=True):
+        self.host = host
+        self.port = port
+        self.size = size
+        self.connect_timeout = connect_timeout
+        self.pipelining = pipelining
+        self.factories = []  # connections taking requests
+        self.connects = 0
+
+    def request(self, ip):
+        # Deferred firing with the answer to "ping <ip> -q"
+        if not self.pipelining:
+            return self.single(ip)
+        idle = [f for f in self.factories if f.outstanding == 0]
+        if idle:
+            factory = idle[0]
+        elif len(self.factories) < self.size:
+            factory = self.connect(PipelinedClientFactory(self))
+            self.factories.append(factory)
+        else:
+            factory = min(self.factories, key=lambda f: f.outstanding)
+        return factory.request(ip)
+
+    def single(self, ip):
+        return self.connect(PingClientFactory(ip)).deferred
+
+    def connect(self, factory):
+        self.connects += 1
+        factory.connector = reactor.connectTCP(self.host, self.port, factory,
+                                               timeout=self.connect_timeout)
+        return factory
+
+    def discard(self, factory):
+        if factory in self.factories:
+            self.factories.remove(factory)
+
+    def close(self):
+        for factory in list(self.factories):
+            factory.retire()
+
+
+# class MserverProber
+#
+# address(fqdn) gives the (host, port) to reach a server's control service;
+# by default that is the fqdn itself on CONTROL_PORT. With
+# connections_per_server 0, every request gets a connection of its own.
+class MserverProber(object):
+    def __init__(self, per_server=4, max_concurrent=256,
+                 connect_timeout=CONNECT_TIMEOUT,
+                 request_timeout=REQUEST_TIMEOUT, address=None,
+                 connections_per_server=CONNECTIONS_PER_SERVER):
+        self.per_server = per_server
+        self.connect_timeout = connect_timeout
+        self.request_timeout = request_timeout
+        self.address = address or (lambda fqdn: (fqdn, CONTROL_PORT))
+        self.connections_per_server = connections_per_server
+        self.overall = defer.DeferredSemaphore(max_concurrent)
+        self.servers = {}  # fqdn -> DeferredSemaphore
+        self.pools = {}    # fqdn -> ControlConnectionPool
+        self.deadline = None
+        self.counts = {'ok': 0, 'failed': 0, 'timeout': 0, 'skipped': 0}
+
+    def pool(self, fqdn):
+        pool = self.pools.get(fqdn)
+        if pool is None:
+            host, port = self.address(fqdn)
+            pool = self.pools[fqdn] = ControlConnectionPool(
+                    host, port, self.connections_per_server,
+                    self.connect_timeout,
+                    pipelining=self.connections_per_server > 0)
+        return pool
+
+    def ping(self, fqdn, ip):
+        # Deferred firing with ping_out, {} on any failure
+        if self.deadline is not None and time.time() >= self.deadline:
+            self.counts['skipped'] += 1
+            return defer.succeed({})
+        d = self.pool(fqdn).request(ip)
+        timer = reactor.callLater(self.request_timeout, self.expire, d)
+        d.addCallback(self.parsed, timer)
+        d.addErrback(self.failed, timer)
+        return d
+
+    def expire(self, d):
+        if not d.called:
+            self.counts['timeout'] += 1
+            d.cancel()
+
+    def parsed(self, data, timer):
+        if timer.active():
+            timer.cancel()
+        ping_out = parse_ping_output(split_output(data))
+        self.counts['ok' if 'rtt_avg' in ping_out else 'failed'] += 1
+        return ping_out
+
+    def failed(self, failure, timer):
+        if timer.active():
+            timer.cancel()
+        if not failure.check(defer.CancelledError):
+            self.counts['failed'] += 1
+        return {}
+
+    def connects(self):
+        return sum([p.connects for p in self.pools.itervalues()])
+
+    def unpipelined(self):
+        # servers that turned out to want a connection per request
+        if not self.connections_per_server:
+            return []
+        return sorted([fqdn for fqdn, p in self.pools.iteritems()
+                       if not p.pipelining])
+
+    def close(self, result=None):
+        for pool in self.pools.itervalues():
+            pool.close()
+        return result
+
+    def limited_ping(self, fqdn, ip):
+        server = self.servers.get(fqdn)
+        if server is None:
+            server = self.servers[fqdn] = defer.DeferredSemaphore(
+                    self.per_server)
+        return server.run(self.overall.run, self.ping, fqdn, ip)
+
+    def run(self, requests, deadline=None):
+        # requests is a list of (fqdn, ip); returns a Deferred firing with
+        # [(fqdn, ip, ping_out), ...] in the same order
+        self.deadline = time.time() + deadline if deadline else None
+        ds = [self.limited_ping(fqdn, ip) for fqdn, ip in requests]
+        d = defer.gatherResults(ds)
+        d.addCallback(lambda results: [(fqdn, ip, ping_out) for
+                                       (fqdn, ip), ping_out in
+                                       zip(requests, results)])
+        d.addBoth(self.close)
+        return d
+
+    def run_blocking(self, requests, deadline=None):
+        # run() for callers that aren't otherwise Twisted: runs the reactor
+        # until every request is answered (the reactor can't be restarted)
+        results = []
+        def finished(r):
+            results.extend(r)
+            reactor.stop()
+        def crashed(failure):
+            failure.printTraceback()
+            reactor.stop()
+        reactor.callWhenRunning(lambda: self.run(requests, deadline)
+                                .addCallbacks(finished, crashed))
+        reactor.run()
+        return results
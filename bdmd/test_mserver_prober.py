@@ -0,0 +1,147 @@
+#!/usr/bin/env python
+#
+# Tests of MserverProber against fake_mserver.py's control service, run in
+# the same reactor:
+#
+#   trial test_mserver_prober     (from bdmd/)
+#
+# The fake here answers a ping of a.b.c.N with every RTT equal to N, so each
+# result can be checked against the address it was returned for.
+
+import argparse
+import random
+
+from twisted.internet import defer, reactor, task
+from twisted.trial import unittest
+
+import fake_mserver
+from mserver_prober import MserverProber
+
+FQDN = 'ndt.test.mlab1.tst01.measurement-lab.org.'
+
+
+def ping_output(ip):
+    rtt = float(ip.split('.')[-1])
+    return '\n'.join([
+            'PING %s (%s) 56(84) bytes of data.' % (ip, ip),
+            '',
+            '--- %s ping statistics ---' % ip,
+            '5 packets transmitted, 5 received, 0% packet loss, time 4004ms',
+            'rtt min/avg/max/mdev = %.3f/%.3f/%.3f/0.000 ms' % (rtt, rtt, rtt),
+            '']) + '\n'
+
+
+class ScriptedFactory(fake_mserver.FakeControlFactory):
+    # answers the i-th request after delays[i] seconds (the last delay for
+    # any after that), never answers the addresses in hang, and records the
+    # order it answered in
+    def __init__(self, opts, delays, hang=()):
+        fake_mserver.FakeControlFactory.__init__(self, opts, random.Random(0))
+        self.delays = delays
+        self.hang = hang
+        self.answered = []
+
+    def reply(self, ip):
+        if ip in self.hang:
+            return None
+        delay = self.delays[min(self.requests - 1, len(self.delays) - 1)]
+        reactor.callLater(delay, self.answered.append, ip)
+        return delay, ping_output(ip)
+
+
+class MserverProberTest(unittest.TestCase):
+    def listen(self, pipeline, delays, hang=()):
+        argp = argparse.ArgumentParser()
+        fake_mserver.add_arguments(argp)
+        opts = argp.parse_args(['--pipeline'] if pipeline else [])
+        self.factory = ScriptedFactory(opts, delays, hang)
+        self.port = reactor.listenTCP(0, self.factory, interface='127.0.0.1')
+        return self.port.getHost().port
+
+    def prober(self, port, **kwargs):
+        return MserverProber(address=lambda fqdn: ('127.0.0.1', port),
+                             **kwargs)
+
+    @defer.inlineCallbacks
+    def tearDown(self):
+        # let both ends of every connection close before the reactor is
+        # checked for leftovers
+        for i in xrange(200):
+            if not self.factory.connections:
+                break
+            yield task.deferLater(reactor, 0.01, lambda: None)
+        for conn in list(self.factory.connections):
+            conn.transport.abortConnection()
+        yield self.port.stopListening()
+        yield task.deferLater(reactor, 0.05, lambda: None)
+
+    def check_results(self, requests, results, missing=()):
+        self.assertEqual([(fqdn, ip) for fqdn, ip, ping_out in results],
+                         requests)
+        for fqdn, ip, ping_out in results:
+            if ip in missing:
+                self.assertEqual(ping_out, {})
+            else:
+                rtt = float(ip.split('.')[-1])
+                self.assertEqual(ping_out['rtt_avg'], rtt)
+                self.assertEqual(ping_out['rtt_min'], rtt)
+                self.assertEqual(ping_out['count_recv'], 5)
+
+    @defer.inlineCallbacks
+    def test_pipelined_out_of_order(self):
+        # one connection, later requests answered first
+        n = 8
+        port = self.listen(True, [0.05 * (n - i) for i in xrange(n)])
+        prober = self.prober(port, per_server=n, connections_per_server=1)
+        requests = [(FQDN, '10.0.0.%d' % (i + 1)) for i in xrange(n)]
+        results = yield prober.run(requests)
+        self.check_results(requests, results)
+        self.assertEqual(self.factory.answered,
+                         list(reversed([ip for fqdn, ip in requests])))
+        self.assertEqual(prober.connects(), 1)
+        self.assertEqual(prober.unpipelined(), [])
+        self.assertEqual(prober.counts['ok'], n)
+
+    @defer.inlineCallbacks
+    def test_fallback_without_pipelining(self):
+        # the server answers one request per connection and hangs up; the
+        # requests left on the two pipelined connections are retried on
+        # connections of their own
+        n = 10
+        port = self.listen(False, [0.01])
+        prober = self.prober(port, per_server=6, connections_per_server=2)
+        requests = [(FQDN, '10.0.1.%d' % (i + 1)) for i in xrange(n)]
+        results = yield prober.run(requests)
+        self.check_results(requests, results)
+        self.assertEqual(prober.unpipelined(), [FQDN])
+        self.assertEqual(prober.connects(), n)
+        self.assertEqual(prober.counts['ok'], n)
+        self.assertEqual(prober.counts['failed'], 0)
+
+    @defer.inlineCallbacks
+    def test_timeout_pipelined(self):
+        # a hung request times out and its connection takes no more
+        # requests: the rest go down a new one
+        port = self.listen(True, [0.01], hang=['10.0.2.1'])
+        prober = self.prober(port, per_server=1, connections_per_server=1,
+                             request_timeout=0.3)
+        requests = [(FQDN, '10.0.2.%d' % (i + 1)) for i in xrange(4)]
+        results = yield prober.run(requests)
+        self.check_results(requests, results, missing=['10.0.2.1'])
+        self.assertEqual(prober.counts['timeout'], 1)
+        self.assertEqual(prober.counts['ok'], 3)
+        self.assertEqual(prober.counts['failed'], 0)
+        self.assertEqual(prober.unpipelined(), [])
+        self.assertEqual(prober.connects(), 2)
+
+    @defer.inlineCallbacks
+    def test_timeout_connection_per_request(self):
+        port = self.listen(False, [0.01], hang=['10.0.3.1'])
+        prober = self.prober(port, per_server=4, connections_per_server=0,
+                             request_timeout=0.5)
+        requests = [(FQDN, '10.0.3.%d' % (i + 1)) for i in xrange(4)]
+        results = yield prober.run(requests)
+        self.check_results(requests, results, missing=['10.0.3.1'])
+        self.assertEqual(prober.counts['timeout'], 1)
+        self.assertEqual(prober.counts['ok'], 3)
+        self.assertEqual(prober.connects(), 4)
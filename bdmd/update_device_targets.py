@@ -1,17 +1,30 @@
 #!/usr/bin/env python
 
+import argparse
 import datetime
+import itertools
+import multiprocessing
 import os
 import sys
 import re
+import time
+from cStringIO import StringIO
 
 import psycopg2
 
+from mserver_directory import MserverDatabase, open_directory, snapshot_path
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                '..', 'scripts'))
+from quantile_sketch import QuantileSketch
+
 UPDATE_FREQUENCY = datetime.timedelta(days=30)
 OLD_DEVICE_THRESHOLD = datetime.timedelta(days=30)
 FRESHNESS_THRESHOLD = datetime.timedelta(days=30)
 MLAB_GROUP_PREFERENCES = [30, 20, 10]
 MLAB_ONLY = True
+BATCH_SIZE = 1000  # devices per set-based RTT query
+RTT_SUMMARY = True  # rank from mserver_rtt_daily where the data DB has it
+RTT_SUMMARY_TABLE = 'mserver_rtt_daily'
 GLOBAL_UTCNOW = datetime.datetime.utcnow()
 
 REQ_ENV_VARS = ['VAR_DIR',
@@ -31,101 +44,16 @@ OPT_ENV_VARS = [('BDM_PG_PORT', 5432),
                 ('BDMD_TCP_KEEPCNT', 2),
                 ('BDMD_TCP_KEEPINTVL', 10),
                 ('BDMD_DEBUG', 0),
+                ('BDMD_MSERVER_SNAPSHOT', None),
                 ]
 LOG_SUBDIR = 'log/devices'
+PHASES = ['directory', 'candidates', 'rtt fetch', 'ranking', 'apply']
 
+# seconds spent in each of PHASES; workers send theirs back with each chunk
+phase_times = {}
 
-# class MserverDatabase
-#
-# The purpose of this class is to provide a DNS-like interface, along with a
-# notion of history (lookups in the past) for measurement server IP addressses
-# and fully-qualified domain names (FQDNs). This is necessary because
-# measurements sources/destinations are stored as IP addresses, while
-# measurement servers are caonically referred to by name (though their IP
-# address could theoretically change).
-class MserverDatabase(object):
-    def __init__(self, dbconn, start_date):
-        self.fqdns_by_ip = {}
-        self.ips_by_fqdn = {}
-        self.id_by_fqdn = {}
-        self.fqdn_by_id = {}
-        self.fqdn_list = []
-        self.fqdns_by_mlab_group = {}  # group eg. atl01, syd02, etc.
-
-        cur = dbconn.cursor()
-        cur.execute((
-                "SELECT ti.target_id, t.fqdn, ti.ip, ti.date_effective "
-                "FROM targets as t, target_ips as ti, ( "
-                "    SELECT t.target_id, min(t.min) as min_date "
-                "    FROM (( "
-                "            SELECT target_id, min(date_effective) "
-                "            FROM target_ips "
-                "            WHERE date_effective >= %s "
-                "            GROUP BY target_id "
-                "        ) UNION ( "
-                "            SELECT target_id, max(date_effective) "
-                "            FROM target_ips "
-                "            WHERE date_effective < %s "
-                "            GROUP BY target_id "
-                "    )) as t "
-                "    GROUP BY target_id "
-                ") as tmp "
-                "WHERE ti.target_id = tmp.target_id "
-                "AND t.id = ti.target_id "
-                "AND ti.date_effective >= tmp.min_date "
-                "ORDER BY target_id, date_effective; "),
-                [start_date.isoformat()]*2)
-        for row in cur.fetchall():
-            self.fqdns_by_ip.setdefault(row[2], []).append({
-                    'fqdn': row[1],
-                    'date_effective': row[3]})
-            self.ips_by_fqdn.setdefault(row[1], []).append({
-                    'ip': row[2],
-                    'date_effective': row[3]})
-            self.id_by_fqdn[row[1]] = row[0]
-            self.fqdn_by_id[row[0]] = row[1]
-        for k in self.fqdns_by_ip:
-            self.fqdns_by_ip[k].sort(
-                    key=lambda x: x['date_effective'], reverse=True)
-        for k in self.ips_by_fqdn:
-            self.ips_by_fqdn[k].sort(
-                    key=lambda x: x['date_effective'], reverse=True)
-
-        cur.execute("SELECT fqdn FROM targets")
-        self.fqdn_list = [x[0] for x in cur.fetchall()]
-        self.fqdn_list.sort()
-
-        for fqdn in self.fqdn_list:
-            parts = fqdn.split('.')
-            if parts[-3]+'.'+parts[-2] == 'measurement-lab.org':
-                self.fqdns_by_mlab_group.setdefault(parts[-4], []).append(fqdn)
-
-    def lookup_ptr(self, ip, date_effective=None):
-        if not date_effective:
-            date_effective = GLOBAL_UTCNOW
-        try:
-            fqdn_list = self.fqdns_by_ip[ip]
-            for f in fqdn_list:
-                if f['date_effective'] < date_effective:
-                    return f['fqdn']
-            return None
-        except KeyError:
-            return None
-
-    def lookup_a(self, fqdn, date_effective=None):
-        if not date_effective:
-            date_effective = GLOBAL_UTCNOW
-        try:
-            ip_list = self.ips_by_fqdn[fqdn]
-            for i in ip_list:
-                if i['date_effective'] < date_effective:
-                    return i['ip']
-            return None
-        except KeyError:
-            return None
-
-    def lookup_id(self, fqdn):
-        return self.id_by_fqdn.get(fqdn, None)
+def add_phase_time(phase, start):
+    phase_times[phase] = phase_times.get(phase, 0.0) + time.time() - start
 
 
 class SelectedTarget(object):
@@ -173,13 +101,16 @@ def select_device_targets(data_dbconn, device_id, mserver_db):
     dcur = data_dbconn.cursor()
     device_targets = []
     rtt_data = None
+    start = time.time()
     dcur.execute((
             "SELECT dstip, eventstamp, "
             "   average, median, minimum, maximum, std "
             "FROM m_mserver_rtt "
             "WHERE deviceid = %s "
-            "AND eventstamp > %s "),
-            [device_id[2:], (GLOBAL_UTCNOW - FRESHNESS_THRESHOLD)])
+            "AND eventstamp > %s "
+            "AND eventstamp <= %s "),
+            [device_id[2:], (GLOBAL_UTCNOW - FRESHNESS_THRESHOLD),
+             GLOBAL_UTCNOW])
 
     if dcur.rowcount and dcur.rowcount > 0:
         # device has fresh mserver_rtt data
@@ -191,13 +122,17 @@ def select_device_targets(data_dbconn, device_id, mserver_db):
                 "   average, median, minimum, maximum, std "
                 "FROM m_mserver_rping "
                 "WHERE deviceid = %s "
-                "AND eventstamp > %s "),
-                [device_id[2:], (GLOBAL_UTCNOW - FRESHNESS_THRESHOLD)])
+                "AND eventstamp > %s "
+                "AND eventstamp <= %s "),
+                [device_id[2:], (GLOBAL_UTCNOW - FRESHNESS_THRESHOLD),
+                 GLOBAL_UTCNOW])
         if dcur.rowcount and dcur.rowcount > 0:
             rtt_data = dcur.fetchall()
     else:
         print_error("ERROR: couldn't get db rowcount")
+    add_phase_time('rtt fetch', start)
 
+    start = time.time()
     if rtt_data:
         ordered_targets = select_targets_by_rtt(rtt_data, mserver_db)
         if ordered_targets:
@@ -206,19 +141,144 @@ def select_device_targets(data_dbconn, device_id, mserver_db):
                         ordered_targets, mserver_db)
     else:
         print_error("ERROR: device '%s' has no RTT data." % device_id)
+    add_phase_time('ranking', start)
 
     return device_targets
 
+def load_mserver_fqdns(data_dbconn, mserver_db):
+    # The IP -> FQDN history that lookup_ptr uses, as a temp table in the
+    # data DB, in epochs as MserverDatabase keeps it.
+    rows = list(mserver_db.ptr_history())
+    dcur = data_dbconn.cursor()
+    dcur.execute((
+            "CREATE TEMP TABLE mserver_fqdns ( "
+            "   ip inet, fqdn text, "
+            "   since double precision, until double precision );"))
+    if rows:
+        dcur.execute("INSERT INTO mserver_fqdns VALUES %s;" % ','.join(
+                [dcur.mogrify("(%s, %s, %s, %s)", r) for r in rows]))
+
+def fetch_median_min_rtts(data_dbconn, table, device_ids):
+    # For each device with fresh rows in table, the median of the minimum RTT
+    # to each mserver, as select_targets_by_rtt computes it (the lower median,
+    # i.e. percentile_disc). Returns {deviceid: [(fqdn, latency), ...]},
+    # keyed by the data DB's deviceid (the device id without its OW prefix).
+    dcur = data_dbconn.cursor()
+    dcur.execute((
+            "SELECT m.deviceid, f.fqdn, "
+            "   percentile_disc(0.5) WITHIN GROUP (ORDER BY m.minimum) "
+            "FROM %s AS m "
+            "LEFT JOIN mserver_fqdns AS f ON m.dstip = f.ip "
+            "   AND extract(epoch FROM m.eventstamp) > f.since "
+            "   AND (f.until IS NULL OR extract(epoch FROM m.eventstamp) <= f.until) "
+            "WHERE m.deviceid = ANY(%%s) "
+            "AND m.eventstamp > %%s "
+            "AND m.eventstamp <= %%s "
+            "GROUP BY m.deviceid, f.fqdn "
+            "ORDER BY m.deviceid, f.fqdn;") % table,
+            [list(device_ids), (GLOBAL_UTCNOW - FRESHNESS_THRESHOLD),
+             GLOBAL_UTCNOW])
+    medians = {}
+    for deviceid, fqdn, latency in dcur.fetchall():
+        # devices with rows, even for unknown IPs, don't fall back to rping
+        latencies = medians.setdefault(deviceid, [])
+        if fqdn is not None:
+            latencies.append((fqdn, latency))
+    return medians
+
+def has_rtt_summary(data_dbconn):
+    dcur = data_dbconn.cursor()
+    dcur.execute(("SELECT 1 FROM information_schema.tables "
+                  "WHERE table_schema = current_schema() "
+                  "AND table_name = %s;"), [RTT_SUMMARY_TABLE])
+    return dcur.rowcount > 0
+
+def fetch_summary_min_rtts(data_dbconn, source, device_ids):
+    # fetch_median_min_rtts from the per-day summary that ingest maintains
+    # (db/maintenance/create_mserver_rtt_daily.sql): the median comes from
+    # merging the quantile sketches of a few days per device and server
+    # instead of every sample, to within the sketch's relative accuracy.
+    # Freshness is counted in whole days, up to and including the day of
+    # GLOBAL_UTCNOW, and a day's samples are attributed to the server its
+    # address belonged to at the day's last sample.
+    dcur = data_dbconn.cursor()
+    dcur.execute((
+            "SELECT s.deviceid, f.fqdn, s.sketch_keys, s.sketch_counts "
+            "FROM %s AS s "
+            "LEFT JOIN mserver_fqdns AS f ON s.dstip = f.ip "
+            "   AND extract(epoch FROM s.last_eventstamp) > f.since "
+            "   AND (f.until IS NULL "
+            "        OR extract(epoch FROM s.last_eventstamp) <= f.until) "
+            "WHERE s.source = %%s "
+            "AND s.deviceid = ANY(%%s) "
+            "AND s.day >= %%s "
+            "AND s.day <= %%s "
+            "AND s.sketch_keys IS NOT NULL;") % RTT_SUMMARY_TABLE,
+            [source, list(device_ids),
+             (GLOBAL_UTCNOW - FRESHNESS_THRESHOLD).date(),
+             GLOBAL_UTCNOW.date()])
+    sketches = {}
+    for deviceid, fqdn, keys, counts in dcur.fetchall():
+        day = QuantileSketch.from_buckets(keys, counts)
+        # devices with rows, even for unknown IPs, don't fall back to rping
+        by_fqdn = sketches.setdefault(deviceid, {})
+        if fqdn is not None:
+            if fqdn in by_fqdn:
+                by_fqdn[fqdn].merge(day)
+            else:
+                by_fqdn[fqdn] = day
+    medians = {}
+    for deviceid, by_fqdn in sketches.iteritems():
+        medians[deviceid] = [(fqdn, sketch.quantile(0.5))
+                             for fqdn, sketch in sorted(by_fqdn.iteritems())]
+    return medians
+
+def select_targets_batch(data_dbconn, device_ids, mserver_db):
+    # select_device_targets for many devices at once, with one query per
+    # table instead of up to two per device
+    device_targets = {}
+    if RTT_SUMMARY and has_rtt_summary(data_dbconn):
+        fetch_rtt = lambda ids: fetch_summary_min_rtts(data_dbconn, 'rtt', ids)
+        fetch_rping = lambda ids: fetch_summary_min_rtts(
+                data_dbconn, 'rping', ids)
+    else:
+        fetch_rtt = lambda ids: fetch_median_min_rtts(
+                data_dbconn, 'm_mserver_rtt', ids)
+        fetch_rping = lambda ids: fetch_median_min_rtts(
+                data_dbconn, 'm_mserver_rping', ids)
+    for i in xrange(0, len(device_ids), BATCH_SIZE):
+        start = time.time()
+        batch = [d[2:] for d in device_ids[i:i+BATCH_SIZE]]
+        medians = fetch_rtt(batch)
+        no_rtt = [d for d in batch if d not in medians]
+        if no_rtt:
+            medians.update(fetch_rping(no_rtt))
+        add_phase_time('rtt fetch', start)
+        start = time.time()
+        for device_id in device_ids[i:i+BATCH_SIZE]:
+            ordered_targets = medians.get(device_id[2:])
+            if not ordered_targets:
+                print_error("ERROR: device '%s' has no RTT data." % device_id)
+                continue
+            ordered_targets.sort(key=lambda x: x[1])
+            if MLAB_ONLY:
+                device_targets[device_id] = select_mlab_targets_by_group(
+                        ordered_targets, mserver_db)
+        add_phase_time('ranking', start)
+    return device_targets
+
 def select_targets_by_rtt(rtt_resultset, mserver_db):
+    # the median minimum RTT to each fqdn, from a quantile sketch per fqdn
+    # rather than a sorted list of every sample
     min_latency = {}
-    for row in rtt_resultset:
-        fqdn = mserver_db.lookup_ptr(row[0], row[1])
-        min_latency.setdefault(fqdn, []).append(row[4])
+    fqdns = mserver_db.lookup_ptrs([(row[0], row[1]) for row in rtt_resultset])
+    for fqdn, row in zip(fqdns, rtt_resultset):
+        sketch = min_latency.setdefault(fqdn, QuantileSketch())
+        if row[4] is not None:
+            sketch.add(row[4])
     median_minlatencies = []
     for fqdn in min_latency:
-        min_latency[fqdn].sort()
-        quick_median = min_latency[fqdn][(len(min_latency[fqdn])+1)/2-1]
-        median_minlatencies.append((fqdn, quick_median))
+        median_minlatencies.append((fqdn, min_latency[fqdn].quantile(0.5)))
     median_minlatencies.sort(key=lambda x: x[1])
     return median_minlatencies
 
@@ -244,59 +304,274 @@ def select_mlab_targets_by_group(ordered_targets, mserver_db):
                     MLAB_GROUP_PREFERENCES[i]))
     return ranked_targets
 
-def apply_device_targets(mgmt_dbconn, device_id, ranked_targets, mserver_db):
-    if ranked_targets:
-        cur = mgmt_dbconn.cursor()
+# Rankings are applied in bulk: they are COPYed into a staging table and
+# swapped in with one UPDATE (disabling the devices' current non-permanent
+# targets) and one INSERT, in a single transaction, so bdmd never sees a
+# partly retargeted fleet. With a chunk size, each chunk of that many devices
+# is its own transaction instead.
+def stage_device_targets(cur, ranked, mserver_db):
+    # ranked is a list of (device_id, [SelectedTarget, ...])
+    cur.execute("TRUNCATE staged_device_targets;")
+    buf = StringIO()
+    for device_id, ranked_targets in ranked:
+        for t in ranked_targets:
+            target_id = mserver_db.lookup_id(t.fqdn)
+            if target_id is None:
+                # device_targets.target_id can't be NULL; one such row would
+                # abort the whole transaction
+                print_error("ERROR: no target id for '%s', not assigning it "
+                            "to %s." % (t.fqdn, device_id))
+                continue
+            buf.write("%s\t%d\t%d\n" % (device_id, target_id, t.pref))
+    buf.seek(0)
+    cur.copy_from(buf, 'staged_device_targets',
+                  columns=('device_id', 'target_id', 'preference'))
+
+def count_changed_devices(cur):
+    # staged devices whose enabled (target, preference) set is different
+    cur.execute((
+            "WITH current AS ( "
+            "   SELECT dt.device_id, dt.target_id, dt.preference "
+            "   FROM device_targets AS dt "
+            "   WHERE dt.is_enabled = TRUE "
+            "   AND dt.is_permanent = FALSE "
+            "   AND dt.device_id IN ( "
+            "       SELECT device_id FROM staged_device_targets) "
+            ") "
+            "SELECT count(DISTINCT device_id) FROM (( "
+            "   SELECT * FROM staged_device_targets EXCEPT SELECT * FROM current "
+            ") UNION ALL ( "
+            "   SELECT * FROM current EXCEPT SELECT * FROM staged_device_targets "
+            ")) AS diff;"))
+    return cur.fetchone()[0]
+
+def apply_device_targets(mgmt_dbconn, ranked, mserver_db, chunk_size=0):
+    # returns the number of devices whose targets changed
+    cur = mgmt_dbconn.cursor()
+    cur.execute((
+            "CREATE TEMP TABLE IF NOT EXISTS staged_device_targets ( "
+            "   device_id text, target_id integer, preference integer);"))
+    changed = 0
+    step = chunk_size or len(ranked) or 1
+    for i in xrange(0, len(ranked), step):
+        stage_device_targets(cur, ranked[i:i+step], mserver_db)
+        changed += count_changed_devices(cur)
         cur.execute((
                 "UPDATE device_targets "
                 "SET is_enabled = FALSE "
                 "WHERE is_enabled = TRUE "
                 "AND is_permanent = FALSE "
-                "AND device_id = %s;"),
-                [device_id])
-        target_tuples = [
-                (device_id, mserver_db.lookup_id(t.fqdn), t.pref,
-                GLOBAL_UTCNOW) for t in ranked_targets]
-        cur.executemany((
+                "AND device_id IN ( "
+                "   SELECT device_id FROM staged_device_targets);"))
+        cur.execute((
                 "INSERT INTO device_targets "
                 "(device_id, target_id, preference, date_effective, "
                 "is_enabled, is_permanent) "
-                "VALUES (%s, %s, %s, %s, TRUE, FALSE);"),
-                target_tuples)
+                "SELECT device_id, target_id, preference, %s, TRUE, FALSE "
+                "FROM staged_device_targets;"),
+                [GLOBAL_UTCNOW])
         mgmt_dbconn.commit()
+    return changed
 
-def main(config):
-    mconn = psycopg2.connect(
-            host=config['BDM_PG_HOST'],
-            port=int(config['BDM_PG_PORT']),
-            database=config['BDM_PG_MGMT_DBNAME'],
-            user=config['BDM_PG_USER'],
-            password=config['BDM_PG_PASSWORD'],
-            )
-    dconn = psycopg2.connect(
+def preview_device_targets(mgmt_dbconn, ranked, mserver_db):
+    # what apply_device_targets would change, printed instead of applied;
+    # returns the number of devices whose targets would change
+    cur = mgmt_dbconn.cursor()
+    cur.execute((
+            "SELECT dt.device_id, dt.target_id, t.fqdn, dt.preference "
+            "FROM device_targets AS dt, targets AS t "
+            "WHERE t.id = dt.target_id "
+            "AND dt.is_enabled = TRUE "
+            "AND dt.is_permanent = FALSE "
+            "AND dt.device_id = ANY(%s);"),
+            [[device_id for device_id, _ in ranked]])
+    current = {}
+    fqdns = {}
+    for device_id, target_id, fqdn, pref in cur.fetchall():
+        current.setdefault(device_id, set()).add((target_id, pref))
+        fqdns[target_id] = fqdn
+    mgmt_dbconn.rollback()
+    changed = 0
+    for device_id, ranked_targets in ranked:
+        proposed = {}
+        for t in ranked_targets:
+            target_id = mserver_db.lookup_id(t.fqdn)
+            if target_id is None:
+                continue  # skipped when applying, see stage_device_targets
+            proposed[(target_id, t.pref)] = t.fqdn
+            fqdns.setdefault(target_id, t.fqdn)
+        old = current.get(device_id, set())
+        if old == set(proposed):
+            continue
+        changed += 1
+        print("Would retarget %s:" % device_id)
+        for target_id, pref in sorted(old - set(proposed), key=lambda x: -x[1]):
+            print("    - %s (pref %d)" % (fqdns[target_id], pref))
+        for target_id, pref in sorted(set(proposed) - old, key=lambda x: -x[1]):
+            print("    + %s (pref %d)" % (proposed[(target_id, pref)], pref))
+    return changed
+
+def print_phase_times(jobs):
+    # with several jobs, rtt fetch and ranking are summed over the workers
+    total = sum(phase_times.values())
+    print("Phase timings%s:" % (
+            " (rtt fetch and ranking summed over %d workers)" % jobs
+            if jobs > 1 else ""))
+    for phase in PHASES:
+        secs = phase_times.get(phase, 0.0)
+        print("    %-12s %9.3fs %5.1f%%" % (
+                phase, secs, 100.0 * secs / total if total > 0 else 0.0))
+
+def parse_now(val):
+    for fmt in ('%Y-%m-%dT%H:%M:%S', '%Y-%m-%d'):
+        try:
+            return datetime.datetime.strptime(val, fmt)
+        except ValueError:
+            pass
+    raise argparse.ArgumentTypeError("invalid time '%s'" % val)
+
+def connect(config, dbname_var):
+    return psycopg2.connect(
             host=config['BDM_PG_HOST'],
             port=int(config['BDM_PG_PORT']),
-            database=config['BDM_PG_DATA_DBNAME'],
+            database=config[dbname_var],
             user=config['BDM_PG_USER'],
             password=config['BDM_PG_PASSWORD'],
             )
 
+def compute_targets(data_dbconn, device_ids, mserver_db, per_device):
+    if per_device:
+        return dict((device_id, select_device_targets(
+                        data_dbconn, device_id, mserver_db))
+                    for device_id in device_ids)
+    return select_targets_batch(data_dbconn, device_ids, mserver_db)
+
+# Parallel mode: each worker process opens its own data DB connection and
+# computes rankings for one chunk of candidates at a time. Errors a worker
+# would print are sent back with the chunk, so that the parent prints
+# everything in candidate order, as the serial mode does.
+worker_state = None
+
+def init_worker(config, mserver_db, per_device):
+    global worker_state
+    dconn = connect(config, 'BDM_PG_DATA_DBNAME')
+    if not per_device:
+        load_mserver_fqdns(dconn, mserver_db)
+    worker_state = (dconn, mserver_db, per_device)
+
+def compute_chunk(device_ids):
+    dconn, mserver_db, per_device = worker_state
+    stderr = sys.stderr
+    sys.stderr = StringIO()
+    phase_times.clear()
+    try:
+        targets = compute_targets(dconn, device_ids, mserver_db, per_device)
+        return targets, sys.stderr.getvalue(), dict(phase_times)
+    finally:
+        sys.stderr = stderr
+        dconn.rollback()  # don't sit idle in a transaction between chunks
+
+def iter_device_targets(config, device_ids, mserver_db, per_device, jobs):
+    # yields consecutive runs of device_ids, in order, with the ranked targets
+    # of those that got any as {device_id: targets}
+    if jobs <= 1:
+        start = time.time()
+        dconn = connect(config, 'BDM_PG_DATA_DBNAME')
+        if not per_device:
+            load_mserver_fqdns(dconn, mserver_db)
+        add_phase_time('rtt fetch', start)
+        yield device_ids, compute_targets(
+                dconn, device_ids, mserver_db, per_device)
+        dconn.close()
+        return
+    # several chunks per worker, so one slow chunk doesn't hold up the rest
+    size = max(1, min(BATCH_SIZE, len(device_ids) / (jobs * 4)))
+    chunks = [device_ids[i:i+size] for i in xrange(0, len(device_ids), size)]
+    pool = multiprocessing.Pool(jobs, init_worker,
+                                (config, mserver_db, per_device))
+    try:
+        # imap hands results back in chunk order
+        results = pool.imap(compute_chunk, chunks)
+        for chunk, (targets, errors, times) in itertools.izip(chunks,
+                                                              results):
+            sys.stderr.write(errors)
+            for phase, secs in times.iteritems():
+                phase_times[phase] = phase_times.get(phase, 0.0) + secs
+            yield chunk, targets
+        pool.close()
+    finally:
+        pool.terminate()
+        pool.join()
+
+def main(config, per_device=False, jobs=1, chunk_size=0, dry_run=False):
+    mconn = connect(config, 'BDM_PG_MGMT_DBNAME')
+
+    start = time.time()
     mdb = MserverDatabase(
-            mconn,
-            start_date=(GLOBAL_UTCNOW - FRESHNESS_THRESHOLD))
-    print("----- %s -----" % GLOBAL_UTCNOW.isoformat())
+            open_directory(mconn, snapshot_path(config)),
+            start_date=(GLOBAL_UTCNOW - FRESHNESS_THRESHOLD),
+            now=GLOBAL_UTCNOW)
+    add_phase_time('directory', start)
+    print("----- %s%s -----" % (GLOBAL_UTCNOW.isoformat(),
+                                " (dry run)" if dry_run else ""))
+    start = time.time()
     update_candidates = find_update_candidates(mconn)
-    for device_id, _ in update_candidates:
-        device_targets = select_device_targets(dconn, device_id, mdb)
-        if device_targets:
-            for target in device_targets:
-                print("Targeting %s => %s (pref %d, latency %s)" %
-                        (device_id, target.fqdn, target.pref,
-                        str(target.latency)))
-            apply_device_targets(mconn, device_id, device_targets, mdb)
+    add_phase_time('candidates', start)
+    device_ids = [d for d, _ in update_candidates]
+    ranked = []
+    for chunk, targets_by_device in iter_device_targets(
+            config, device_ids, mdb, per_device, jobs):
+        for device_id in chunk:
+            device_targets = targets_by_device.get(device_id)
+            if device_targets:
+                for target in device_targets:
+                    print("Targeting %s => %s (pref %d, latency %s)" %
+                            (device_id, target.fqdn, target.pref,
+                            str(target.latency)))
+                ranked.append((device_id, device_targets))
+    # only this process writes to the management DB
+    start = time.time()
+    if dry_run:
+        changed = preview_device_targets(mconn, ranked, mdb)
+    else:
+        changed = apply_device_targets(mconn, ranked, mdb, chunk_size)
+    add_phase_time('apply', start)
+    print("%s %d of %d candidate devices: %d changed, %d unchanged" %
+            ("Would retarget" if dry_run else "Retargeted", len(ranked),
+             len(device_ids), changed, len(ranked) - changed))
+    print_phase_times(jobs)
 
 
 if __name__ == '__main__':
+    argp = argparse.ArgumentParser(
+            description='Retarget devices to their nearest mservers')
+    argp.add_argument('--per-device', action='store_true',
+                      help='query RTTs one device at a time (the old way)')
+    argp.add_argument('-j', '--jobs', type=int, default=1,
+                      help=('worker processes computing rankings, each with '
+                            'its own data DB connection (default: 1)'))
+    argp.add_argument('--chunk-size', type=int, default=0,
+                      help=('apply the new targets this many devices per '
+                            'transaction (default: all in one)'))
+    argp.add_argument('--raw-rtts', action='store_true',
+                      help=('rank from the raw RTT tables even if the data DB '
+                            'has the %s summary' % RTT_SUMMARY_TABLE))
+    argp.add_argument('--dry-run', action='store_true',
+                      help=('print how the targets would change instead of '
+                            'changing them'))
+    argp.add_argument('--now', type=parse_now,
+                      help=('with --dry-run, run as of this UTC time, '
+                            'YYYY-MM-DD[THH:MM:SS] (default: the current '
+                            'time)'))
+    args = argp.parse_args()
+    if args.now and not args.dry_run:
+        # applying would write backdated date_effective rows
+        argp.error("--now is only allowed with --dry-run")
+    if args.raw_rtts:
+        RTT_SUMMARY = False
+    if args.now:
+        GLOBAL_UTCNOW = args.now
+
     config = {}
     for evname in REQ_ENV_VARS:
         try:
@@ -308,4 +583,5 @@ if __name__ == '__main__':
     for (evname, default_val) in OPT_ENV_VARS:
         config[evname] = os.environ.get(evname) or default_val
 
-    main(config)
+    main(config, per_device=args.per_device, jobs=args.jobs,
+         chunk_size=args.chunk_size, dry_run=args.dry_run)
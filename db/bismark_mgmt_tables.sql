@@ -26,6 +26,17 @@ CREATE TABLE devices_log (
 CREATE TRIGGER log_probe AFTER UPDATE on devices FOR EACH ROW
     EXECUTE PROCEDURE log_probe();
 
+-- closed check-in sessions, written by bdmd as they end
+CREATE TABLE device_sessions (
+    device_id       id_t            NOT NULL,
+    bversion        version_t       NOT NULL,
+    ip              ip_t            NOT NULL,
+    date_start      timestamp       NOT NULL,
+    date_end        timestamp       NOT NULL
+);
+CREATE INDEX device_sessions_device_start_idx
+    ON device_sessions (device_id, date_start);
+
 CREATE TABLE tunnels (
     device_id       id_t            NOT NULL REFERENCES devices (id),
     port            integer         NOT NULL,
@@ -0,0 +1,13 @@
+-- Adds the device_sessions table written by bdmd to an existing management
+-- database. Sessions are only recorded from the time bdmd is restarted.
+BEGIN;
+CREATE TABLE device_sessions (
+    device_id       id_t            NOT NULL,
+    bversion        version_t       NOT NULL,
+    ip              ip_t            NOT NULL,
+    date_start      timestamp       NOT NULL,
+    date_end        timestamp       NOT NULL
+);
+CREATE INDEX device_sessions_device_start_idx
+    ON device_sessions (device_id, date_start);
+COMMIT;
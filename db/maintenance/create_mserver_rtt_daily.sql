@@ -0,0 +1,143 @@
+-- Adds the mserver_rtt_daily summary to the data database: for each device,
+-- measurement server address and day, how many RTT samples there were,
+-- percentiles of their minimum RTT and a quantile sketch of it (see
+-- scripts/quantile_sketch.py) that merges across days. source is 'rtt' for
+-- m_mserver_rtt (device to mserver) and 'rping' for m_mserver_rping (mserver
+-- to device).
+--
+-- The parser refreshes the (device, day) pairs of every batch it loads (see
+-- pgsql.copy_rows); run "rtt_summary.py rebuild" once afterwards to fill in
+-- the days loaded before this table existed. Rerunning this file on a
+-- database that has the table without sketches adds them; rebuild then fills
+-- them in.
+--
+-- Days are UTC days whatever the session TimeZone, as update_device_targets
+-- compares them with the UTC date.
+BEGIN;
+CREATE TABLE IF NOT EXISTS mserver_rtt_daily (
+    source          text            NOT NULL,
+    deviceid        text            NOT NULL,
+    dstip           inet            NOT NULL,
+    day             date            NOT NULL,
+    samples         integer         NOT NULL,
+    min_rtt         double precision,
+    p10_rtt         double precision,
+    p50_rtt         double precision,
+    p90_rtt         double precision,
+    last_eventstamp timestamp with time zone NOT NULL,
+    PRIMARY KEY (source, deviceid, day, dstip)
+);
+ALTER TABLE mserver_rtt_daily
+    ADD COLUMN IF NOT EXISTS sketch_keys integer[],
+    ADD COLUMN IF NOT EXISTS sketch_counts integer[];
+
+-- The sketch bucket of a minimum RTT: quantile_sketch.QuantileSketch.key()
+-- with RELATIVE_ACCURACY 0.01 and MIN_VALUE 1e-3.
+CREATE OR REPLACE FUNCTION rtt_sketch_key(x double precision)
+RETURNS integer AS
+$rtt_sketch_key$
+	SELECT ceil(ln(greatest(x, 1e-3)) / ln(1.01 / 0.99))::integer;
+$rtt_sketch_key$
+LANGUAGE sql IMMUTABLE;
+
+-- Inserts the summary rows of the m_mserver_<src> rows that from_where
+-- selects (as "m", with $2 and $3 bound to first_day and last_day).
+CREATE OR REPLACE FUNCTION insert_mserver_rtt_daily(
+        src text, from_where text, first_day date, last_day date)
+RETURNS integer AS
+$insert_mserver_rtt_daily$
+	DECLARE
+		n integer;
+	BEGIN
+		EXECUTE format(
+			'INSERT INTO mserver_rtt_daily '
+			|| ' SELECT a.*, s.sketch_keys, s.sketch_counts '
+			|| ' FROM ( '
+			|| '   SELECT $1, m.deviceid, m.dstip::inet AS dstip, '
+			|| '     (m.eventstamp AT TIME ZONE ''UTC'')::date AS day, '
+			|| '     count(*), min(m.minimum), '
+			|| '     percentile_disc(0.1) WITHIN GROUP (ORDER BY m.minimum), '
+			|| '     percentile_disc(0.5) WITHIN GROUP (ORDER BY m.minimum), '
+			|| '     percentile_disc(0.9) WITHIN GROUP (ORDER BY m.minimum), '
+			|| '     max(m.eventstamp) '
+			|| '   FROM %1$I AS m %2$s '
+			|| '   GROUP BY m.deviceid, m.dstip, '
+			|| '     (m.eventstamp AT TIME ZONE ''UTC'')::date '
+			|| ' ) AS a JOIN ( '
+			|| '   SELECT b.deviceid, b.dstip, b.day, '
+			|| '     array_agg(b.key ORDER BY b.key) AS sketch_keys, '
+			|| '     array_agg(b.n ORDER BY b.key) AS sketch_counts '
+			|| '   FROM ( '
+			|| '     SELECT m.deviceid, m.dstip::inet AS dstip, '
+			|| '       (m.eventstamp AT TIME ZONE ''UTC'')::date AS day, '
+			|| '       rtt_sketch_key(m.minimum) AS key, count(*)::integer AS n '
+			|| '     FROM %1$I AS m %2$s '
+			|| '     GROUP BY 1, 2, 3, 4 '
+			|| '   ) AS b '
+			|| '   GROUP BY 1, 2, 3 '
+			|| ' ) AS s USING (deviceid, dstip, day)',
+			'm_mserver_' || src, from_where)
+			USING src, first_day, last_day;
+		GET DIAGNOSTICS n = ROW_COUNT;
+		RETURN n;
+	END;
+$insert_mserver_rtt_daily$
+LANGUAGE plpgsql;
+
+-- Recomputes the summary rows of the given devices on the days of the given
+-- epochs (devices[i] was measured at epochs[i]). Each (source, device, day)
+-- is locked until the end of the transaction, in a fixed order, so that
+-- loaders refreshing the same day one after the other don't both delete and
+-- then both insert.
+CREATE OR REPLACE FUNCTION refresh_mserver_rtt_daily(
+        src text, devices text[], epochs double precision[])
+RETURNS integer AS
+$refresh_mserver_rtt_daily$
+	BEGIN
+		CREATE TEMP TABLE IF NOT EXISTS rtt_daily_keys (
+			deviceid text, day date) ON COMMIT DELETE ROWS;
+		TRUNCATE rtt_daily_keys;
+		INSERT INTO rtt_daily_keys
+			SELECT DISTINCT k.deviceid,
+				(to_timestamp(k.epoch) AT TIME ZONE 'UTC')::date
+			FROM unnest(devices, epochs) AS k(deviceid, epoch);
+		PERFORM pg_advisory_xact_lock(l.key)
+			FROM (
+				SELECT DISTINCT hashtext(
+					'mserver_rtt_daily/' || src || '/' || k.deviceid || '/' || k.day)
+					AS key
+				FROM rtt_daily_keys AS k
+				ORDER BY 1
+			) AS l;
+		DELETE FROM mserver_rtt_daily AS s
+			USING rtt_daily_keys AS k
+			WHERE s.source = src
+			AND s.deviceid = k.deviceid AND s.day = k.day;
+		RETURN insert_mserver_rtt_daily(src,
+			', rtt_daily_keys AS k '
+			|| 'WHERE m.deviceid = k.deviceid '
+			|| 'AND m.eventstamp >= (k.day::timestamp AT TIME ZONE ''UTC'') '
+			|| 'AND m.eventstamp < ((k.day + 1)::timestamp AT TIME ZONE ''UTC'') '
+			|| 'AND m.minimum IS NOT NULL',
+			NULL, NULL);
+	END;
+$refresh_mserver_rtt_daily$
+LANGUAGE plpgsql;
+
+-- Recomputes the summary rows of every device for days first_day to last_day.
+CREATE OR REPLACE FUNCTION rebuild_mserver_rtt_daily(
+        src text, first_day date, last_day date)
+RETURNS integer AS
+$rebuild_mserver_rtt_daily$
+	BEGIN
+		DELETE FROM mserver_rtt_daily
+			WHERE source = src AND day >= first_day AND day <= last_day;
+		RETURN insert_mserver_rtt_daily(src,
+			'WHERE m.eventstamp >= ($2::timestamp AT TIME ZONE ''UTC'') '
+			|| 'AND m.eventstamp < (($3 + 1)::timestamp AT TIME ZONE ''UTC'') '
+			|| 'AND m.minimum IS NOT NULL',
+			first_day, last_day);
+	END;
+$rebuild_mserver_rtt_daily$
+LANGUAGE plpgsql;
+COMMIT;
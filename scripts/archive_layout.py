@@ -0,0 +1,72 @@
+#!/usr/bin/env python
+#
+# Where files live in the archive tree: DEVICE/TYPE/YEAR/MONTH, with the
+# device and the timestamp taken from the file name and the type from its
+# extension. Shared by organize-archive.py and ingest_uploads.py.
+
+import datetime
+import errno
+import os
+import re
+import shutil
+
+
+TYPES = {'arp.gz':'arp',
+         'csv':'airodump',
+         'csv.gz':'airodump',
+         'events.gz':'events',
+         'filt.csv':'airodump',
+         'xml.gz':'active',
+         'xml.tgz':'active',
+         'tgz':'active'}
+
+
+def filename_to_dir(file):
+
+    # get device name
+    match = re.search(r'[0-9A-Za-z]+',file)
+    if match:
+        dev_name = match.group()
+    else:
+        return ''
+
+    # get date, preferring a standalone number over digits inside the
+    # device id (OW ids can hold ten digits in a row)
+    match = (re.search(r'(?<![0-9A-Za-z])([0-9]{9,10})(?![0-9A-Za-z])',file) or
+             re.search(r'([0-9]{9,10})',file))
+    if match:
+        timestr = match.group(1)
+        date = datetime.date.fromtimestamp(float(timestr))
+        datedir = str(date.year) + '/' + str(date.month)
+    else:
+        return ''
+
+
+    # get type
+    match = re.search(r'.*?[0-9]\.(.*)$',file)
+    if match and match.group(1) in TYPES:
+        typedir = TYPES[match.group(1)]
+    else:
+        return ''
+
+
+    return dev_name + '/' + typedir + '/'+ datedir
+
+
+def archive_path(root, file):
+    # final path of file under root; unrecognised names go in root/unsorted
+    subdir = filename_to_dir(os.path.basename(file)) or 'unsorted'
+    return os.path.join(root, subdir, os.path.basename(file))
+
+
+def move_into(path, dest):
+    # a single rename when source and archive share a filesystem
+    destdir = os.path.dirname(dest)
+    if not os.path.isdir(destdir):
+        os.makedirs(destdir)
+    try:
+        os.rename(path, dest)
+    except OSError as e:
+        if e.errno != errno.EXDEV:
+            raise
+        shutil.move(path, dest)
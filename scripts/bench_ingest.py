@@ -0,0 +1,172 @@
+#!/usr/bin/env python
+# Replays measurement uploads (see gen_measurements.py) through the ingest path
+# and reports where the time goes:
+#
+#   parse   parser.parsefile minus the time spent in the two writers below
+#   db      pgsql.copy_rows, the bulk load into the data DB
+#   trstore trstore.write, traceroute storage
+#
+# along with files/s, rows/s and peak RSS. Point BDM_PG_* at a scratch database;
+# --create-schema creates any missing m_* tables there. With --no-db rows are
+# counted and dropped instead of loaded, and the management DB isn't consulted
+# for mserver addresses either. Traceroutes go to a temporary store
+# unless BDM_TRACEROUTE_DIR is set.
+import os
+import sys
+import time
+import shutil
+import tarfile
+import tempfile
+import resource
+import argparse
+
+import gen_measurements
+
+MEASUREMENT_TABLES = ['rtt','lmrtt','jitter','pktloss','dnsdelaync','dnsfailnc',
+                      'dnsdelayc','dnsfailc','bitrate','aggl3bitrate','ulrttdw',
+                      'ulrttup','capacity','shaperate']
+MEASUREMENT_COLUMNS = '''(
+    deviceid    varchar(20),
+    srcip       inet,
+    dstip       inet,
+    eventstamp  timestamp with time zone,
+    average     double precision,
+    std         double precision,
+    minimum     double precision,
+    maximum     double precision,
+    median      double precision,
+    iqr         double precision,
+    toolid      varchar(20),
+    direction   varchar(2),
+    exitstatus  integer
+)'''
+
+class StageTimer(object):
+  def __init__(self,func,count=None):
+    self.func = func
+    self.count = count
+    self.elapsed = 0.0
+    self.calls = 0
+    self.items = 0
+
+  def __call__(self,*args,**kwargs):
+    start = time.time()
+    try:
+      result = self.func(*args,**kwargs)
+    finally:
+      self.elapsed += time.time() - start
+      self.calls += 1
+    if self.count != None:
+      self.items += self.count(args,result)
+    return result
+
+def discard_rows(rows_by_table,conn=None,log=None,stats=None):
+  total = 0
+  for (table,cols),rows in rows_by_table.items():
+    total += len(rows)
+    if stats != None:
+      counts = stats.setdefault(table,[0,0,0])
+      counts[0] += len(rows)
+      counts[1] += len(rows)
+  return total,0,0.0
+
+def create_schema(conn):
+  for param in MEASUREMENT_TABLES:
+    conn.execute('CREATE TABLE IF NOT EXISTS m_%s %s'%(param,MEASUREMENT_COLUMNS))
+  conn.execute('commit')
+
+def upload_files(paths):
+  # expands directories into the .xml and .tgz uploads below them
+  files = []
+  for path in paths:
+    if not os.path.isdir(path):
+      files.append(path)
+      continue
+    for root,dirs,names in os.walk(path):
+      files.extend([os.path.join(root,n) for n in names
+                    if n.endswith('.xml') or n.endswith('.tgz')])
+  return sorted(files)
+
+def replay(files,tables,log):
+  # returns the number of XML files parsed
+  nxml = 0
+  for fn in files:
+    if fn.endswith('.tgz'):
+      tar = tarfile.open(fn)
+      for tf in tar:
+        fp = tar.extractfile(tf)
+        if fp == None:
+          continue
+        parser.parsefile(fp,tf.name,tables,log)
+        nxml += 1
+      tar.close()
+    else:
+      fp = open(fn)
+      parser.parsefile(fp,os.path.basename(fn),tables,log)
+      fp.close()
+      nxml += 1
+  return nxml
+
+def peak_rss_mb():
+  # ru_maxrss is in kilobytes on Linux
+  return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss/1024.0
+
+if __name__ == '__main__':
+  argp = argparse.ArgumentParser(description='Benchmark measurement ingest')
+  argp.add_argument('paths',nargs='+',help='XML files, tarballs or directories of them')
+  argp.add_argument('--no-db',action='store_true',help='count rows instead of loading them')
+  argp.add_argument('--create-schema',action='store_true',
+                    help='create missing m_* tables in the data DB first')
+  argp.add_argument('--log',default=os.devnull,help='where to write the insert log')
+  args = argp.parse_args()
+
+  tmpdir = None
+  if 'BDM_TRACEROUTE_DIR' not in os.environ:
+    tmpdir = tempfile.mkdtemp(prefix='bench_trstore_')
+    os.environ['BDM_TRACEROUTE_DIR'] = tmpdir
+  import parser
+
+  files = upload_files(args.paths)
+  if len(files) == 0:
+    sys.exit('no .xml or .tgz files found')
+  if args.no_db:
+    parser.sql.copy_rows = discard_rows
+    parser.conn = 'no-db'  # never connect; discard_rows ignores it
+    # nor to the management DB: tag directions against the generator's mservers
+    parser.mserver_ips = parser.MserverIPs(ttl=float('inf'))
+    parser.mserver_ips.ips = frozenset(gen_measurements.MSERVERS)
+  elif args.create_schema:
+    create_schema(parser.get_conn())
+  db = StageTimer(parser.sql.copy_rows,lambda args,result: result[0])
+  tr = StageTimer(parser.trstore.write,lambda args,result: result)
+  parser.sql.copy_rows = db
+  parser.trstore.write = tr
+
+  log = open(args.log,'w')
+  tables = {'measurement':'MEASUREMENTS','traceroute':'traceroutes','hop':'traceroute_hops'}
+  # the parser reports on stdout as it goes; keep that out of the results
+  stdout = sys.stdout
+  sys.stdout = open(os.devnull,'w')
+  start = time.time()
+  try:
+    nxml = replay(files,tables,log)
+  finally:
+    sys.stdout = stdout
+    if tmpdir != None:
+      shutil.rmtree(tmpdir)
+  total = time.time() - start
+  log.close()
+
+  parse = total - db.elapsed - tr.elapsed
+  print '%d uploads, %d XML files, %d rows%s, %d traceroutes'%(
+        len(files),nxml,db.items,' (not loaded)' if args.no_db else '',tr.items)
+  print '%-8s %9s %12s'%('stage','seconds','share')
+  for name,elapsed in (('parse',parse),('db',db.elapsed),('trstore',tr.elapsed)):
+    print '%-8s %9.3f %11.1f%%'%(name,elapsed,100.0*elapsed/total if total > 0 else 0.0)
+  print '%-8s %9.3f'%('total',total)
+  print 'files/s:   %.1f'%(nxml/total if total > 0 else 0.0)
+  print 'rows/s:    %.0f overall, %.0f in db'%(db.items/total if total > 0 else 0.0,
+        db.items/db.elapsed if db.elapsed > 0 else 0.0)
+  print 'traceroutes/s in trstore: %.0f'%(tr.items/tr.elapsed if tr.elapsed > 0 else 0.0)
+  print 'peak RSS:  %.1f MB'%(peak_rss_mb())
+  print parser.row_mappers.report()
@@ -0,0 +1,214 @@
+#!/usr/bin/env python
+#
+# Removes duplicate rows from the measurement (m_*) and traceroutes tables of
+# the data DB, and prepares those tables for deduplication at ingest time.
+#
+#   prepare   add the digest column and a (deviceid, eventstamp, digest) index
+#             to each table, building the index concurrently
+#   backfill  fill in digests of rows loaded before the column existed, so
+#             that re-uploads of old files are recognised as duplicates;
+#             with --recompute, redo every digest (needed once for rows
+#             loaded while the digest still covered direction)
+#   dedup     delete all but the first copy of rows identical in every
+#             column the digest covers, so rows that differ only in a
+#             direction filled in later count as copies
+#
+# backfill and dedup work through each table one --batch-days window of
+# eventstamp at a time, committing after each window, so they only ever hold
+# row locks on a day's worth of rows and can be interrupted and rerun.
+
+import argparse
+import datetime
+import os
+import sys
+import time
+
+import psycopg2
+
+from pgsql import row_digest, DIGEST_SKIP_COLS
+
+REQ_ENV_VARS = ['BDM_PG_HOST',
+                'BDM_PG_USER',
+                'BDM_PG_PASSWORD',
+                'BDM_PG_DATA_DBNAME',
+                ]
+
+# each optional item consists of a tuple (var_name, default_value)
+OPT_ENV_VARS = [('BDM_PG_PORT', 5432),
+                ]
+
+HOPS_TABLE = 'traceroute_hops'
+
+
+def table_columns(cur, table):
+    cur.execute((
+            "SELECT column_name FROM information_schema.columns "
+            "WHERE table_schema = current_schema() AND table_name = %s "
+            "ORDER BY ordinal_position;"), [table])
+    return [r[0] for r in cur.fetchall()]
+
+
+def dedup_tables(cur):
+    # every m_* table, plus traceroutes, that has the columns we key on
+    cur.execute((
+            "SELECT table_name FROM information_schema.tables "
+            "WHERE table_schema = current_schema() "
+            "AND table_type = 'BASE TABLE' "
+            "AND (table_name LIKE 'm\\_%' OR table_name = 'traceroutes') "
+            "ORDER BY table_name;"))
+    tables = []
+    for (table,) in cur.fetchall():
+        cols = table_columns(cur, table)
+        if 'deviceid' in cols and 'eventstamp' in cols:
+            tables.append(table)
+    return tables
+
+
+def windows(cur, table, since, until, batch):
+    # [start, end) eventstamp windows covering the table's rows
+    cur.execute("SELECT min(eventstamp), max(eventstamp) FROM %s;" % table)
+    first, last = cur.fetchone()
+    if first is None:
+        return
+    # --since/--until are UTC dates; match them to the column's type
+    if since is not None:
+        first = max(first, since.replace(tzinfo=first.tzinfo))
+    if until is not None:
+        last = min(last, until.replace(tzinfo=last.tzinfo))
+    first = first.replace(hour=0, minute=0, second=0, microsecond=0)
+    while first <= last:
+        yield first, first + batch
+        first += batch
+
+
+def prepare(dconn, table):
+    cur = dconn.cursor()
+    if 'digest' not in table_columns(cur, table):
+        cur.execute("ALTER TABLE %s ADD COLUMN digest char(16);" % table)
+        print("%s: added digest column" % table)
+    index = '%s_dedup_idx' % table
+    cur.execute("SELECT 1 FROM pg_indexes WHERE indexname = %s;", [index])
+    exists = cur.rowcount > 0
+    dconn.commit()
+    if not exists:
+        # CREATE INDEX CONCURRENTLY can't run inside a transaction
+        dconn.autocommit = True
+        cur.execute(
+                "CREATE INDEX CONCURRENTLY %s ON %s (deviceid, eventstamp, digest);"
+                % (index, table))
+        dconn.autocommit = False
+        print("%s: created %s" % (table, index))
+
+
+def backfill(dconn, table, since, until, batch, pause, recompute=False):
+    cur = dconn.cursor()
+    all_cols = table_columns(cur, table)
+    cols = [c for c in all_cols if c not in DIGEST_SKIP_COLS]
+    if 'digest' not in all_cols:
+        print("%s: no digest column, run prepare first" % table)
+        return 0
+    total = 0
+    missing = "" if recompute else "digest IS NULL AND "
+    for start, end in list(windows(cur, table, since, until, batch)):
+        cur.execute((
+                "SELECT ctid, digest, %s FROM %s "
+                "WHERE %seventstamp >= %%s AND eventstamp < %%s;")
+                % (', '.join(cols), table, missing), [start, end])
+        updates = []
+        for row in cur.fetchall():
+            digest = row_digest(table, cols, row[2:])
+            if digest != row[1]:
+                updates.append((digest, row[0]))
+        cur.executemany(
+                "UPDATE %s SET digest = %%s WHERE ctid = %%s::tid;" % table,
+                updates)
+        dconn.commit()
+        total += len(updates)
+        if updates:
+            print("%s: %s %d digest(s)" % (table, start.date(), len(updates)))
+        time.sleep(pause)
+    return total
+
+
+def dedup(dconn, table, since, until, batch, pause):
+    cur = dconn.cursor()
+    all_cols = table_columns(cur, table)
+    cols = [c for c in all_cols if c not in DIGEST_SKIP_COLS]
+    returning = " RETURNING id" if table == 'traceroutes' and 'id' in all_cols else ""
+    total = 0
+    for start, end in list(windows(cur, table, since, until, batch)):
+        cur.execute((
+                "DELETE FROM %s WHERE ctid IN ( "
+                "   SELECT ctid FROM ( "
+                "       SELECT ctid, row_number() OVER ( "
+                "           PARTITION BY %s ORDER BY ctid) AS n "
+                "       FROM %s "
+                "       WHERE eventstamp >= %%s AND eventstamp < %%s "
+                "       ) AS t "
+                "   WHERE t.n > 1 "
+                "   )%s;") % (table, ', '.join(cols), table, returning),
+                [start, end])
+        deleted = cur.rowcount
+        if returning and deleted > 0:
+            cur.execute("DELETE FROM %s WHERE id = ANY(%%s);" % HOPS_TABLE,
+                        [[r[0] for r in cur.fetchall()]])
+        dconn.commit()
+        total += deleted
+        if deleted:
+            print("%s: %s %d duplicate(s) removed" % (table, start.date(), deleted))
+        time.sleep(pause)
+    return total
+
+
+def parse_date(val):
+    return datetime.datetime.strptime(val, '%Y-%m-%d')
+
+
+if __name__ == '__main__':
+    argp = argparse.ArgumentParser(
+            description='Deduplicate measurement and traceroute tables')
+    argp.add_argument('command', choices=('prepare', 'backfill', 'dedup'))
+    argp.add_argument('tables', nargs='*',
+                      help='default: every m_* table and traceroutes')
+    argp.add_argument('--since', type=parse_date, help='YYYY-MM-DD')
+    argp.add_argument('--until', type=parse_date, help='YYYY-MM-DD')
+    argp.add_argument('--batch-days', type=float, default=1,
+                      help='eventstamp window per transaction (default: 1)')
+    argp.add_argument('--pause', type=float, default=0,
+                      help='seconds to sleep between windows (default: 0)')
+    argp.add_argument('--recompute', action='store_true',
+                      help='backfill: redo digests that are already set')
+    args = argp.parse_args()
+
+    config = {}
+    for evname in REQ_ENV_VARS:
+        try:
+            config[evname] = os.environ[evname]
+        except KeyError:
+            print(("Environment variable '%s' required and not defined. "
+                    "Terminating.") % evname)
+            sys.exit(1)
+    for (evname, default_val) in OPT_ENV_VARS:
+        config[evname] = os.environ.get(evname) or default_val
+
+    dconn = psycopg2.connect(
+            host=config['BDM_PG_HOST'],
+            port=int(config['BDM_PG_PORT']),
+            database=config['BDM_PG_DATA_DBNAME'],
+            user=config['BDM_PG_USER'],
+            password=config['BDM_PG_PASSWORD'],
+            )
+    tables = args.tables or dedup_tables(dconn.cursor())
+    batch = datetime.timedelta(days=args.batch_days)
+    for table in tables:
+        if args.command == 'prepare':
+            if table != 'traceroutes':
+                prepare(dconn, table)
+        elif args.command == 'backfill':
+            if table != 'traceroutes':
+                n = backfill(dconn, table, args.since, args.until, batch,
+                             args.pause, args.recompute)
+                print("%s: %d digest(s) filled in" % (table, n))
+        else:
+            n = dedup(dconn, table, args.since, args.until, batch, args.pause)
+            print("%s: %d duplicate row(s) removed" % (table, n))
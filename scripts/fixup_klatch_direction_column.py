@@ -1,11 +1,24 @@
 #!/usr/bin/env python
+#
+# Fills in the direction column of measurements loaded before the parser
+# started tagging it at ingest (see parser.MserverIPs): 'up' when the
+# destination is a measurement server, 'dw' when the source is.
+#
+# This is a one-off backfill. Each table is worked through one --batch-days
+# window of eventstamp at a time, with a single UPDATE per window, and the end
+# of the last finished window is recorded in the direction_backfill table of
+# the data DB. A rerun carries on from there instead of scanning the whole
+# table again; --restart starts over from the oldest row.
+#
+# Rows that ingest loads without a direction (while it can't reach the
+# management DB) may lie behind the watermark; --since YYYY-MM-DD rescans
+# from that day on, or --restart from the start.
 
-import calendar
+import argparse
 import datetime
 import os
 import sys
-import pprint
-import re
+import time
 
 import psycopg2
 
@@ -29,7 +42,106 @@ OPT_ENV_VARS = [('BDM_PG_PORT', 5432),
                 ('BDMD_DEBUG', 0),
                 ]
 
+WATERMARK_TABLE = 'direction_backfill'
+
+
+def load_mserver_ips(mcur, dcur):
+    mcur.execute("SELECT DISTINCT ti.ip FROM target_ips as ti ORDER BY ti.ip;")
+    ips = [r[0] for r in mcur.fetchall()]
+    dcur.execute("CREATE TEMP TABLE mserver_ips ( ip inet PRIMARY KEY );")
+    dcur.execute("INSERT INTO mserver_ips (ip) SELECT unnest(%s::inet[]);",
+                 [ips])
+    return len(ips)
+
+
+def get_watermark(dcur, table):
+    dcur.execute(("CREATE TABLE IF NOT EXISTS %s ( "
+                  "tablename text PRIMARY KEY, "
+                  "done_until timestamp with time zone NOT NULL );")
+                 % WATERMARK_TABLE)
+    dcur.execute("SELECT done_until FROM %s WHERE tablename = %%s;"
+                 % WATERMARK_TABLE, [table])
+    row = dcur.fetchone()
+    return row[0] if row else None
+
+
+def set_watermark(dcur, table, done_until):
+    dcur.execute("UPDATE %s SET done_until = %%s WHERE tablename = %%s;"
+                 % WATERMARK_TABLE, [done_until, table])
+    if dcur.rowcount == 0:
+        dcur.execute("INSERT INTO %s (tablename, done_until) VALUES (%%s, %%s);"
+                     % WATERMARK_TABLE, [table, done_until])
+
+
+def table_exists(dcur, table):
+    dcur.execute("SELECT 1 FROM information_schema.tables "
+                 "WHERE table_schema = current_schema() AND table_name = %s;",
+                 [table])
+    return dcur.rowcount > 0
+
+
+def backfill(dconn, table, since, until, batch, pause, restart):
+    # since and until are UTC timestamp strings; since overrides the watermark
+    dcur = dconn.cursor()
+    start = None if restart or since else get_watermark(dcur, table)
+    if since is not None:
+        dcur.execute("SELECT %s::timestamp with time zone;", [since])
+        start = dcur.fetchone()[0]
+    if start is None:
+        # with time zone, to compare with until whatever the column's type
+        dcur.execute("SELECT min(eventstamp)::timestamp with time zone FROM %s;"
+                     % table)
+        start = dcur.fetchone()[0]
+        if start is None:
+            return 0, 0
+    dcur.execute("SELECT %s::timestamp with time zone;", [until])
+    until = dcur.fetchone()[0]
+    up = dw = 0
+    while start < until:
+        end = min(start + batch, until)
+        dcur.execute((
+                "UPDATE %s SET direction = CASE "
+                "   WHEN dstip IN (SELECT ip FROM mserver_ips) THEN 'up' "
+                "   ELSE 'dw' END "
+                "WHERE direction IS NULL "
+                "AND eventstamp >= %%s AND eventstamp < %%s "
+                "AND (dstip IN (SELECT ip FROM mserver_ips) "
+                "     OR srcip IN (SELECT ip FROM mserver_ips)) "
+                "RETURNING direction;") % table, [start, end])
+        directions = [r[0] for r in dcur.fetchall()]
+        set_watermark(dcur, table, end)
+        dconn.commit()
+        up += directions.count('up')
+        dw += directions.count('dw')
+        if directions:
+            print("%s: %s %d row(s)" % (table, start.date(), len(directions)))
+        start = end
+        time.sleep(pause)
+    return up, dw
+
+
+def parse_date(val):
+    return datetime.datetime.strptime(val, '%Y-%m-%d')
+
+
 if __name__ == '__main__':
+    argp = argparse.ArgumentParser(
+            description='Backfill the direction of old measurements')
+    argp.add_argument('tables', nargs='*',
+                      help='default: %s' % ', '.join(FIXUP_TABLES))
+    argp.add_argument('--since', type=parse_date,
+                      help=('YYYY-MM-DD, UTC: rescan from here, whatever '
+                            'the watermark'))
+    argp.add_argument('--until', type=parse_date,
+                      help='YYYY-MM-DD, UTC (default: now)')
+    argp.add_argument('--batch-days', type=float, default=1,
+                      help='eventstamp window per transaction (default: 1)')
+    argp.add_argument('--pause', type=float, default=0,
+                      help='seconds to sleep between windows (default: 0)')
+    argp.add_argument('--restart', action='store_true',
+                      help='ignore the recorded watermark and start over')
+    args = argp.parse_args()
+
     config = {}
     for evname in REQ_ENV_VARS:
         try:
@@ -57,25 +169,18 @@ if __name__ == '__main__':
             )
 
     mcur = mconn.cursor()
-    mcur.execute("SELECT DISTINCT ti.ip FROM target_ips as ti ORDER BY ti.ip;")
     dcur = dconn.cursor()
-    dcur.execute("CREATE TEMP TABLE mserver_ips ( ip inet PRIMARY KEY );")
-    dcur.executemany(
-            "INSERT INTO mserver_ips (ip) VALUES (%s);", mcur.fetchall())
+    # a temp table lives as long as the session, across the commits below
+    print("%d mserver address(es)" % load_mserver_ips(mcur, dcur))
     dconn.commit()
-    for table in FIXUP_TABLES:
-        sys.stdout.write("Adding directions to '%s'..." % table)
-        dcur.execute((
-                "UPDATE %s SET direction = 'up' "
-                "WHERE direction IS NULL "
-                "AND dstip IN (SELECT ip FROM mserver_ips);") % table)
-        sys.stdout.write(" (%d 'up' row(s), " % dcur.rowcount)
-        dcur.execute((
-                "UPDATE %s SET direction = 'dw' "
-                "WHERE direction IS NULL "
-                "AND srcip IN (SELECT ip FROM mserver_ips);") % table)
-        sys.stdout.write("%d 'dw' row(s))." % dcur.rowcount)
-        dconn.commit()
-        print(" Done.")
-
-
+    until = args.until or datetime.datetime.utcnow()
+    until = until.strftime('%Y-%m-%d %H:%M:%S+00')
+    since = args.since and args.since.strftime('%Y-%m-%d %H:%M:%S+00')
+    batch = datetime.timedelta(days=args.batch_days)
+    for table in args.tables or FIXUP_TABLES:
+        if not table_exists(dcur, table):
+            print("%s: no such table, skipped" % table)
+            continue
+        up, dw = backfill(dconn, table, since, until, batch, args.pause,
+                          args.restart)
+        print("%s: %d 'up' row(s), %d 'dw' row(s). Done." % (table, up, dw))
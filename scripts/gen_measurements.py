@@ -0,0 +1,204 @@
+#!/usr/bin/env python
+# Writes synthetic measurement uploads for benchmarking the ingest path.
+#
+# Each device produces one <measurements> block per measurement cycle, with the
+# parameters and cadences described in xml_description: rtt/lmrtt every cycle,
+# jitter and pktloss every 30 minutes, dns hourly, bitrate (with aggl3bitrate
+# and the under-load ulrtt pair) every 2 hours, capacity and shaperate every 6
+# hours, and a traceroute to each measurement server hourly. A configurable
+# fraction of blocks is malformed the ways real uploads are.
+#
+# Output is either flat DEVICE_TS.xml files, as parse_xml.py reads from
+# var/data/, or tarballs laid out like the upload tree parse_xml_tgz.py globs:
+#   OUT/HOST/active/DEVICE/active_TS.xml.tgz
+import os
+import sys
+import time
+import random
+import tarfile
+import calendar
+import argparse
+from cStringIO import StringIO
+
+CYCLE = 600
+
+# param: (tool, period in seconds, directional, value range)
+PARAMS = [
+  ('rtt',          'ping',        CYCLE,  False, (5.0,300.0)),
+  ('lmrtt',        'ping',        CYCLE,  False, (1.0,40.0)),
+  ('jitter',       'ditg',        1800,   True,  (0.0001,0.05)),
+  ('pktloss',      'ditg',        1800,   True,  (0.0,0.05)),
+  ('dnsdelaync',   'dnsclient',   3600,   False, (5.0,500.0)),
+  ('dnsfailnc',    'dnsclient',   3600,   False, (0.0,1.0)),
+  ('dnsdelayc',    'dnsclient',   3600,   False, (1.0,50.0)),
+  ('dnsfailc',     'dnsclient',   3600,   False, (0.0,1.0)),
+  ('bitrate',      'netperf',     7200,   True,  (200.0,50000.0)),
+  ('aggl3bitrate', 'ifconfig',    7200,   True,  (200.0,50000.0)),
+  ('ulrttdw',      'ping',        7200,   False, (5.0,900.0)),
+  ('ulrttup',      'ping',        7200,   False, (5.0,900.0)),
+  ('capacity',     'shaperprobe', 21600,  True,  (200.0,60000.0)),
+  ('shaperate',    'shaperprobe', 21600,  True,  (200.0,60000.0)),
+]
+TRACEROUTE_PERIOD = 3600
+MSERVERS = ['198.51.100.%d'%(i) for i in range(10,18)]
+MALFORMED_KINDS = ('ampersand','no_param','truncated','bad_version')
+
+def device_ids(count,rnd):
+  ids = set()
+  while len(ids) < count:
+    ids.add('OW%012X'%(rnd.getrandbits(48)))
+  return sorted(ids)
+
+def stats(rnd,lo,hi):
+  # avg, std, min, max, med, iqr of a plausible sample
+  mn = rnd.uniform(lo,hi)
+  mx = mn*rnd.uniform(1.0,1.5)
+  avg = rnd.uniform(mn,mx)
+  return [avg,(mx-mn)/4,mn,mx,rnd.uniform(mn,mx),(mx-mn)/2]
+
+def measurement(rnd,param,tool,srcip,dstip,ts,direction,vrange):
+  avg,std,mn,mx,med,iqr = stats(rnd,*vrange)
+  attrs = [('param',param.upper()),('tool',tool),('srcip',srcip),('dstip',dstip),
+           ('timestamp',ts),('avg','%.4f'%(avg)),('std','%.4f'%(std)),
+           ('min','%.4f'%(mn)),('max','%.4f'%(mx)),('med','%.4f'%(med)),
+           ('iqr','%.4f'%(iqr))]
+  if direction != None:
+    attrs.append(('direction',direction))
+  return '<measurement %s />'%(' '.join(['%s="%s"'%(k,v) for k,v in attrs]))
+
+def traceroute(rnd,srcip,dstip,ts):
+  lines = ['<traceroute srcip="%s" dstip="%s" timestamp="%d" tool="paris-traceroute">'%(
+           srcip,dstip,ts)]
+  nhops = rnd.randint(6,16)
+  rtt = rnd.uniform(0.5,2.0)
+  for hop in range(1,nhops+1):
+    if rnd.random() < 0.05:
+      lines.append('<hop id="%d" ip="*" rtt="" />'%(hop))
+      continue
+    rtt += rnd.uniform(0.5,15.0)
+    ip = dstip if hop == nhops else '10.%d.%d.%d'%(rnd.randint(0,255),hop,rnd.randint(1,254))
+    lines.append('<hop id="%d" ip="%s" rtt="%.3f" />'%(hop,ip,rtt))
+  lines.append('</traceroute>')
+  return lines
+
+def cycle_block(rnd,did,devip,ts,version):
+  lines = ['<measurements version="%s">'%(version),'<info deviceid="%s" />'%(did)]
+  for param,tool,period,directional,vrange in PARAMS:
+    if ts % period >= CYCLE:
+      continue
+    servers = MSERVERS if param == 'rtt' else [rnd.choice(MSERVERS)]
+    for server in servers:
+      mts = ts + rnd.randint(0,CYCLE-1)
+      if directional:
+        lines.append(measurement(rnd,param,tool,devip,server,mts,'up',vrange))
+        lines.append(measurement(rnd,param,tool,server,devip,mts,'dw',vrange))
+      else:
+        lines.append(measurement(rnd,param,tool,devip,server,mts,None,vrange))
+  if ts % TRACEROUTE_PERIOD < CYCLE:
+    for server in MSERVERS:
+      lines.extend(traceroute(rnd,devip,server,ts + rnd.randint(0,CYCLE-1)))
+  lines.append('</measurements>')
+  return lines
+
+def malform(rnd,lines):
+  kind = rnd.choice(MALFORMED_KINDS)
+  i = rnd.randint(2,len(lines)-2)
+  if kind == 'ampersand':
+    lines[i] = lines[i].replace('" ',' & ',1)
+  elif kind == 'no_param':
+    lines[i] = '<measurement tool="ping" srcip="0.0.0.0" dstip="0.0.0.0" timestamp="0" />'
+  elif kind == 'truncated':
+    lines[i] = lines[i][:len(lines[i])/2]
+  else:
+    lines[0] = '<measurements version="0.9">'
+  return lines
+
+def device_files(rnd,did,start,end,cycles_per_file,malformed,version):
+  # yields (timestamp, xml text) for each upload from one device
+  devip = '203.0.113.%d'%(rnd.randint(1,254))
+  ts = start - start % CYCLE
+  while ts < end:
+    out = StringIO()
+    file_ts = ts
+    for i in range(0,cycles_per_file):
+      if ts >= end:
+        break
+      lines = cycle_block(rnd,did,devip,ts,version)
+      if rnd.random() < malformed:
+        lines = malform(rnd,lines)
+      out.write('\n'.join(lines))
+      out.write('\n')
+      ts += CYCLE
+    yield file_ts,out.getvalue()
+
+def write_tarball(path,members):
+  tmp = path + '.tmp'
+  tar = tarfile.open(tmp,'w:gz')
+  for name,mtime,text in members:
+    info = tarfile.TarInfo(name)
+    info.size = len(text)
+    info.mtime = mtime
+    tar.addfile(info,StringIO(text))
+  tar.close()
+  os.rename(tmp,path)
+
+def generate(args):
+  rnd = random.Random(args.seed)
+  start = args.start
+  end = start + int(args.days*86400)
+  nfiles = 0
+  nbytes = 0
+  for did in device_ids(args.devices,rnd):
+    members = []
+    for ts,text in device_files(rnd,did,start,end,args.cycles_per_file,
+                                args.malformed,args.version):
+      name = '%s_%d.xml'%(did,ts)
+      nfiles += 1
+      nbytes += len(text)
+      if args.format == 'xml':
+        fp = open(os.path.join(args.out,name),'w')
+        fp.write(text)
+        fp.close()
+        continue
+      members.append((name,ts,text))
+      if len(members) >= args.files_per_tarball:
+        write_tarball(tarball_path(args,did,members[0][1]),members)
+        members = []
+    if len(members) > 0:
+      write_tarball(tarball_path(args,did,members[0][1]),members)
+  return nfiles,nbytes
+
+def tarball_path(args,did,ts):
+  d = os.path.join(args.out,args.host,'active',did)
+  if not os.path.isdir(d):
+    os.makedirs(d)
+  return os.path.join(d,'active_%d.xml.tgz'%(ts))
+
+def parse_date(val):
+  try:
+    return int(val)
+  except ValueError:
+    return calendar.timegm(time.strptime(val,'%Y-%m-%d'))
+
+if __name__ == '__main__':
+  argp = argparse.ArgumentParser(description='Generate synthetic measurement uploads')
+  argp.add_argument('out',help='output directory')
+  argp.add_argument('-d','--devices',type=int,default=10)
+  argp.add_argument('--start',type=parse_date,default=calendar.timegm((2012,3,1,0,0,0)),
+                    help='UTC YYYY-MM-DD or epoch (default: 2012-03-01)')
+  argp.add_argument('--days',type=float,default=1.0,help='time span (default: 1)')
+  argp.add_argument('--malformed',type=float,default=0.01,
+                    help='fraction of malformed blocks (default: 0.01)')
+  argp.add_argument('--format',choices=('xml','tgz'),default='tgz')
+  argp.add_argument('--cycles-per-file',type=int,default=1,
+                    help='measurement cycles per XML file (default: 1)')
+  argp.add_argument('--files-per-tarball',type=int,default=36,
+                    help='XML files per tarball (default: 36, 6 hours)')
+  argp.add_argument('--host',default='bench',help='upload host directory for tarballs')
+  argp.add_argument('--version',default='1.3',help='<measurements> version')
+  argp.add_argument('--seed',type=int,default=0)
+  args = argp.parse_args()
+  if not os.path.isdir(args.out):
+    os.makedirs(args.out)
+  nfiles,nbytes = generate(args)
+  print '%d files, %.1f MB of XML written to %s'%(nfiles,nbytes/1e6,args.out)
@@ -19,14 +19,55 @@ OPT_ENV_VARS = [('BDM_PG_PORT', 5432),
                 ('BDMD_DEBUG', 0),
                 ]
 
+def interval_ms(start, end):
+    return (calendar.timegm(start.timetuple())*1000,
+            calendar.timegm(end.timetuple())*1000)
+
+
+# rows are (id, start, end), ordered by id and start; single check-ins from
+# devices_log are just rows with start == end.
+def build_intervals(rows, downtime_threshold):
+    intervals_by_id = {}
+    current_id = None
+    current_intervals = []
+    interval_start = None
+    interval_end = None
+    for row in rows:
+        if row[0] != current_id:
+            if current_id is not None:
+                current_intervals.append(
+                        interval_ms(interval_start, interval_end))
+                intervals_by_id[current_id] = (zip(*current_intervals))
+                current_intervals = []
+            current_id = row[0]
+            interval_start = row[1]
+            interval_end = row[2]
+        else:
+            if (row[1] - interval_end) > downtime_threshold:
+                current_intervals.append(
+                        interval_ms(interval_start, interval_end))
+                interval_start = row[1]
+            interval_end = max(interval_end, row[2])
+    if current_id is not None:
+        current_intervals.append(interval_ms(interval_start, interval_end))
+        intervals_by_id[current_id] = (zip(*current_intervals))
+    return intervals_by_id
+
+
 if __name__ == '__main__':
-    if not (2 <= len(sys.argv) <= 3):
-        print("USAGE %s output_filename.json [DOWNTIME_THRESHOLD=180]"
+    args = sys.argv[1:]
+    from_sessions = (args[:1] == ['-s'])
+    if from_sessions:
+        args = args[1:]
+    if not (1 <= len(args) <= 2):
+        print("USAGE %s [-s] output_filename.json [DOWNTIME_THRESHOLD=180]"
               % sys.argv[0])
+        print("  -s  build intervals from device_sessions instead of "
+              "devices_log")
         sys.exit(2)
-    f = open(sys.argv[1], 'w')
-    if len(sys.argv) == 3:
-        DOWNTIME_THRESHOLD = datetime.timedelta(seconds=int(sys.argv[2]))
+    f = open(args[0], 'w')
+    if len(args) == 2:
+        DOWNTIME_THRESHOLD = datetime.timedelta(seconds=int(args[1]))
     else:
         DOWNTIME_THRESHOLD = datetime.timedelta(seconds=180)
 
@@ -50,38 +91,29 @@ if __name__ == '__main__':
             )
 
     mcur = mconn.cursor()
-    mcur.execute(
-            "SELECT id, date_seen "
-            "FROM devices_log "
-            "ORDER BY id, date_seen;")
-    data = mcur.fetchall()
-    intervals_by_id = {}
-    current_id = None
-    current_intervals = []
-    interval_start = None
-    interval_end = None
-    for row in data:
-        if row[0] != current_id:
-            if current_id is not None:
-                current_intervals.append(
-                        (calendar.timegm(interval_start.timetuple())*1000,
-                        calendar.timegm(interval_end.timetuple())*1000))
-                intervals_by_id[current_id] = (zip(*current_intervals))
-                current_intervals = []
-            current_id = row[0]
-            interval_start = row[1]
-            interval_end = row[1]
-        else:
-            if (row[1] - interval_end) > DOWNTIME_THRESHOLD:
-                current_intervals.append(
-                        (calendar.timegm(interval_start.timetuple())*1000,
-                        calendar.timegm(interval_end.timetuple())*1000))
-                interval_start = row[1]
-            interval_end = row[1]
-    current_intervals.append(
-            (calendar.timegm(interval_start.timetuple())*1000,
-            calendar.timegm(interval_end.timetuple())*1000))
-    intervals_by_id[current_id] = (zip(*current_intervals))
+    if from_sessions:
+        # bdmd splits sessions at restarts; build_intervals merges them back
+        # together as long as the gap is under DOWNTIME_THRESHOLD. Sessions
+        # still open are only in bdmd's memory, so a device seen since its
+        # last stored session also gets its last check-in, which extends
+        # that session up to it or starts an interval there, as the last
+        # check-in in devices_log does without -s.
+        mcur.execute(
+                "SELECT device_id, date_start, date_end "
+                "FROM device_sessions "
+                "UNION ALL "
+                "SELECT d.id, d.date_last_seen, d.date_last_seen "
+                "FROM devices AS d "
+                "WHERE d.date_last_seen > coalesce("
+                "    (SELECT max(s.date_end) FROM device_sessions AS s "
+                "     WHERE s.device_id = d.id), '-infinity') "
+                "ORDER BY 1, 2;")
+    else:
+        mcur.execute(
+                "SELECT id, date_seen, date_seen "
+                "FROM devices_log "
+                "ORDER BY id, date_seen;")
+    intervals_by_id = build_intervals(mcur.fetchall(), DOWNTIME_THRESHOLD)
 
     json.dump(
             (intervals_by_id,
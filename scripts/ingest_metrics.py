@@ -0,0 +1,213 @@
+#!/usr/bin/env python
+# Ingest metrics: per-file stage timings and counters, written as JSON lines.
+#
+# parser.parsefile records, for every file it ingests:
+#
+#   read     reading (and for tarball members, decompressing) the file
+#   parse    splitting blocks, expat and mapping records to rows
+#   db       pgsql.copy_rows
+#   trstore  trstore.write
+#
+# along with the number of blocks, bad blocks, traceroutes and, per table, the
+# rows handed to the DB and how many were inserted, rejected or skipped as
+# duplicates. The ingest scripts start a run with start_run, which appends one
+# {"type": "file"} line per file and a {"type": "run"} line at the end to
+# var/log/ingest_metrics.jsonl. parse_xml_tgz.py workers write their own file
+# lines under the parent's run id.
+#
+#   ingest_metrics.py report [--runs N] [--slowest N] [FILE]
+#
+# summarises the last runs: where the time went, throughput, per-table counts
+# and the slowest files.
+import os
+import sys
+import time
+import json
+import argparse
+
+STAGES = ('read','parse','db','trstore')
+COUNTERS = ('blocks','bad_blocks','traceroutes','traceroutes_stored')
+TABLE_COUNTERS = ('rows','inserted','rejected')
+DEFAULT_PATH = os.path.join(os.environ.get('HOME',''),'var/log/ingest_metrics.jsonl')
+
+# Wraps a file object and adds up the time spent waiting on it.
+class TimedReader(object):
+  def __init__(self,fp):
+    self.fp = fp
+    self.elapsed = 0.0
+
+  def __iter__(self):
+    it = iter(self.fp)
+    timer = time.time
+    while True:
+      start = timer()
+      try:
+        line = it.next()
+      finally:
+        self.elapsed += timer() - start
+      yield line
+
+  def read(self,size=-1):
+    start = time.time()
+    try:
+      return self.fp.read(size)
+    finally:
+      self.elapsed += time.time() - start
+
+class FileStats(object):
+  def __init__(self,name):
+    self.name = name
+    self.start = time.time()
+    self.times = dict([(stage,0.0) for stage in STAGES])
+    self.counts = dict([(counter,0) for counter in COUNTERS])
+    self.tables = {}
+
+  def record(self,run,script):
+    wall = time.time() - self.start
+    # parsing is what's left once the other stages are accounted for
+    self.times['parse'] = max(0.0,wall - self.times['read'] - self.times['db'] -
+                              self.times['trstore'])
+    rec = {'type':'file','run':run,'script':script,'pid':os.getpid(),
+           'file':self.name,'start':round(self.start,3),'wall':round(wall,6)}
+    for stage in STAGES:
+      rec[stage] = round(self.times[stage],6)
+    rec.update(self.counts)
+    rec['tables'] = self.tables
+    for counter in TABLE_COUNTERS:
+      rec[counter] = sum([t[counter] for t in self.tables.values()])
+    rec['duplicates'] = rec['rows'] - rec['inserted'] - rec['rejected']
+    return rec
+
+# Collects FileStats for the files of one run. Until start_run is called the
+# counters are kept but nothing is written.
+class IngestMetrics(object):
+  def __init__(self):
+    self.fd = None
+    self.run = None
+    self.script = None
+    self.started = None
+    self.file = None
+
+  def start_run(self,path,script):
+    self.fd = os.open(path,os.O_WRONLY | os.O_APPEND | os.O_CREAT,0644)
+    self.started = time.time()
+    self.run = '%d.%d'%(self.started,os.getpid())
+    self.script = script
+
+  def write(self,rec):
+    # a single O_APPEND write per line, so workers sharing the file don't
+    # interleave their lines
+    if self.fd != None:
+      os.write(self.fd,json.dumps(rec,sort_keys=True) + '\n')
+
+  def begin_file(self,name):
+    self.file = FileStats(name)
+
+  def add_time(self,stage,seconds):
+    if self.file != None:
+      self.file.times[stage] += seconds
+
+  def count(self,counter,n=1):
+    if self.file != None:
+      self.file.counts[counter] += n
+
+  def add_tables(self,stats):
+    # stats as filled in by pgsql.copy_rows: table -> [rows, inserted, rejected]
+    if self.file == None:
+      return
+    for table,vals in stats.items():
+      t = self.file.tables.setdefault(table,dict([(c,0) for c in TABLE_COUNTERS]))
+      for counter,val in zip(TABLE_COUNTERS,vals):
+        t[counter] += val
+
+  def end_file(self):
+    if self.file != None:
+      self.write(self.file.record(self.run,self.script))
+    self.file = None
+
+  def end_run(self,**extra):
+    if self.fd == None:
+      return
+    rec = {'type':'run','run':self.run,'script':self.script,'pid':os.getpid(),
+           'start':round(self.started,3),'wall':round(time.time() - self.started,6)}
+    rec.update(extra)
+    self.write(rec)
+    os.close(self.fd)
+    self.fd = None
+
+def read_metrics(path):
+  runs = {}
+  files = {}
+  for line in open(path):
+    try:
+      rec = json.loads(line)
+    except ValueError:
+      continue  # a line cut short by a crash
+    if rec.get('type') == 'run':
+      runs[rec['run']] = rec
+    elif rec.get('type') == 'file':
+      files.setdefault(rec['run'],[]).append(rec)
+  return runs,files
+
+def share(part,total):
+  return 100.0*part/total if total > 0 else 0.0
+
+def report_run(run,files,slowest):
+  # run is None for runs that haven't finished (or died)
+  wall = run['wall'] if run else max([f['start'] + f['wall'] for f in files]) - \
+         min([f['start'] for f in files])
+  script = (run or files[0])['script']
+  start = time.strftime('%Y-%m-%d %H:%M:%S',time.localtime((run or files[0])['start']))
+  rows = sum([f['rows'] for f in files])
+  print '%s  %s%s: %d files, %d rows in %.1fs wall'%(start,script,
+        '' if run else ' (unfinished)',len(files),rows,wall)
+  total = sum([sum([f[stage] for f in files]) for stage in STAGES])
+  print '  %-8s %10s %7s'%('stage','seconds','share')
+  for stage in STAGES:
+    secs = sum([f[stage] for f in files])
+    print '  %-8s %10.2f %6.1f%%'%(stage,secs,share(secs,total))
+  print '  files/s %.1f, rows/s %.0f, blocks %d (%d bad), traceroutes %d'%(
+        len(files)/wall if wall > 0 else 0.0,rows/wall if wall > 0 else 0.0,
+        sum([f['blocks'] for f in files]),sum([f['bad_blocks'] for f in files]),
+        sum([f['traceroutes'] for f in files]))
+  tables = {}
+  for f in files:
+    for table,counts in f['tables'].items():
+      t = tables.setdefault(table,dict([(c,0) for c in TABLE_COUNTERS]))
+      for counter in TABLE_COUNTERS:
+        t[counter] += counts[counter]
+  if tables:
+    print '  %-16s %10s %10s %10s %10s'%('table','rows','inserted','rejected','duplicate')
+    for table in sorted(tables):
+      t = tables[table]
+      print '  %-16s %10d %10d %10d %10d'%(table,t['rows'],t['inserted'],t['rejected'],
+            t['rows'] - t['inserted'] - t['rejected'])
+  if slowest > 0:
+    print '  slowest files:'
+    for f in sorted(files,key=lambda f: -f['wall'])[:slowest]:
+      print '  %8.3fs %s (%s)'%(f['wall'],f['file'],', '.join(
+            ['%s %.3f'%(stage,f[stage]) for stage in STAGES]))
+
+def report(path,nruns,slowest):
+  runs,files = read_metrics(path)
+  ids = set(runs.keys()) | set(files.keys())
+  order = sorted(ids,key=lambda r: (runs.get(r) or files[r][0])['start'])
+  for run in order[-nruns:]:
+    if run not in files:
+      continue  # nothing was ingested
+    report_run(runs.get(run),files[run],slowest)
+    print
+
+if __name__ == '__main__':
+  argp = argparse.ArgumentParser(description='Summarise ingest metrics')
+  sub = argp.add_subparsers(dest='command')
+  rep = sub.add_parser('report',help='stage timings and counts of the last runs')
+  rep.add_argument('path',nargs='?',default=DEFAULT_PATH,
+                   help='metrics file (default: ~/var/log/ingest_metrics.jsonl)')
+  rep.add_argument('--runs',type=int,default=5,help='how many runs (default: 5)')
+  rep.add_argument('--slowest',type=int,default=5,
+                   help='list the N slowest files of each run (default: 5)')
+  args = argp.parse_args()
+  if not os.path.exists(args.path):
+    sys.exit('%s: no such file'%(args.path))
+  report(args.path,args.runs,args.slowest)
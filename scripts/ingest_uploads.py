@@ -0,0 +1,115 @@
+#!/usr/bin/env python
+# Ingests uploaded .tgz archives in one pass, replacing the crontab job that
+# unpacked them into var/data for parse.sh to shuffle around.
+#
+# Each archive is read once, as a stream: XML members are decompressed on the
+# fly and fed straight to the parser, other members are written to var/data for
+# the jobs that pick them up there, and the archive's sha1 is computed from the
+# same bytes. The archive itself then goes to its place in the archive tree
+# (see archive_layout.py) with a single rename. Members and archives are
+# recorded in the ingest ledger, so an interrupted run resumes where it stopped.
+import os
+import sys
+import time
+import zlib
+import shutil
+import tarfile
+import argparse
+import gzip as gz
+from parser import *
+import parser
+from ledger import IngestLedger, HashingReader
+from archive_layout import archive_path, move_into
+
+def find_uploads(dir,min_age):
+  # .tgz files under dir that haven't been written to for min_age seconds
+  now = time.time()
+  uploads = []
+  for root,dirs,names in os.walk(dir):
+    for name in names:
+      fn = os.path.join(root,name)
+      if name.endswith('.tgz') and now - os.path.getmtime(fn) >= min_age:
+        uploads.append(fn)
+  return sorted(uploads)
+
+def extract_member(tar,tf,datadir):
+  # the old unpacker's behaviour for members we don't parse
+  src = tar.extractfile(tf)
+  dest = os.path.join(datadir,os.path.basename(tf.name))
+  dst = open(dest + '.part','wb')
+  shutil.copyfileobj(src,dst)
+  dst.close()
+  os.rename(dest + '.part',dest)
+
+def ingest_upload(fn,tables,log,filelog,ledger,datadir):
+  # returns the archive's sha1
+  name = os.path.basename(fn)
+  done = ledger.members_done(name)
+  raw = open(fn,'rb')
+  reader = HashingReader(raw)
+  tar = tarfile.open(fileobj=reader,mode='r|gz')
+  print 'upload:',fn
+  for tf in tar:
+    if not tf.isfile():
+      continue
+    if not tf.name.endswith('.xml'):
+      extract_member(tar,tf,datadir)
+      continue
+    if done.get(tf.name) == (tf.size,int(tf.mtime)):
+      continue
+    filelog.write("%s\n"%(tf.name))
+    print tf.name
+    member = HashingReader(tar.extractfile(tf))
+    parsefile(member,tf.name,tables,log)
+    ledger.mark_member(name,tf.name,tf.size,int(tf.mtime),member.hexdigest())
+  tar.close()
+  # hash whatever the tar reader left unread (end-of-archive padding)
+  while reader.read(1<<16):
+    pass
+  raw.close()
+  return reader.hexdigest()
+
+def process_upload(fn,tables,log,filelog,ledger,archive_dir,datadir):
+  # ingests fn unless the ledger has it, then moves it into the archive tree
+  name = os.path.basename(fn)
+  st = os.stat(fn)
+  dest = archive_path(archive_dir,name)
+  if not ledger.tarball_done(name,st.st_size,int(st.st_mtime)):
+    try:
+      sha1 = ingest_upload(fn,tables,log,filelog,ledger,datadir)
+    except (tarfile.TarError,IOError,EOFError,zlib.error) as e:
+      # unreadable archive: keep it out of the way for a human to look at
+      log.write('Error reading %s: %s\n'%(fn,e))
+      print 'failed:',fn,e
+      move_into(fn,os.path.join(archive_dir,'failed',name))
+      return
+    ledger.mark_tarball(name,dest,st.st_size,int(st.st_mtime),sha1)
+    log.write('Done ' + fn + '\n')
+  move_into(fn,dest)
+
+if __name__ == '__main__':
+  HOME = os.environ['HOME'] + '/'
+  argp = argparse.ArgumentParser(description='Ingest and archive uploaded measurement archives')
+  argp.add_argument('--upload-dir',default=HOME+'var/data',
+                    help='where uploads arrive (default: ~/var/data)')
+  argp.add_argument('--archive-dir',default=HOME+'var/archive/openwrt',
+                    help='root of the archive tree (default: ~/var/archive/openwrt)')
+  argp.add_argument('--min-age',type=int,default=300,
+                    help='skip archives modified in the last N seconds (default: 300)')
+  args = argp.parse_args()
+  LOG_DIR = 'var/log/'
+  FILE_LOG = LOG_DIR + 'xml_openwrt_parse_files'
+  FILE_LEDGER = LOG_DIR + 'ingest_ledger.sqlite'
+  FILE_METRICS = LOG_DIR + 'ingest_metrics.jsonl'
+  tables = {'measurement':'MEASUREMENTS','traceroute':'traceroutes','hop':'traceroute_hops'}
+  filelog = open(HOME+FILE_LOG,'a')
+  log = gz.open(HOME+LOG_DIR+'insert.log.gz','ab')
+  ledger = IngestLedger(HOME+FILE_LEDGER)
+  parser.metrics.start_run(HOME+FILE_METRICS,'ingest_uploads')
+
+  for fn in find_uploads(args.upload_dir,args.min_age):
+    process_upload(fn,tables,log,filelog,ledger,args.archive_dir,args.upload_dir)
+  print parser.row_mappers.report()
+  parser.metrics.end_run()
+  log.close()
+  filelog.close()
@@ -0,0 +1,324 @@
+#!/usr/bin/env python
+# Ingest daemon: watches the upload directories with inotify and ingests each
+# measurement file seconds after it is complete, instead of waiting for the
+# next parse.sh run.
+#
+# Three kinds of file are handled, the same way the batch scripts do:
+#
+#   xml      loose DEVICE_TS.xml files (parse_xml.py), archived gzipped after
+#   upload   uploaded .tgz archives (ingest_uploads.py), archived after
+#   tarball  */active/OW*/active* tarballs (parse_xml_tgz.py), left in place
+#
+# A file is complete when it is renamed into a watched directory, or when its
+# size has stopped changing for --settle seconds after it was last written.
+# Files are ingested one at a time in a worker thread that keeps the data DB
+# connection open between files. Everything is recorded in the ingest ledger
+# before a file is moved, and at startup (and every --rescan seconds, in case
+# inotify dropped events) the directories are scanned for files that are still
+# waiting, so a restart neither loses nor repeats work.
+#
+# Tarballs stay where they are after ingest, so the tarball tree holds every
+# one ever uploaded: only its */active/OW* and */active/DL* directories are
+# watched (new ones from the next rescan on), and the scans pass over tarballs
+# the ledger already has without queueing them. The XML and upload
+# directories are emptied as their files are archived and are watched whole.
+#
+# The daemon holds an flock on --lock while it runs, which parse.sh takes
+# around its own ingest steps, so the two never ingest at the same time.
+import os
+import fcntl
+import glob
+import time
+import fnmatch
+import argparse
+import gzip as gz
+
+from twisted.internet import reactor, inotify, threads, task
+from twisted.python.filepath import FilePath
+from twisted.python.threadpool import ThreadPool
+
+import parser
+import parse_xml
+import parse_xml_tgz
+import ingest_uploads
+from ledger import IngestLedger, HashingReader
+
+TARBALL_PATTERNS = ['*/active/OW*/active*','*/active/DL*/active*']
+TARBALL_DIRS = [os.path.dirname(p) for p in TARBALL_PATTERNS]
+WATCH_MASK = inotify.IN_CLOSE_WRITE | inotify.IN_MOVED_TO
+RETRY_DELAY = 60
+
+class IngestDaemon(object):
+  def __init__(self,args,tables,log,filelog):
+    self.args = args
+    self.tables = tables
+    self.log = log
+    self.filelog = filelog
+    self.ledger = None
+    # the reactor thread's own connection, for the scans
+    self.scan_ledger = None
+    self.notifier = None
+    self.watched = set()
+    self.missing = set()
+    self.settling = {}
+    self.queued = set()
+    self.queue = []
+    self.busy = False
+    # (size, mtime) of files finished while they stay in place (tarballs),
+    # so rescans don't queue them again
+    self.finished = {}
+    # one thread, so files are ingested serially on one DB connection
+    self.pool = ThreadPool(1,1,'ingest')
+
+  def roots(self):
+    # most specific kind first, as the directories may overlap
+    return ([('tarball',d) for d in self.args.tarball_dir] +
+            [('upload',d) for d in self.args.upload_dir] +
+            [('xml',d) for d in self.args.xml_dir])
+
+  def kind_of(self,path):
+    name = os.path.basename(path)
+    if name.endswith('.part') or name.startswith('.'):
+      return None
+    for kind,root in self.roots():
+      if not path.startswith(os.path.join(root,'')):
+        continue
+      if kind == 'tarball':
+        rel = os.path.relpath(path,root)
+        if [p for p in TARBALL_PATTERNS if fnmatch.fnmatch(rel,p)]:
+          return kind
+      elif kind == 'upload' and name.endswith('.tgz'):
+        return kind
+      elif kind == 'xml' and name.endswith('.xml') and not parse_xml.ignore_file(name):
+        return kind
+    return None
+
+  def incoming(self,kind,root):
+    # the directories files of a kind arrive in under root
+    if kind == 'tarball':
+      return sorted([d for p in TARBALL_DIRS for d in glob.glob(os.path.join(root,p))
+                     if os.path.isdir(d)])
+    return [root]
+
+  def watch(self):
+    # watches the incoming directories not watched yet
+    for kind,root in self.roots():
+      if not os.path.isdir(root):
+        if root not in self.missing:
+          print 'not watching %s: no such directory'%(root)
+          self.missing.add(root)
+        continue
+      self.missing.discard(root)
+      for path in self.incoming(kind,root):
+        if path in self.watched:
+          continue
+        self.notifier.watch(FilePath(path),mask=WATCH_MASK,autoAdd=True,
+                            recursive=(kind != 'tarball'),callbacks=[self.notify])
+        self.watched.add(path)
+        print 'watching %s for %s files'%(path,kind)
+
+  def start(self):
+    self.pool.start()
+    self.scan_ledger = IngestLedger(self.args.ledger)
+    self.notifier = inotify.INotify()
+    self.notifier.startReading()
+    self.rescan = task.LoopingCall(self.scan)
+    self.rescan.start(self.args.rescan,now=True)
+
+  def stop(self):
+    self.rescan.stop()
+    for call in self.settling.values():
+      call.cancel()
+    # waits for the file being ingested, if any, to finish
+    self.pool.stop()
+    self.scan_ledger.close()
+    print parser.row_mappers.report()
+    parser.metrics.end_run()
+
+  def scan(self):
+    self.watch()
+    for kind,root in self.roots():
+      for path in self.incoming(kind,root):
+        if kind == 'tarball':
+          names = [os.path.join(path,name) for name in os.listdir(path)]
+        else:
+          names = [os.path.join(dirpath,name) for dirpath,dirs,files in os.walk(path)
+                   for name in files]
+        for name in names:
+          if self.kind_of(name) == None or self.ingested(name):
+            continue
+          self.settle(name,None)
+
+  def ingested(self,path):
+    # tarballs the ledger has, unchanged, are only remembered in finished;
+    # the other kinds are moved once ingested, so are never seen again
+    if self.kind_of(path) != 'tarball' or path in self.queued:
+      return False
+    try:
+      st = os.stat(path)
+    except OSError:
+      return True
+    if self.finished.get(path) == (st.st_size,st.st_mtime):
+      return True
+    if self.scan_ledger.tarball_done(os.path.basename(path),st.st_size,int(st.st_mtime)):
+      self.finished[path] = (st.st_size,st.st_mtime)
+      return True
+    return False
+
+  def notify(self,ignored,filepath,mask):
+    path = filepath.path
+    if self.kind_of(path) == None:
+      return
+    if mask & inotify.IN_MOVED_TO:
+      # renamed into place, so it's already complete
+      if path in self.settling:
+        self.settling.pop(path).cancel()
+      self.enqueue(path)
+    else:
+      self.settle(path,None)
+
+  def settle(self,path,last_size):
+    if path in self.queued:
+      return
+    if last_size == None and path in self.settling:
+      return  # already being watched
+    self.settling.pop(path,None)
+    try:
+      st = os.stat(path)
+    except OSError:
+      return
+    size = st.st_size
+    if self.finished.get(path) == (size,st.st_mtime):
+      return
+    if size == last_size:
+      self.enqueue(path)
+    else:
+      self.settling[path] = reactor.callLater(self.args.settle,self.settle,path,size)
+
+  def enqueue(self,path):
+    if path in self.queued:
+      return
+    self.queued.add(path)
+    self.queue.append(path)
+    self.next()
+
+  def next(self):
+    if self.busy or len(self.queue) == 0:
+      return
+    path = self.queue.pop(0)
+    self.busy = True
+    start = time.time()
+    d = threads.deferToThreadPool(reactor,self.pool,self.ingest,path)
+    d.addCallbacks(self.done,self.failed,callbackArgs=(path,start),errbackArgs=(path,))
+
+  def done(self,result,path,start):
+    print '%s ingested in %.1fs'%(path,time.time() - start)
+    self.queued.discard(path)
+    try:
+      st = os.stat(path)
+      self.finished[path] = (st.st_size,st.st_mtime)
+    except OSError:
+      pass
+    self.busy = False
+    self.next()
+
+  def failed(self,failure,path):
+    # most likely the DB went away: reconnect and try again later
+    print 'failed to ingest %s: %s'%(path,failure.getErrorMessage())
+    self.log.write('Error ingesting %s\n%s\n'%(path,failure.getTraceback()))
+    self.busy = False
+    reactor.callLater(RETRY_DELAY,self.retry,path)
+    self.next()
+
+  def retry(self,path):
+    self.queued.discard(path)
+    if os.path.exists(path):
+      self.enqueue(path)
+
+  # The methods below run in the worker thread.
+
+  def ingest(self,path):
+    if self.ledger == None:
+      # sqlite connections belong to the thread that opened them
+      self.ledger = IngestLedger(self.args.ledger)
+    if not os.path.exists(path):
+      return
+    try:
+      kind = self.kind_of(path)
+      if kind == 'xml':
+        self.ingest_xml(path)
+      elif kind == 'upload':
+        ingest_uploads.process_upload(path,self.tables,self.log,self.filelog,
+                                      self.ledger,self.args.archive_dir,
+                                      os.path.dirname(path))
+      elif kind == 'tarball':
+        if not parse_xml_tgz.ignore_file(path,self.ledger):
+          parse_xml_tgz.ingest_tarball(path,self.tables,self.log,self.filelog,self.ledger)
+          self.log.write('Done ' + path + '\n')
+          parse_xml_tgz.mark_tarball_done(self.ledger,path)
+    except Exception:
+      parser.reset_conn()
+      raise
+    finally:
+      self.log.flush()
+      self.filelog.flush()
+
+  def ingest_xml(self,path):
+    name = os.path.basename(path)
+    st = os.stat(path)
+    if not self.ledger.tarball_done(name,st.st_size,int(st.st_mtime)):
+      self.filelog.write("%s\n"%(name))
+      fp = open(path)
+      reader = HashingReader(fp)
+      parser.parsefile(reader,name,self.tables,self.log)
+      fp.close()
+      self.ledger.mark_tarball(name,path,st.st_size,int(st.st_mtime),reader.hexdigest())
+      self.log.write('Done ' + name + '\n')
+    parse_xml.move_file(path,self.args.xml_archive_dir)
+
+if __name__ == '__main__':
+  HOME = os.environ['HOME'] + '/'
+  argp = argparse.ArgumentParser(description='Ingest measurement uploads as they arrive')
+  argp.add_argument('--xml-dir',action='append',default=[],
+                    help='directory of loose XML files (repeatable)')
+  argp.add_argument('--upload-dir',action='append',default=[],
+                    help='directory of uploaded .tgz archives (repeatable)')
+  argp.add_argument('--tarball-dir',action='append',default=[],
+                    help='root of the */active/OW*/active* tarball tree (repeatable)')
+  argp.add_argument('--archive-dir',default=HOME+'var/archive/openwrt',
+                    help='archive tree for uploads (default: ~/var/archive/openwrt)')
+  argp.add_argument('--xml-archive-dir',default=HOME+'var/archive/openwrt',
+                    help='where parsed XML files go (default: ~/var/archive/openwrt)')
+  argp.add_argument('--ledger',default=HOME+'var/log/ingest_ledger.sqlite')
+  argp.add_argument('--lock',default=HOME+'var/run/ingest.lock',
+                    help='lock shared with parse.sh (default: ~/var/run/ingest.lock)')
+  argp.add_argument('--settle',type=float,default=5,
+                    help='seconds a file size must hold still (default: 5)')
+  argp.add_argument('--rescan',type=float,default=600,
+                    help='seconds between full directory scans (default: 600)')
+  args = argp.parse_args()
+  for name in ('xml_dir','upload_dir','tarball_dir'):
+    setattr(args,name,[os.path.abspath(d) for d in getattr(args,name)])
+  if not (args.xml_dir or args.upload_dir or args.tarball_dir):
+    argp.error('nothing to watch')
+
+  lock = open(args.lock,'a')
+  try:
+    fcntl.flock(lock,fcntl.LOCK_EX|fcntl.LOCK_NB)
+  except IOError:
+    print 'waiting for %s: parse.sh is ingesting'%(args.lock)
+    fcntl.flock(lock,fcntl.LOCK_EX)
+
+  LOG_DIR = 'var/log/'
+  FILE_LOG = LOG_DIR + 'xml_openwrt_parse_files'
+  FILE_METRICS = LOG_DIR + 'ingest_metrics.jsonl'
+  tables = {'measurement':'MEASUREMENTS','traceroute':'traceroutes','hop':'traceroute_hops'}
+  filelog = open(HOME+FILE_LOG,'a')
+  log = gz.open(HOME+LOG_DIR+'insert.log.gz','ab')
+  parser.metrics.start_run(HOME+FILE_METRICS,'ingestd')
+  daemon = IngestDaemon(args,tables,log,filelog)
+  reactor.addSystemEventTrigger('after','startup',daemon.start)
+  reactor.addSystemEventTrigger('before','shutdown',daemon.stop)
+  reactor.run()
+  log.close()
+  filelog.close()
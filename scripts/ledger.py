@@ -0,0 +1,134 @@
+#!/usr/bin/env python
+# Ingest ledger: records which tarballs, and which members inside them, have
+# been committed to the data DB. It replaces the dbhash parsed_files.db, which
+# only knew about whole tarballs, so a crash halfway through a tarball no
+# longer re-ingests the members that were already written.
+#
+# The ledger is a SQLite database in WAL mode, so parse_xml_tgz.py workers can
+# record members concurrently while the parent records finished tarballs.
+import os
+import sys
+import time
+import hashlib
+import sqlite3
+
+SCHEMA = [
+  '''CREATE TABLE IF NOT EXISTS tarballs (
+       name     text PRIMARY KEY,
+       path     text,
+       size     integer,
+       mtime    integer,
+       sha1     text,
+       done_at  real
+     )''',
+  '''CREATE TABLE IF NOT EXISTS members (
+       tarball  text NOT NULL,
+       member   text NOT NULL,
+       size     integer,
+       mtime    integer,
+       sha1     text,
+       done_at  real NOT NULL,
+       PRIMARY KEY (tarball, member)
+     )''',
+]
+
+def file_sha1(path,bufsize=1<<16):
+  h = hashlib.sha1()
+  fp = open(path,'rb')
+  while True:
+    buf = fp.read(bufsize)
+    if not buf:
+      break
+    h.update(buf)
+  fp.close()
+  return h.hexdigest()
+
+# Wraps a file object so that whatever is read from it, by lines or blocks,
+# also feeds a sha1.
+class HashingReader(object):
+  def __init__(self,fp):
+    self.fp = fp
+    self.sha1 = hashlib.sha1()
+
+  def __iter__(self):
+    for line in self.fp:
+      self.sha1.update(line)
+      yield line
+
+  def read(self,size=-1):
+    buf = self.fp.read(size)
+    self.sha1.update(buf)
+    return buf
+
+  def hexdigest(self):
+    return self.sha1.hexdigest()
+
+class IngestLedger(object):
+  def __init__(self,path,timeout=60):
+    self.path = path
+    self.db = sqlite3.connect(path,timeout=timeout)
+    self.db.execute('PRAGMA journal_mode=WAL')
+    self.db.execute('PRAGMA synchronous=NORMAL')
+    for stmt in SCHEMA:
+      self.db.execute(stmt)
+    self.db.commit()
+
+  def close(self):
+    self.db.close()
+
+  def tarball_done(self,name,size=None,mtime=None):
+    # Entries imported from parsed_files.db carry no size/mtime and are
+    # trusted by name alone, as before.
+    row = self.db.execute('SELECT size,mtime,done_at FROM tarballs WHERE name=?',
+                          (name,)).fetchone()
+    if row == None or row[2] == None:
+      return False
+    if row[0] == None:
+      return True
+    return row[0] == size and row[1] == mtime
+
+  def members_done(self,tarball):
+    done = {}
+    for member,size,mtime in self.db.execute(
+        'SELECT member,size,mtime FROM members WHERE tarball=?',(tarball,)):
+      done[member] = (size,mtime)
+    return done
+
+  def mark_member(self,tarball,member,size,mtime,sha1):
+    self.db.execute('INSERT OR REPLACE INTO members '
+                    '(tarball,member,size,mtime,sha1,done_at) '
+                    'VALUES (?,?,?,?,?,?)',
+                    (tarball,member,size,mtime,sha1,time.time()))
+    self.db.commit()
+
+  def mark_tarball(self,name,path,size,mtime,sha1):
+    self.db.execute('INSERT OR REPLACE INTO tarballs '
+                    '(name,path,size,mtime,sha1,done_at) '
+                    'VALUES (?,?,?,?,?,?)',
+                    (name,path,size,mtime,sha1,time.time()))
+    self.db.commit()
+
+  def is_empty(self):
+    return self.db.execute('SELECT count(*) FROM tarballs').fetchone()[0] == 0
+
+  def import_parsed_files(self,parseddb):
+    # one-off migration of the old dbhash parsed_files.db
+    try:
+      import dbhash as db
+    except ImportError:
+      print 'dbhash not available, not importing %s'%(parseddb)
+      return 0
+    obj = db.open(parseddb,'r')
+    names = obj.keys()
+    obj.close()
+    now = time.time()
+    self.db.executemany('INSERT OR IGNORE INTO tarballs (name,done_at) VALUES (?,?)',
+                        [(name,now) for name in names])
+    self.db.commit()
+    return len(names)
+
+if __name__ == '__main__':
+  if len(sys.argv) != 4 or sys.argv[1] != 'import':
+    sys.exit('USAGE: %s import parsed_files.db ledger.sqlite'%(sys.argv[0]))
+  ledger = IngestLedger(sys.argv[3])
+  print 'imported %d tarballs'%(ledger.import_parsed_files(sys.argv[2]))
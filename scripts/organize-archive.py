@@ -8,44 +8,7 @@ import datetime
 import shutil
 import tarfile
 
-
-def filename_to_dir(file):
-
-    types = {'arp.gz':'arp',
-             'csv':'airodump',
-             'csv.gz':'airodump',
-             'events.gz':'events',
-             'filt.csv':'airodump',
-             'xml.gz':'active'}
-
-    # get device name
-    match = re.search(r'[0-9A-Za-z]+',file)
-    if match:
-        dev_name = match.group()
-    else:
-        return ''
-            
-    # get date
-    match = re.search(r'([0-9]{9,10})',file)
-    if match:
-        timestr = match.group(1)
-        date = datetime.date.fromtimestamp(float(timestr))
-        datedir = str(date.year) + '/' + str(date.month)
-    else:
-        return ''
-
-
-    # get type
-    match = re.search(r'.*?[0-9]\.(.*)$',file)
-    if match:
-        extension = match.group(1)
-        typedir = types[extension]
-    else:
-        return ''
-
-
-    return dev_name + '/' + typedir + '/'+ datedir
-
+from archive_layout import filename_to_dir, move_into
 
 
 def clean_data(dir,targetdir):
@@ -91,38 +54,44 @@ def new_device_files(members,device,pubdir):
             yield tarinfo
         
 
-def unpack_backup(device,dir,tmpdir,pubdir):
+def publish_member(tar,tarinfo,pubdir):
+    # stream one member straight to its place in the published tree
+    src = tar.extractfile(tarinfo)
+    if src is None:
+        return
+    datadir = pubdir + filename_to_dir(tarinfo.name)
+    if re.search(r'[Uu]ky',tarinfo.name):
+        datadir = os.environ['HOME'] + '/var/archive/UKY-old'
+    if not os.path.exists(datadir):
+        os.makedirs(datadir)
+    tfile = datadir + '/' + os.path.basename(tarinfo.name)
+    dst = open(tfile + '.part','wb')
+    shutil.copyfileobj(src,dst)
+    dst.close()
+    os.utime(tfile + '.part',(tarinfo.mtime,tarinfo.mtime))
+    move_into(tfile + '.part',tfile)
+    print tarinfo.name + '->' + datadir
+
+def unpack_backup(device,dir,pubdir):
 
     # get the tarfiles in the archive
     files = os.listdir(dir)
     for file in files:
-        
-        # make a directory to unpack the tarfile
-        try: 
-            os.mkdir(tmpdir)
-        except OSError:
-            pass
 
         # look for the active measurement files
         match = re.search(r'xml.tgz',file)
         if match:
-            # unpack into the unpack dir
             print file
             try:
                 tar = tarfile.open(dir+file,'r:gz')
 
-                # unpack all device files that aren't yet published into the unpack dir
-                tar.extractall(tmpdir,members=new_device_files(tar,device,pubdir))
+                # publish all device files that aren't yet published
+                for tarinfo in list(new_device_files(tar,device,pubdir)):
+                    publish_member(tar,tarinfo,pubdir)
                 tar.close()
             except tarfile.ReadError:
                 print "Warning Read Error"
 
-        # publish the data with the correct directory structure
-        clean_data(tmpdir,pubdir)
-        
-        # remove the temporary dir
-        shutil.rmtree(tmpdir)
-
 
 if __name__ == '__main__':
     HOME = os.environ['HOME'] + '/'
@@ -130,9 +99,8 @@ if __name__ == '__main__':
 
     ARCHIVE_DIR = HOME + MEASURE_FILE_DIR + 'old/'
     BACKUP_DIR = HOME + 'var/backup/'
-    UNPACK_DIR = '/data/bismark/unpack/'
 
     PUBLISH_DIR = '/data/bismark/public/'
 
     # restore directory structure from backup
-    unpack_backup('NB105',BACKUP_DIR,UNPACK_DIR,PUBLISH_DIR)    
+    unpack_backup('NB105',BACKUP_DIR,PUBLISH_DIR)    
@@ -1,6 +1,8 @@
 #!/usr/bin/env bash
 
 pidfile=/home/bismark/var/run/parser_pid
+# held by ingestd while it runs
+ingestlock=/home/bismark/var/run/ingest.lock
 #activedir=/home/bismark/var/data/http_uploads/active
 activedir="/data/bismark/http_uploads/active"
 datadir=/home/bismark/var/data
@@ -8,6 +10,7 @@ datadir=/home/bismark/var/data
 # Load local db config file (contains passwords, etc.)
 . ~/etc/bdm_db.conf
 . ~/etc/parser.conf
+export BDM_TRACEROUTE_DIR=${BDM_TRACEROUTE_DIR:-/home/bismark/var/traceroutes}
 
 if [ -e $pidfile ]; then
 	echo "parser running"
@@ -15,16 +18,23 @@ if [ -e $pidfile ]; then
 fi
 echo $$ > $pidfile
 echo "run"
-#for i in "$activedir"/OW*; do mv $i/OW* ~/var/data/; done
-for i in $activedir; do 
-	echo "activedir" $i
-	find $i -name "*.xml" -mmin +5 | while read -r f; do
-		mv $f $datadir
+# ingestd, when it is running, ingests uploads as they arrive; holding its
+# lock keeps it from starting until the steps below are done
+exec 9>>$ingestlock
+if ! flock -n 9; then
+	echo "ingestd running, skipping ingest"
+else
+	#for i in "$activedir"/OW*; do mv $i/OW* ~/var/data/; done
+	for i in $activedir; do 
+		echo "activedir" $i
+		find $i -name "*.xml" -mmin +5 | while read -r f; do
+			mv $f $datadir
+		done
+		#ls $i/OW*/OW* $datadir
 	done
-	#ls $i/OW*/OW* $datadir
-done
-sleep 5
-~/bin/parse_xml.py > ~/var/log/last_xml_openwrt_parse.log 2>~/var/log/last_xml_openwrt_parse_error.log
-~/bin/parse_xml_tgz.py >> ~/var/log/last_xml_openwrt_parse.log 2>>~/var/log/last_xml_openwrt_parse_error.log
-~/bin/fixup_klatch_direction_column.py > ~/var/log/fixup_klatch_direction_column.log 2>&1
+	sleep 5
+	~/bin/ingest_uploads.py > ~/var/log/last_ingest_uploads.log 2>~/var/log/last_ingest_uploads_error.log
+	~/bin/parse_xml.py > ~/var/log/last_xml_openwrt_parse.log 2>~/var/log/last_xml_openwrt_parse_error.log
+	~/bin/parse_xml_tgz.py --jobs ${PARSE_JOBS:-1} >> ~/var/log/last_xml_openwrt_parse.log 2>>~/var/log/last_xml_openwrt_parse_error.log
+fi
 rm $pidfile
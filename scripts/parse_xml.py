@@ -4,16 +4,21 @@ import sys
 import subprocess as sub
 import gzip as gz
 import time
+import shutil
 import pgsql as sql
-import bsdtr
+import trstore
 from parser import *
 
 def move_file(file,dir):
-  cmd = ['gzip',file]
-  sub.Popen(cmd).communicate()
-  zfile = file + '.gz'
-  cmd = ['mv',zfile,dir]
-  sub.Popen(cmd).communicate()
+  # compress straight into the archive, rather than gzip in place and mv
+  zfile = os.path.join(dir,os.path.basename(file) + '.gz')
+  src = open(file,'rb')
+  dst = gz.open(zfile + '.part','wb')
+  shutil.copyfileobj(src,dst)
+  dst.close()
+  src.close()
+  os.rename(zfile + '.part',zfile)
+  os.remove(file)
 
 def ignore_file(file):
   if '.xml' not in file:
@@ -30,10 +35,12 @@ if __name__ == '__main__':
   LOG_DIR = 'var/log/'
   ARCHIVE_DIR = 'var/archive/openwrt'
   FILE_LOG = LOG_DIR + 'xml_openwrt_parse_files'
+  FILE_METRICS = LOG_DIR + 'ingest_metrics.jsonl'
   tables = {'measurement':'MEASUREMENTS','traceroute':'traceroutes','hop':'traceroute_hops'}
 
   filelog = open(HOME+FILE_LOG,'w')
   log = gz.open(HOME+LOG_DIR+'insert.log.gz','ab')
+  metrics.start_run(HOME+FILE_METRICS,'parse_xml')
   files = os.listdir(HOME+MEASURE_FILE_DIR)
   fcnt = 0
   for file in files:
@@ -49,6 +56,8 @@ if __name__ == '__main__':
     move_file(HOME+MEASURE_FILE_DIR+file,HOME+ARCHIVE_DIR)
     if fcnt < -1:
       sys.exit()
+  print row_mappers.report()
+  metrics.end_run()
   log.close()
   filelog.close()
 
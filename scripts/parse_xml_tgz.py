@@ -5,30 +5,156 @@ import subprocess as sub
 import gzip as gz
 import time
 import pgsql as sql
-import bsdtr
+import trstore
 import tarfile
 import glob
+import argparse
+import multiprocessing
+import traceback
+import Queue
+from cStringIO import StringIO
 from parser import *
+import parser
+from ledger import IngestLedger, HashingReader, file_sha1
 
-def ignore_file(fname,parsed_files):
-  if os.path.basename(fname) in parsed_files:
-   return True
+def ignore_file(fname,ledger):
   if 'active' not in fname:
     return True
+  # a stat is enough to skip tarballs that are already done and unchanged
+  st = os.stat(fname)
+  if ledger.tarball_done(os.path.basename(fname),st.st_size,int(st.st_mtime)):
+    return True
   #if 'OW' not in fname:
   #   return True
   #if 'OW_' in fname:
   #  return True
   return False
 
-def get_parsed_files(parseddb):
-  import dbhash as db
-  obj = db.open(parseddb,'w')
-  return obj
+def mark_tarball_done(ledger,fn):
+  st = os.stat(fn)
+  ledger.mark_tarball(os.path.basename(fn),fn,st.st_size,int(st.st_mtime),file_sha1(fn))
+
+def ingest_tarball(fn,tables,log,filelog,ledger):
+  # Members are recorded in the ledger once their rows are committed (parsefile
+  # flushes at the end of each file), so a rerun after a crash resumes at the
+  # first member that wasn't finished.
+  name = os.path.basename(fn)
+  done = ledger.members_done(name)
+  f1 = tarfile.open(fn)
+  fm1 = f1.getmembers() 
+  print 'tarfile:',fn
+  for tf in fm1:
+    fname = tf.name
+    if done.get(fname) == (tf.size,int(tf.mtime)):
+      continue
+    filelog.write("%s\n"%(fname))
+    file = f1.extractfile(tf)
+    if file == None:
+      continue
+    print fname
+    reader = HashingReader(file)
+    parsefile(reader,fname,tables,log)
+    ledger.mark_member(name,fname,tf.size,int(tf.mtime),reader.hexdigest())
+  f1.close()
+
+def ingest_worker(task_q,result_q,tables,ledger_path):
+  # Each worker process opens its own DB connection (on first use, see
+  # parser.get_conn) and ledger connection, and ingests whole tarballs handed
+  # out by the parent. Log lines are buffered and sent back with the result,
+  # so that only the parent writes to insert.log.gz.
+  ledger = IngestLedger(ledger_path)
+  pid = os.getpid()
+  while True:
+    fn = task_q.get()
+    if fn == None:
+      print '[%d] %s'%(pid,parser.row_mappers.report())
+      break
+    log = StringIO()
+    filelog = StringIO()
+    try:
+      ingest_tarball(fn,tables,log,filelog,ledger)
+      result_q.put(('done',pid,fn,log.getvalue(),filelog.getvalue()))
+    except Exception:
+      parser.reset_conn()
+      log.write('Error ingesting %s\n%s'%(fn,traceback.format_exc()))
+      result_q.put(('failed',pid,fn,log.getvalue(),filelog.getvalue()))
+
+def run_parallel(files,jobs,tables,log,filelog,ledger):
+  # The parent hands out one tarball at a time to each worker and is the only
+  # process that marks whole tarballs as parsed, after the worker reports that
+  # all of its members were committed. A worker that dies mid-tarball leaves that
+  # tarball unmarked, and is replaced if there is work left.
+  result_q = multiprocessing.Queue()
+  workers = {}
+  in_flight = {}
+  files = list(files)
+  files.reverse()
+
+  def spawn():
+    task_q = multiprocessing.Queue()
+    p = multiprocessing.Process(target=ingest_worker,
+                                args=(task_q,result_q,tables,ledger.path))
+    p.start()
+    workers[p.pid] = (p,task_q)
+    return p.pid
+
+  def assign(pid):
+    if len(files) > 0:
+      fn = files.pop()
+      in_flight[pid] = fn
+      workers[pid][1].put(fn)
+    else:
+      workers[pid][1].put(None)
+
+  def handle(result):
+    kind,pid,fn,logtext,filelogtext = result
+    if in_flight.get(pid) != fn:
+      return
+    del in_flight[pid]
+    log.write(logtext)
+    filelog.write(filelogtext)
+    if kind == 'done':
+      log.write('Done ' + fn + '\n')
+      mark_tarball_done(ledger,fn)
+    else:
+      print 'failed:',fn
+    assign(pid)
+
+  for i in range(0,min(jobs,len(files))):
+    assign(spawn())
+  while len(in_flight) > 0:
+    try:
+      handle(result_q.get(timeout=1))
+      continue
+    except Queue.Empty:
+      pass
+    for pid in in_flight.keys():
+      p = workers[pid][0]
+      if p.is_alive():
+        continue
+      # drain results the worker sent before exiting
+      try:
+        while True:
+          handle(result_q.get_nowait())
+      except Queue.Empty:
+        pass
+      if pid in in_flight:
+        fn = in_flight.pop(pid)
+        log.write('Worker %d exited (%s) while ingesting %s\n'%(pid,p.exitcode,fn))
+        print 'worker %d died while ingesting %s'%(pid,fn)
+        del workers[pid]
+        if len(files) > 0:
+          assign(spawn())
+  for pid in workers:
+    workers[pid][0].join()
 
 if __name__ == '__main__':
   HOME = os.environ['HOME'] + '/'
   #MEASURE_FILE_DIR = 'var/data/'
+  argp = argparse.ArgumentParser(description='Ingest active measurement tarballs')
+  argp.add_argument('-j','--jobs',type=int,default=1,
+                    help='number of tarballs to ingest in parallel (default: 1)')
+  args = argp.parse_args()
   try:
     MEASURE_FILE_DIR = os.environ['MEASURE_FILE_DIR']
   except:
@@ -36,9 +162,13 @@ if __name__ == '__main__':
   LOG_DIR = 'var/log/'
   FILE_LOG = LOG_DIR + 'xml_openwrt_parse_files'
   FILE_PARSED_DB = LOG_DIR + 'parsed_files.db'
+  FILE_LEDGER = LOG_DIR + 'ingest_ledger.sqlite'
+  FILE_METRICS = LOG_DIR + 'ingest_metrics.jsonl'
   tables = {'measurement':'MEASUREMENTS','traceroute':'traceroutes','hop':'traceroute_hops'}
   filelog = open(HOME+FILE_LOG,'w')
   log = gz.open(HOME+LOG_DIR+'insert.log.gz','ab')
+  # workers inherit the open metrics file and write their own file lines
+  parser.metrics.start_run(HOME+FILE_METRICS,'parse_xml_tgz')
 #  files = sub.Popen(['find',MEASURE_FILE_DIR,'-type','f'],stdout=sub.PIPE).communicate()
   files_ow = glob.glob(os.path.join(MEASURE_FILE_DIR,"*/active/OW*/active*"))
   files_dl = glob.glob(os.path.join(MEASURE_FILE_DIR,"*/active/DL*/active*"))
@@ -51,25 +181,23 @@ if __name__ == '__main__':
 
   files = files_ow + files_dl
 
-  parsed_files = get_parsed_files(HOME+FILE_PARSED_DB)
-  for fn in files:
-    if ignore_file(fn,parsed_files) == True:
-      continue
-    f1 = tarfile.open(fn)
-    fm1 = f1.getmembers() 
-    print 'tarfile:',fn
-    for tf in fm1:
-      fname = tf.name
-      filelog.write("%s\n"%(fname))
-      file = f1.extractfile(tf)
-      print fname
-      parsefile(file,fname,tables,log)
-    log.write('Done ' + fn + '\n')
-    parsed_files[os.path.basename(fn)] = ''
-    parsed_files.sync()
-    #move_file(HOME+MEASURE_FILE_DIR+file,HOME+ARCHIVE_DIR)
-    fcnt += 1
-    if fcnt < -1:
-      sys.exit()
+  ledger = IngestLedger(HOME+FILE_LEDGER)
+  if ledger.is_empty() and os.path.exists(HOME+FILE_PARSED_DB):
+    print 'imported %d tarballs from %s'%(
+          ledger.import_parsed_files(HOME+FILE_PARSED_DB),FILE_PARSED_DB)
+  files = [fn for fn in files if ignore_file(fn,ledger) == False]
+  if args.jobs > 1:
+    run_parallel(files,args.jobs,tables,log,filelog,ledger)
+  else:
+    for fn in files:
+      ingest_tarball(fn,tables,log,filelog,ledger)
+      log.write('Done ' + fn + '\n')
+      mark_tarball_done(ledger,fn)
+      #move_file(HOME+MEASURE_FILE_DIR+file,HOME+ARCHIVE_DIR)
+      fcnt += 1
+      if fcnt < -1:
+        sys.exit()
+    print parser.row_mappers.report()
+  parser.metrics.end_run(jobs=args.jobs)
   log.close()
   filelog.close()
@@ -4,29 +4,111 @@ import sys
 import subprocess as sub
 import gzip as gz
 import time
+import xml.parsers.expat
 import pgsql as sql
-import bsdtr
+import trstore
+import ingest_metrics
 
-conn = sql.sqlconn()
+# The data DB connection is opened on first use, so that processes forked
+# after importing this module each get their own.
+conn = None
 traceroutearr = {}
-bsdtr.init()
+trstore.init()
+# per-file stage timings and counts; written out once a script calls
+# metrics.start_run (see ingest_metrics.py)
+metrics = ingest_metrics.IngestMetrics()
 
-def get_fields(line):
-  skey = ''
-  if '/>' in line:
-    skey = '/>'
-  else:
-    skey = '>'
+def get_conn():
+  global conn
+  if conn == None:
+    conn = sql.sqlconn()
+  return conn
 
-  try:
-    line = line.split('<')[1]
-  except:
-    return None
-  line = line.split(skey)[0]
-  line = line.replace("'","")
-  line = line.replace('"','')
-  val = line.split()
-  return val
+def reset_conn():
+  global conn,pending_rows,pending_count,uncommitted,traceroutearr
+  if conn != None:
+    sql.staging_tables.pop(id(conn),None)
+    sql.summary_disabled.discard(id(conn))
+    try:
+      conn.connection.close()
+    except:
+      pass
+  conn = None
+  pending_rows = {}
+  pending_count = 0
+  uncommitted = False
+  traceroutearr = {}
+
+START_BLOCK = '<measurements'
+END_BLOCK = '</measurements'
+SUPPORTED_VERSIONS = ('1.0','1.2','1.3')
+
+# Typed records produced by the block parser. attrs holds the tag attributes
+# exactly as they appear in the file (values are strings).
+class Record(object):
+  kind = None
+  def __init__(self,attrs,kind=None):
+    self.attrs = attrs
+    if kind != None:
+      self.kind = kind
+
+class Info(Record):
+  kind = 'info'
+
+class Measurement(Record):
+  kind = 'measurement'
+
+class Traceroute(Record):
+  kind = 'traceroute'
+  def __init__(self,attrs):
+    Record.__init__(self,attrs)
+    self.hops = []
+
+class Hop(Record):
+  kind = 'hop'
+  def __init__(self,attrs,traceroute,ttid):
+    Record.__init__(self,attrs)
+    self.traceroute = traceroute
+    self.ttid = ttid
+
+RECORD_TYPES = {'info':Info,'measurement':Measurement}
+
+# One <measurements> element. lines is the raw text of the block, kept so a
+# bad block can be logged; error is set if the block is not well-formed.
+class MeasurementBlock(object):
+  def __init__(self,lines,lineno):
+    self.lines = lines
+    self.lineno = lineno
+    self.version = None
+    self.records = []
+    self.traceroutes = []
+    self.error = None
+
+  def start_element(self,name,attrs):
+    if name == 'measurements':
+      self.version = attrs.get('version')
+    elif name == 'traceroute':
+      rec = Traceroute(attrs)
+      self.traceroutes.append(rec)
+      self.records.append(rec)
+    elif name == 'hop':
+      if len(self.traceroutes) == 0:
+        raise ValueError('hop outside of a traceroute')
+      rec = Hop(attrs,self.traceroutes[-1],len(self.traceroutes)-1)
+      self.traceroutes[-1].hops.append(rec)
+      self.records.append(rec)
+    else:
+      self.records.append(RECORD_TYPES.get(name,Record)(attrs,name))
+
+  def data(self):
+    # dict of record lists keyed by tag, the layout write_block_v1_0 expects
+    data = {}
+    for rec in self.records:
+      tuple = dict(rec.attrs)
+      if rec.kind == 'hop':
+        tuple['ttid'] = rec.ttid
+      data.setdefault(rec.kind,[]).append(tuple)
+    return data
 
 def get_measurement_params(fids,vals,arr):
   #print arr
@@ -55,23 +137,6 @@ def modify_fid(fid,table):
       return 'median'
   return fid
 
-def modify_val(fid,val):
-  nstr = '%s'
-  nval = val
-  if val == '':
-    nval = 'NULL'
-  #nval = "'" + val + "'"
-  if fid  == 'timestamp':
-    nstr = 'to_timestamp(%s)'#%(val)
-  if fid  == 'deviceid':
-    nval = '%s'%(val[-12:])
- #if fid in ['deviceid','param','tool']:
-  #  nval = '"' + val + '"'
-  #else:
-    #if fid in ['srcip','dstip','ip']:
-    #  nval = 'INET_ATON("' + val + '")'
-  return nstr,nval
-
 def get_tool_info(tool):
   cmd = 'select id from tools where tool = "%s"'%(tool)
   #res = sql.run_sql_cmd(cmd)
@@ -79,38 +144,181 @@ def get_tool_info(tool):
   #return 'asdasd'
   return tool
   
-def form_insert_cmd(table,fids,vals):
-  if table.lower() == 'measurements':
+# Measurements whose direction (up: device to mserver, dw: mserver to device)
+# is worked out from which end is a measurement server when the record
+# doesn't say.
+DIRECTION_PARAMS = ('bitrate','capacity','jitter','pktloss','shaperate')
+MSERVER_IPS_TTL = 1800
+
+class MserverIPs(object):
+  # The mserver addresses from the management DB, reloaded every ttl seconds
+  # so a long-running ingest picks up new servers. If the management DB can't
+  # be reached the last list is kept (rows get no direction until the first
+  # successful load; fixup_klatch_direction_column.py --since fills those in,
+  # a plain rerun skips them if they're behind its watermark).
+  def __init__(self,ttl=MSERVER_IPS_TTL):
+    self.ttl = ttl
+    self.ips = None
+    self.loaded = 0
+
+  def get(self):
+    now = time.time()
+    if self.ips == None or now - self.loaded >= self.ttl:
+      try:
+        self.ips = sql.mserver_ips()
+      except Exception as e:
+        print 'Could not load mserver addresses: %s'%(e)
+        if self.ips == None:
+          self.ips = frozenset()
+      self.loaded = now
+    return self.ips
+
+  def direction(self,srcip,dstip):
+    ips = self.get()
+    if dstip in ips:
+      return 'up'
+    if srcip in ips:
+      return 'dw'
+    return None
+
+mserver_ips = MserverIPs()
+
+# Compiled form of form_row's mapping for one (table, param, field list).
+# Records written by the same firmware carry the same fields in the same
+# order, so a handful of mappers serve a whole upload and each record is
+# mapped with one pass over precomputed positions.
+class RowMapper(object):
+  def __init__(self,table,param,fids):
+    self.ntab = '%s_%s'%(table.lower()[0],param.lower())
     tabfid = fids.index('param')
-    ntab = '%s_%s'%(table.lower()[0],vals[tabfid].lower())
-    fids.pop(tabfid)
-    vals.pop(tabfid)
-    toolind = fids.index('tool')
-    tool = vals[toolind]
-    toolid = get_tool_info(tool)
-    fids[toolind] = 'toolid'
-    vals[toolind] = toolid
-  else:
-    ntab = table
-  cmd = 'INSERT into ' + ntab + '('
-  if 'traceroute' not in table:
-    cmd += 'exitstatus,'
-  for fid in fids:
-    fid = modify_fid(fid,table)
-    cmd += fid + ","
-  cmd = cmd[0:len(cmd)-1]
-  cmd += ') SELECT '
-  if 'traceroute' not in table:
-    cmd += '0,'
-  cvals = []
-  for val in vals:
-    ind = vals.index(val)
-    nstr,nval = modify_val(fids[ind],val)
-    cmd += nstr + ","
-    cvals.append(nval)
-  cmd = cmd[0:len(cmd)-1]
-  #print cmd
-  return cmd,cvals
+    cols = ['exitstatus']
+    self.fields = []
+    for i in range(0,len(fids)):
+      if i == tabfid:
+        continue
+      fid = fids[i]
+      if fid == 'tool':
+        conv = get_tool_info
+        fid = 'toolid'
+      elif fid == 'deviceid':
+        conv = lambda val: val[-12:]
+      else:
+        conv = None
+      cols.append(modify_fid(fid,table))
+      self.fields.append((i,conv))
+    # positions of the columns that feed the digest, in digest order
+    self.digest_order = sorted([(col,pos) for pos,col in enumerate(cols)
+                                if col not in sql.DIGEST_SKIP_COLS])
+    # (direction, srcip, dstip) positions for records whose direction is
+    # filled in from the mserver addresses; the direction column is added
+    # if the record has none
+    self.direction = None
+    if param.lower() in DIRECTION_PARAMS and 'srcip' in cols and 'dstip' in cols:
+      if 'direction' not in cols:
+        cols.append('direction')
+      self.direction = (cols.index('direction'),cols.index('srcip'),cols.index('dstip'))
+    cols.append('digest')
+    self.cols = tuple(cols)
+
+  def row(self,vals):
+    cvals = [0]
+    for i,conv in self.fields:
+      if conv == None:
+        cvals.append(vals[i])
+      else:
+        cvals.append(conv(vals[i]))
+    # the digest never covers direction (see pgsql.DIGEST_SKIP_COLS), which
+    # is filled in here when the record has none
+    digest = sql.digest_pairs(self.ntab,[(col,cvals[pos]) for col,pos in self.digest_order])
+    if self.direction != None:
+      dirpos,srcpos,dstpos = self.direction
+      if dirpos == len(cvals):
+        cvals.append(None)
+      if cvals[dirpos] in (None,''):
+        cvals[dirpos] = mserver_ips.direction(cvals[srcpos],cvals[dstpos])
+    cvals.append(digest)
+    return self.ntab,self.cols,tuple(cvals)
+
+class MapperCache(object):
+  def __init__(self):
+    self.mappers = {}
+    self.hits = 0
+    self.misses = 0
+
+  def get(self,table,param,fids):
+    key = (table,param,tuple(fids))
+    mapper = self.mappers.get(key)
+    if mapper == None:
+      self.misses += 1
+      mapper = self.mappers[key] = RowMapper(table,param,fids)
+    else:
+      self.hits += 1
+    return mapper
+
+  def hit_rate(self):
+    total = self.hits + self.misses
+    return float(self.hits)/total if total > 0 else 0.0
+
+  def report(self):
+    # tables that needed more than one field list point at firmware versions
+    # writing different record layouts
+    layouts = {}
+    for mapper in self.mappers.values():
+      layouts.setdefault(mapper.ntab,set()).add(mapper.cols)
+    lines = ['row mappers: %d for %d tables, hit rate %.2f%% (%d hits, %d misses)'%(
+             len(self.mappers),len(layouts),100*self.hit_rate(),self.hits,self.misses)]
+    for ntab in sorted(layouts):
+      if len(layouts[ntab]) > 1:
+        lines.append('  %s: %d field layouts'%(ntab,len(layouts[ntab])))
+    return '\n'.join(lines)
+
+row_mappers = MapperCache()
+
+def form_row(table,fids,vals):
+  # Maps a measurement record to the target table, column names and raw
+  # values for the bulk loader (timestamps stay epoch seconds,
+  # empty values become NULL in pgsql.copy_rows). The last column is the
+  # row's digest, which copy_rows uses to skip rows it has already loaded.
+  param = vals[fids.index('param')]
+  return row_mappers.get(table,param,fids).row(vals)
+
+pending_rows = {}
+pending_count = 0
+uncommitted = False
+BULK_FLUSH_ROWS = 5000
+
+def queue_rows(rows):
+  global pending_count
+  for ntab,cols,cvals in rows:
+    pending_rows.setdefault((ntab,cols),[]).append(cvals)
+  pending_count += len(rows)
+
+def flush_rows(log=None,commit=True):
+  # writes out the queued measurement rows and traceroutes as one batch each;
+  # with commit=False the rows stay uncommitted until a later flush
+  global pending_rows,pending_count,uncommitted,traceroutearr
+  inserted = 0
+  if pending_count > 0:
+    start = time.time()
+    stats = {}
+    inserted,rejected,elapsed = sql.copy_rows(pending_rows,conn=get_conn(),log=log,
+                                              stats=stats,commit=commit)
+    metrics.add_time('db',time.time() - start)
+    metrics.add_tables(stats)
+    pending_rows = {}
+    pending_count = 0
+    uncommitted = not commit
+  elif commit and uncommitted:
+    get_conn().execute('commit')
+    uncommitted = False
+  if len(traceroutearr) > 0:
+    start = time.time()
+    stored = trstore.write(traceroutearr)
+    metrics.add_time('trstore',time.time() - start)
+    metrics.count('traceroutes',len(traceroutearr))
+    metrics.count('traceroutes_stored',stored)
+    traceroutearr = {}
+  return inserted
 
 def write_block_v1_0(data,tables,log,fname):
   if 'info' not in data:
@@ -140,7 +348,14 @@ def write_block_v1_0(data,tables,log,fname):
         if tab != 'hop':
           fids,vals = get_measurement_params(fids,vals,data['info'][0])
           fids,vals = get_measurement_params(fids,vals,data[tab][i])
-          cmd,cvals = form_insert_cmd(table,fids,vals)
+          if tab == 'measurement':
+            try:
+              row = form_row(table,fids,vals)
+            except ValueError:
+              #no param field
+              invalid_data=True
+              postcmds = []
+              break
         else:
           try:
             ttid = data[tab][i]['ttid']
@@ -194,91 +409,80 @@ def write_block_v1_0(data,tables,log,fname):
         #  tup = (did,ts,srcip,dstip,toolid)
         #  traceroutearr[tup] = []
         if tab != 'hop' and tab != 'traceroute':
-          postcmds.append([cmd,cvals])
+          postcmds.append(row)
       if invalid_data == True:
         return False
-  if len(postcmds) > 1:
-    #postcmds.append('commit')
-    sql.run_insert_cmd(postcmds,conn=conn)
-  if len(traceroutearr) > 0:
-    bsdtr.write(traceroutearr)
-    traceroutearr = {}
+  if len(postcmds) > 0:
+    queue_rows(postcmds)
+  # Large files are written out in batches to bound memory, but committed
+  # only by parsefile's flush at the end of the file, so a file recorded in
+  # the ledger is all in or, after a crash, not in at all.
+  if pending_count + len(traceroutearr) >= BULK_FLUSH_ROWS:
+    flush_rows(log,commit=False)
   return True
     
 
-def parse_block_v1_0(block,version,tables,log):
-  data = {}
-  for line in block:
-    fields = get_fields(line)
-    if fields == None:
-      continue
-    head = fields[0]
-    if '/' in head:
+def parse_block_text(lines,lineno):
+  block = MeasurementBlock(lines,lineno)
+  p = xml.parsers.expat.ParserCreate()
+  p.returns_unicode = False
+  p.StartElementHandler = block.start_element
+  try:
+    p.Parse(''.join(lines),True)
+  except xml.parsers.expat.ExpatError as e:
+    block.error = 'line %d: %s'%(lineno + e.lineno - 1,
+                                 xml.parsers.expat.ErrorString(e.code))
+  except ValueError as e:
+    block.error = 'line %d: %s'%(lineno + p.CurrentLineNumber - 1,e)
+  return block
+
+def iter_blocks(file):
+  # Reads the file a line at a time and hands each <measurements> element to
+  # its own expat parser, so memory use is bounded by the largest block and a
+  # malformed block doesn't stop the rest of the file from being parsed.
+  lines = None
+  lineno = 0
+  for line in file:
+    lineno += 1
+    if lines == None:
+      if START_BLOCK not in line:
+        continue
+      line = line[line.index(START_BLOCK):]
+      lines = []
+      start = lineno
+    if END_BLOCK in line:
+      end = line.find('>',line.index(END_BLOCK))
+      if end >= 0:
+        line = line[:end+1]
+      lines.append(line)
+      yield parse_block_text(lines,start)
+      lines = None
       continue
-    if head not in data:
-      data[head] = []
-
-    tuple = {}
-    if head == 'hop':
-      tuple['ttid'] = len(data['traceroute']) -1
-    #print("f------->", fields[1:])
-    for field in fields[1:]:
-      field = field.split("=")
-      if len(field) != 2:
-        log.write("Unexpected split result %s\n" % str(fields[1:]))
-	continue
-      name = field[0]
-      val = field[1]
-      tuple[name] = val
-      #val = field[1].split('"')[1]
-      #print name,":", val, ",",
-    #print ''
-    data[head].append(tuple)
-  return data
-
-def parse_block_v1_1(block,version,tables,log):
-  data = parse_block_v1_0(block,version,tables,log)
-  return data
-
-def parse_block(block,version,tables,log,fname):
-  if version == '1.0':
-    data = parse_block_v1_0(block,version,tables,log)
-  elif version == '1.2' or version == '1.3':
-    data = parse_block_v1_1(block,version,tables,log)
-    did = data['info'][0]['deviceid']
-  else:
+    lines.append(line)
+
+def parse_block(block,tables,log,fname):
+  if block.error != None:
+    log.write('Error: %s in %s\n'%(block.error,fname))
     return False
-  return write_block_v1_0(data,tables,log,fname)
+  if block.version not in SUPPORTED_VERSIONS:
+    return False
+  return write_block_v1_0(block.data(),tables,log,fname)
 
 def log_bad_block(log,block,fname):
   log.write('Bad block in %s\n'%(fname))
-  for line in block:
-    log.write('%s\n'%(line))
+  for line in block.lines:
+    log.write('%s\n'%(line.rstrip('\n')))
 
 def parsefile(file,fname,tables,log):
-  start_block = '<measurements'
-  end_block = '</measurements'
-  #fp = open(file)
-  fp = file.readlines()
-  state = 0
-  block = []
-  version = 0
-  for line in fp:
-    if state == 0:
-      if  start_block in line:
-        state = 1
-        val = get_fields(line)
-        version = val[1].split("=")[1]#.split('"')[1]
-        print version
-      continue
-
-    if state == 1:
-      if end_block in line:
-        stat = parse_block(block,version,tables,log,fname)
-        if stat == False:
-          log_bad_block(log,block,fname)
-        state = 0
-        block = []
-        continue
-      block.append(line)
-
+  metrics.begin_file(fname)
+  reader = ingest_metrics.TimedReader(file)
+  for block in iter_blocks(reader):
+    print block.version
+    metrics.count('blocks')
+    stat = parse_block(block,tables,log,fname)
+    if stat == False:
+      metrics.count('bad_blocks')
+      log_bad_block(log,block,fname)
+  metrics.add_time('read',reader.elapsed)
+  flush_rows(log)
+  metrics.end_file()
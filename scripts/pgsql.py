@@ -7,6 +7,11 @@ import traceback
 import os
 import random as rnd
 import socket, struct
+import time
+import calendar
+import datetime
+import hashlib
+from cStringIO import StringIO
 import numpy as np
 
 REQ_ENV_VARS = ['BDM_PG_HOST',
@@ -42,29 +47,20 @@ def sqlconn():
     sys.exit()
   return cursor
 
-def run_insert_cmd(cmds,conn=None,prnt=0):
-  if conn == None:
-    conn = sqlconn()
-  savepointcmd = 'savepoint sp;'
-  #print cmds
-  conn.execute('begin')
-  conn.execute(savepointcmd)
-  print 'begin'
-  for ctup in cmds:
-    cmd = ctup[0]
-    cvals = ctup[1]
-    try:
-      conn.execute(cmd,cvals)
-      conn.execute(savepointcmd)
-      if prnt == 1:
-        print cmd,cvals
-    except:
-      print "Couldn't run ",cmd,cvals
-      conn.execute('rollback to savepoint sp')
-    #cursor.fetchall()
-  print 'end'
-  conn.execute('commit')
-  return 1 
+def mserver_ips():
+  # addresses of the measurement servers, from the management DB's target_ips
+  conn = pgsql.connect(
+        database=os.environ['BDM_PG_MGMT_DBNAME'],
+        host=os.environ['BDM_PG_HOST'],
+        port=int(os.environ.get('BDM_PG_PORT') or 5432),
+        user=os.environ['BDM_PG_USER'],
+        password=os.environ['BDM_PG_PASSWORD'])
+  try:
+    cursor = conn.cursor()
+    cursor.execute('SELECT DISTINCT host(ip) FROM target_ips')
+    return frozenset([r[0] for r in cursor.fetchall()])
+  finally:
+    conn.close()
 
 def run_data_cmd(cmd,cvals,conn=None,prnt=0):
   if conn == None:
@@ -80,3 +76,223 @@ def run_data_cmd(cmd,cvals,conn=None,prnt=0):
     return 0 
   result = conn.fetchall()
   return result 
+
+# Bulk load path. Rows are grouped by (table, columns) and streamed with COPY
+# into a temporary staging table, then moved into the real table with one
+# INSERT ... SELECT. If a group fails as a whole (e.g. one bad value), it is
+# retried row by row so that only the offending rows are rejected and logged.
+#
+# Rows that carry a digest column (see row_digest) are deduplicated on the way
+# in: a row is skipped if the table already has one with the same deviceid,
+# eventstamp and digest, or if it repeats within the batch. Tables that don't
+# have the column yet (see dedup_measurements.py prepare) are loaded as before.
+#
+# The digest leaves out the columns ingest fills in itself: direction is
+# worked out from the mserver addresses at ingest (and was by the old
+# fixup_klatch_direction_column.py), so a stored row may have one that the
+# uploaded record didn't. dedup_measurements.py backfill and dedup hash and
+# compare the same columns.
+TIMESTAMP_COLS = ('eventstamp',)
+TEXT_COLS = ('deviceid','srcip','dstip','toolid','direction')
+DIGEST_SKIP_COLS = ('exitstatus','digest','id','direction')
+DEDUP_KEY = ('deviceid','eventstamp','digest')
+staging_tables = {}
+
+# The mserver RTT tables are summarised per device, server and day in
+# mserver_rtt_daily (db/maintenance/create_mserver_rtt_daily.sql). After each
+# batch, the summary days of the devices that got new rows are recomputed.
+# On a DB without the summary (undefined function or table) this is noticed
+# once per connection and skipped; any other failure only skips that batch's
+# refresh.
+RTT_SUMMARY_SOURCES = {'m_mserver_rtt':'rtt','m_mserver_rping':'rping'}
+SUMMARY_MISSING_CODES = ('42883','42P01')  # undefined_function, undefined_table
+summary_disabled = set()
+
+def canonical_value(col,val):
+  # the same text for a value whether it comes from an XML attribute or back
+  # out of the DB, so that re-uploaded rows get the same digest
+  if val == None or val == '':
+    return ''
+  if isinstance(val,datetime.datetime):
+    if val.tzinfo != None:
+      val = val.replace(tzinfo=None) - val.utcoffset()
+    val = calendar.timegm(val.timetuple()) + val.microsecond/1e6
+  if col not in TEXT_COLS:
+    try:
+      return repr(float(val))
+    except (TypeError,ValueError):
+      pass
+  return str(val)
+
+def row_digest(table,cols,vals):
+  return digest_pairs(table,sorted([(col,val) for col,val in zip(cols,vals)
+                                    if col not in DIGEST_SKIP_COLS]))
+
+def digest_pairs(table,pairs):
+  # pairs must be (column, value) sorted by column, without DIGEST_SKIP_COLS
+  h = hashlib.sha1(table.lower())
+  for col,val in pairs:
+    val = canonical_value(col,val)
+    if val != '':
+      h.update('\0%s=%s'%(col,val))
+  return h.hexdigest()[:16]
+
+def copy_escape(val):
+  if val == None or val == '':
+    return '\\N'
+  val = str(val)
+  return val.replace('\\','\\\\').replace('\t','\\t').replace('\n','\\n').replace('\r','\\r')
+
+def copy_buffer(rows):
+  buf = StringIO()
+  for row in rows:
+    buf.write('\t'.join([copy_escape(v) for v in row]))
+    buf.write('\n')
+  buf.seek(0)
+  return buf
+
+def get_staging_table(conn,table):
+  # returns the staging table's name and the real table's columns. After a
+  # failed batch the cache entry is dropped, but the table itself survives if
+  # an earlier transaction created it, hence IF NOT EXISTS.
+  tables = staging_tables.setdefault(id(conn),{})
+  if table in tables:
+    return tables[table]
+  stage = 'stage_' + table
+  conn.execute('CREATE TEMP TABLE IF NOT EXISTS %s (LIKE %s) ON COMMIT DELETE ROWS'%(stage,table))
+  conn.execute('SELECT * FROM %s LIMIT 0'%(stage))
+  cols = [d[0] for d in conn.description]
+  for col in TIMESTAMP_COLS:
+    if col in cols:
+      # timestamps arrive as epoch seconds and are converted on the way out
+      conn.execute('ALTER TABLE %s ALTER COLUMN %s TYPE double precision USING NULL'%(stage,col))
+  tables[table] = (stage,tuple(cols))
+  return tables[table]
+
+def select_expr(col,prefix=''):
+  if col in TIMESTAMP_COLS:
+    return 'to_timestamp(%s%s)'%(prefix,col)
+  return prefix + col
+
+def dedup_cond(table,prefix=''):
+  # true if table already holds a row with the candidate's dedup key
+  return 'NOT EXISTS (SELECT 1 FROM %s t WHERE %s)'%(table,' AND '.join(
+         ['t.%s = %s'%(col,select_expr(col,prefix)) for col in DEDUP_KEY]))
+
+def strip_digest(cols,rows):
+  i = cols.index('digest')
+  return cols[:i] + cols[i+1:],[row[:i] + row[i+1:] for row in rows]
+
+def insert_rows_singly(table,cols,rows,conn,log=None):
+  cmd = 'INSERT into %s(%s) SELECT %s'%(table,','.join(cols),
+        ','.join([select_expr('%s') if c in TIMESTAMP_COLS else '%s' for c in cols]))
+  dedup = len([c for c in DEDUP_KEY if c in cols]) == len(DEDUP_KEY)
+  if dedup:
+    keypos = [cols.index(col) for col in DEDUP_KEY]
+    cmd += ' WHERE NOT EXISTS (SELECT 1 FROM %s t WHERE %s)'%(table,
+           ' AND '.join(['t.%s = %s'%(col,select_expr('%s')) for col in DEDUP_KEY]))
+  inserted = 0
+  rejected = 0
+  for row in rows:
+    cvals = [v if v != '' else None for v in row]
+    if dedup:
+      cvals = cvals + [cvals[i] for i in keypos]
+    try:
+      conn.execute('savepoint sp')
+      conn.execute(cmd,cvals)
+      conn.execute('release savepoint sp')
+      inserted += conn.rowcount
+    except pgsql.Error:
+      print "Couldn't run ",cmd,cvals
+      if log != None:
+        log.write("Rejected row for %s: %s\n"%(table,str(cvals)))
+      conn.execute('rollback to savepoint sp')
+      rejected += 1
+  return inserted,rejected
+
+def summary_keys(cols,rows):
+  # (deviceid, epoch) of each row, for refresh_rtt_summary
+  dpos = cols.index('deviceid')
+  epos = cols.index('eventstamp')
+  keys = set()
+  for row in rows:
+    try:
+      keys.add((row[dpos],float(row[epos])))
+    except (TypeError,ValueError):
+      pass  # rejected anyway
+  return keys
+
+def refresh_rtt_summary(conn,keys):
+  # keys: source -> set of (deviceid, epoch) of the rows just loaded
+  if id(conn) in summary_disabled:
+    return
+  for source in sorted(keys):
+    devices = [k[0] for k in keys[source]]
+    epochs = [k[1] for k in keys[source]]
+    conn.execute('savepoint summary')
+    try:
+      conn.execute('SELECT refresh_mserver_rtt_daily(%s,%s::text[],%s::double precision[])',
+                   (source,devices,epochs))
+      conn.execute('release savepoint summary')
+    except pgsql.Error as e:
+      conn.execute('rollback to savepoint summary')
+      if e.pgcode in SUMMARY_MISSING_CODES:
+        summary_disabled.add(id(conn))
+        print 'Not maintaining mserver_rtt_daily: %s'%(str(e).strip())
+        return
+      print 'Could not refresh mserver_rtt_daily for %d %s key(s), rerun rtt_summary.py rebuild: %s'%(
+            len(devices),source,str(e).strip())
+
+def copy_rows(rows_by_table,conn=None,log=None,stats=None,commit=True):
+  # stats, if given, gets table -> [rows, inserted, rejected] added to it;
+  # with commit=False the rows are left for the caller to commit
+  if conn == None:
+    conn = sqlconn()
+  start = time.time()
+  total = 0
+  inserted = 0
+  rejected = 0
+  summary = {}
+  for (table,cols) in rows_by_table:
+    rows = rows_by_table[(table,cols)]
+    total += len(rows)
+    ins_before,rej_before = inserted,rejected
+    conn.execute('savepoint bulk')
+    try:
+      stage,table_cols = get_staging_table(conn,table)
+      if 'digest' in cols and 'digest' not in table_cols:
+        cols,rows = strip_digest(cols,rows)
+      conn.copy_expert('COPY %s (%s) FROM STDIN'%(stage,','.join(cols)),copy_buffer(rows))
+      if 'digest' in cols:
+        conn.execute('INSERT INTO %s (%s) SELECT DISTINCT ON (%s) %s FROM %s s WHERE %s'%(
+                     table,','.join(cols),','.join(['s.'+c for c in DEDUP_KEY]),
+                     ','.join([select_expr(c,'s.') for c in cols]),stage,
+                     dedup_cond(table,'s.')))
+      else:
+        conn.execute('INSERT INTO %s (%s) SELECT %s FROM %s'%(table,','.join(cols),
+                     ','.join([select_expr(c) for c in cols]),stage))
+      inserted += conn.rowcount
+      conn.execute('TRUNCATE %s'%(stage))
+      conn.execute('release savepoint bulk')
+    except pgsql.Error:
+      conn.execute('rollback to savepoint bulk')
+      staging_tables.get(id(conn),{}).pop(table,None)
+      ins,rej = insert_rows_singly(table,cols,rows,conn,log)
+      inserted += ins
+      rejected += rej
+    if table in RTT_SUMMARY_SOURCES and inserted > ins_before:
+      summary.setdefault(RTT_SUMMARY_SOURCES[table],set()).update(summary_keys(cols,rows))
+    if stats != None:
+      counts = stats.setdefault(table,[0,0,0])
+      counts[0] += len(rows)
+      counts[1] += inserted - ins_before
+      counts[2] += rejected - rej_before
+  if summary:
+    refresh_rtt_summary(conn,summary)
+  if commit:
+    conn.execute('commit')
+  elapsed = time.time() - start
+  rate = inserted / elapsed if elapsed > 0 else 0.0
+  print 'copied %d of %d rows into %d tables in %.3fs (%.0f rows/s), %d duplicates skipped'%(
+        inserted,total,len(rows_by_table),elapsed,rate,total-inserted-rejected)
+  return inserted,rejected,elapsed
@@ -0,0 +1,126 @@
+#!/usr/bin/env python
+#
+# Mergeable quantile sketches for latency distributions, in the manner of
+# DDSketch: a value x is counted in bucket ceil(log_gamma(x)), with
+# gamma = (1 + a) / (1 - a) for relative accuracy a, and a bucket stands for
+# the value 2 * gamma**k / (gamma + 1). Every value in bucket k lies within
+# a relative distance a of that, so a quantile read from the sketch is within
+# a of the sample it replaces: with the default a = 1%, a true median of
+# 50ms comes back between 49.5ms and 50.5ms, however many samples there
+# were. Values below MIN_VALUE are counted as MIN_VALUE.
+#
+# Sketches merge by adding bucket counts, so a quantile over any window comes
+# from the per-day sketches stored in mserver_rtt_daily (sketch_keys and
+# sketch_counts, filled in by rtt_sketch_key() in
+# db/maintenance/create_mserver_rtt_daily.sql, which must use the same
+# RELATIVE_ACCURACY and MIN_VALUE).
+#
+# quantile(q) is percentile_disc(q): the sample at rank ceil(q * n), so
+# quantile(0.5) approximates the lower median.
+#
+#   quantile_sketch.py   runs the doctests below
+
+import math
+
+RELATIVE_ACCURACY = 0.01
+MIN_VALUE = 1e-3  # ms
+
+
+class QuantileSketch(object):
+    """
+    >>> import random
+    >>> rnd = random.Random(1)
+    >>> samples = [rnd.lognormvariate(3, 1) for i in xrange(10001)]
+    >>> sketch = QuantileSketch()
+    >>> for x in samples:
+    ...     sketch.add(x)
+    >>> exact = sorted(samples)
+    >>> all(abs(sketch.quantile(q) - exact[int(math.ceil(q * len(exact))) - 1])
+    ...     <= RELATIVE_ACCURACY * exact[int(math.ceil(q * len(exact))) - 1]
+    ...     for q in (0.01, 0.1, 0.5, 0.9, 0.99))
+    True
+    >>> len(sketch.buckets) < 700
+    True
+
+    Merging the sketches of parts gives the sketch of the whole:
+
+    >>> a, b = QuantileSketch(), QuantileSketch()
+    >>> for i, x in enumerate(samples):
+    ...     (a if i % 3 else b).add(x)
+    >>> a.merge(b).buckets == sketch.buckets
+    True
+    >>> a.count
+    10001
+
+    and so does rebuilding one from stored buckets:
+
+    >>> keys, counts = sketch.to_buckets()
+    >>> QuantileSketch.from_buckets(keys, counts).quantile(0.5) == \\
+    ...     sketch.quantile(0.5)
+    True
+
+    The lower median, as update_device_targets.py has always taken it:
+
+    >>> small = QuantileSketch()
+    >>> for x in [30.0, 10.0, 20.0, 40.0]:
+    ...     small.add(x)
+    >>> abs(small.quantile(0.5) - 20.0) <= 0.2
+    True
+    >>> QuantileSketch().quantile(0.5) is None
+    True
+    """
+
+    def __init__(self, relative_accuracy=RELATIVE_ACCURACY):
+        self.relative_accuracy = relative_accuracy
+        self.gamma = (1 + relative_accuracy) / (1 - relative_accuracy)
+        self.log_gamma = math.log(self.gamma)
+        self.buckets = {}  # key -> count
+        self.count = 0
+
+    @classmethod
+    def from_buckets(cls, keys, counts, relative_accuracy=RELATIVE_ACCURACY):
+        sketch = cls(relative_accuracy)
+        for key, count in zip(keys, counts):
+            sketch.buckets[key] = sketch.buckets.get(key, 0) + count
+            sketch.count += count
+        return sketch
+
+    def key(self, x):
+        return int(math.ceil(math.log(max(x, MIN_VALUE)) / self.log_gamma))
+
+    def value(self, key):
+        return 2 * self.gamma ** key / (self.gamma + 1)
+
+    def add(self, x, count=1):
+        key = self.key(x)
+        self.buckets[key] = self.buckets.get(key, 0) + count
+        self.count += count
+
+    def merge(self, other):
+        if other.relative_accuracy != self.relative_accuracy:
+            raise ValueError("can't merge sketches of different accuracy")
+        for key, count in other.buckets.iteritems():
+            self.buckets[key] = self.buckets.get(key, 0) + count
+        self.count += other.count
+        return self
+
+    def quantile(self, q):
+        if self.count == 0:
+            return None
+        rank = max(1, int(math.ceil(q * self.count)))
+        seen = 0
+        for key in sorted(self.buckets):
+            seen += self.buckets[key]
+            if seen >= rank:
+                return self.value(key)
+        return self.value(key)
+
+    def to_buckets(self):
+        # (keys, counts), by key, as stored in mserver_rtt_daily
+        keys = sorted(self.buckets)
+        return keys, [self.buckets[k] for k in keys]
+
+
+if __name__ == '__main__':
+    import doctest
+    doctest.testmod()
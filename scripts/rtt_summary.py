@@ -0,0 +1,167 @@
+#!/usr/bin/env python
+#
+# Rebuilds the mserver_rtt_daily summary of m_mserver_rtt and m_mserver_rping
+# in the data DB (see db/maintenance/create_mserver_rtt_daily.sql), e.g. to
+# backfill the days loaded before ingest started maintaining it, or after
+# rows were deleted by hand.
+#
+#   rtt_summary.py rebuild [--since YYYY-MM-DD] [--until YYYY-MM-DD] [SOURCE...]
+#   rtt_summary.py quantiles [--since ...] [--until ...] [--source S] DEVICEID
+#
+# rebuild works through each source (rtt, rping) one --batch-days window of
+# days at a time, committing after each window. quantiles merges the stored
+# sketches of a device's days to print the p10/p50/p90 of minimum RTT to each
+# mserver address over the window.
+
+import argparse
+import datetime
+import os
+import sys
+import time
+
+import psycopg2
+
+from pgsql import RTT_SUMMARY_SOURCES
+from quantile_sketch import QuantileSketch
+
+REQ_ENV_VARS = ['BDM_PG_HOST',
+                'BDM_PG_USER',
+                'BDM_PG_PASSWORD',
+                'BDM_PG_DATA_DBNAME',
+                ]
+
+# each optional item consists of a tuple (var_name, default_value)
+OPT_ENV_VARS = [('BDM_PG_PORT', 5432),
+                ]
+
+SUMMARY_TABLE = 'mserver_rtt_daily'
+
+
+def source_days(cur, table, since, until):
+    # first and last day with rows in table, clipped to --since/--until
+    cur.execute("SELECT (min(eventstamp) AT TIME ZONE 'UTC')::date, "
+                "   (max(eventstamp) AT TIME ZONE 'UTC')::date FROM %s;"
+                % table)
+    first, last = cur.fetchone()
+    if first is None:
+        return None, None
+    if since is not None:
+        first = max(first, since.date())
+    if until is not None:
+        last = min(last, until.date())
+    return first, last
+
+
+def rebuild(dconn, source, since, until, batch, pause):
+    cur = dconn.cursor()
+    first, last = source_days(cur, 'm_mserver_' + source, since, until)
+    if first is None:
+        return 0
+    total = 0
+    while first <= last:
+        end = min(first + batch - datetime.timedelta(days=1), last)
+        cur.execute("SELECT rebuild_mserver_rtt_daily(%s, %s, %s);",
+                    [source, first, end])
+        n = cur.fetchone()[0]
+        dconn.commit()
+        total += n
+        if n:
+            print("%s: %s..%s %d summary row(s)" % (source, first, end, n))
+        first = end + datetime.timedelta(days=1)
+        time.sleep(pause)
+    return total
+
+
+def device_quantiles(dconn, source, deviceid, since, until):
+    # {dstip: merged sketch} of deviceid's days in [since, until]
+    cur = dconn.cursor()
+    cur.execute((
+            "SELECT host(dstip), sketch_keys, sketch_counts FROM %s "
+            "WHERE source = %%s AND deviceid = %%s "
+            "AND (%%s::date IS NULL OR day >= %%s::date) "
+            "AND (%%s::date IS NULL OR day <= %%s::date) "
+            "AND sketch_keys IS NOT NULL;") % SUMMARY_TABLE,
+            [source, deviceid, since, since, until, until])
+    sketches = {}
+    for dstip, keys, counts in cur.fetchall():
+        day = QuantileSketch.from_buckets(keys, counts)
+        if dstip in sketches:
+            sketches[dstip].merge(day)
+        else:
+            sketches[dstip] = day
+    return sketches
+
+
+def parse_date(val):
+    return datetime.datetime.strptime(val, '%Y-%m-%d')
+
+
+if __name__ == '__main__':
+    argp = argparse.ArgumentParser(
+            description='Rebuild or query the per-day mserver RTT summary')
+    sources = sorted(RTT_SUMMARY_SOURCES.values())
+    sub = argp.add_subparsers(dest='command')
+    reb = sub.add_parser('rebuild', help='recompute the summary from the '
+                                         'raw tables')
+    reb.add_argument('sources', nargs='*',
+                     help='default: %s' % ', '.join(sources))
+    reb.add_argument('--batch-days', type=int, default=7,
+                     help='days per transaction (default: 7)')
+    reb.add_argument('--pause', type=float, default=0,
+                     help='seconds to sleep between windows (default: 0)')
+    qua = sub.add_parser('quantiles', help="a device's minimum RTT "
+                                           "percentiles per mserver")
+    qua.add_argument('deviceid', help='as in the data DB, without OW')
+    qua.add_argument('--source', choices=sources, default='rtt',
+                     help='default: rtt')
+    for p in (reb, qua):
+        p.add_argument('--since', type=parse_date, help='YYYY-MM-DD')
+        p.add_argument('--until', type=parse_date, help='YYYY-MM-DD')
+    args = argp.parse_args()
+    if args.command == 'rebuild':
+        for source in args.sources:
+            if source not in sources:
+                argp.error("unknown source '%s'" % source)
+
+    config = {}
+    for evname in REQ_ENV_VARS:
+        try:
+            config[evname] = os.environ[evname]
+        except KeyError:
+            print(("Environment variable '%s' required and not defined. "
+                    "Terminating.") % evname)
+            sys.exit(1)
+    for (evname, default_val) in OPT_ENV_VARS:
+        config[evname] = os.environ.get(evname) or default_val
+
+    dconn = psycopg2.connect(
+            host=config['BDM_PG_HOST'],
+            port=int(config['BDM_PG_PORT']),
+            database=config['BDM_PG_DATA_DBNAME'],
+            user=config['BDM_PG_USER'],
+            password=config['BDM_PG_PASSWORD'],
+            )
+    cur = dconn.cursor()
+    cur.execute("SELECT 1 FROM information_schema.tables "
+                "WHERE table_schema = current_schema() AND table_name = %s;",
+                [SUMMARY_TABLE])
+    if cur.rowcount == 0:
+        print("%s: no such table, create it with "
+              "db/maintenance/create_mserver_rtt_daily.sql" % SUMMARY_TABLE)
+        sys.exit(1)
+    if args.command == 'rebuild':
+        batch = datetime.timedelta(days=args.batch_days)
+        for source in args.sources or sources:
+            n = rebuild(dconn, source, args.since, args.until, batch,
+                        args.pause)
+            print("%s: %d summary row(s) rebuilt" % (source, n))
+    else:
+        sketches = device_quantiles(dconn, args.source, args.deviceid,
+                                    args.since, args.until)
+        print("%-16s %8s %9s %9s %9s" % ('dstip', 'samples', 'p10', 'p50',
+                                         'p90'))
+        for dstip in sorted(sketches):
+            sketch = sketches[dstip]
+            print("%-16s %8d %9.2f %9.2f %9.2f" % (
+                    dstip, sketch.count, sketch.quantile(0.1),
+                    sketch.quantile(0.5), sketch.quantile(0.9)))
@@ -0,0 +1,82 @@
+#!/usr/bin/env python
+# Tests of TracerouteStore's recovery from writers that died part way:
+#
+#   python test_trstore.py        (from scripts/)
+import os
+import shutil
+import tempfile
+import unittest
+
+import trstore
+
+TS = 1420070400  # 2015-01-01
+SEGMENT = '2015-01'
+
+def traceroute(did,ts,last_hop):
+  return {(did,ts,'10.0.0.1','10.0.9.9','bsd'):
+          [(1,'10.0.0.254',1.5),(2,'*',None),(3,last_hop,12.25)]}
+
+class TornTailTest(unittest.TestCase):
+  def setUp(self):
+    self.root = tempfile.mkdtemp()
+    self.store = trstore.TracerouteStore(self.root)
+    self.assertEqual(self.store.write(traceroute('dev000000001',TS,'10.1.1.1')),1)
+
+  def tearDown(self):
+    shutil.rmtree(self.root)
+
+  def tear(self,ext,tail):
+    fp = open(self.store.path(SEGMENT,ext),'ab')
+    fp.write(tail)
+    fp.close()
+
+  def check_appended(self):
+    new = traceroute('dev000000001',TS+60,'10.2.2.2')
+    self.assertEqual(self.store.write(new),1)
+    key,hops = new.items()[0]
+    self.assertEqual([r[0][1] for r in self.store.by_device('dev000000001')],
+                     [TS,TS+60])
+    self.assertEqual(self.store.by_hop('10.2.2.2').next(),
+                     (key,[(1,'10.0.0.254',1.5),(2,'*',None),(3,'10.2.2.2',12.25)]))
+    self.assertEqual(self.store.latest('dev000000001')[0],key)
+    # both are seen as stored, so writing them again adds nothing
+    self.assertEqual(self.store.write(new),0)
+    self.assertEqual(self.store.write(traceroute('dev000000001',TS,'10.1.1.1')),0)
+    self.assertEqual(len(list(self.store.scan(SEGMENT))),2)
+
+  def test_torn_index_runs(self):
+    for ext in trstore.INDEXES:
+      entry = trstore.INDEXES[ext]
+      self.tear(ext,trstore.RUN_HEAD.pack(trstore.RUN_MAGIC,3) + '\0'*(entry.size+5))
+    self.check_appended()
+
+  def test_torn_run_head(self):
+    self.tear('tri',trstore.RUN_MAGIC[:3])
+    self.tear('trh',trstore.RUN_MAGIC)
+    self.check_appended()
+
+  def test_partial_record(self):
+    rec = trstore.encode(('dev000000002',TS+30,'10.0.0.1','10.0.9.9','bsd'),[])
+    self.tear('trd',rec[:-1])
+    self.check_appended()
+    self.assertEqual(self.store.reindex(SEGMENT),2)
+    self.check_appended_again()
+
+  def test_partial_record_head(self):
+    self.tear('trd','\x03\0')
+    self.check_appended()
+
+  def test_segment_without_data_end(self):
+    # segments written before .tre files existed
+    os.remove(self.store.path(SEGMENT,'tre'))
+    rec = trstore.encode(('dev000000002',TS+30,'10.0.0.1','10.0.9.9','bsd'),[])
+    self.tear('trd',rec[:trstore.REC_HEAD.size+1])
+    self.check_appended()
+
+  def check_appended_again(self):
+    self.assertEqual(len(list(self.store.by_device('dev000000001'))),2)
+    self.assertEqual(self.store.write(traceroute('dev000000001',TS+120,'10.3.3.3')),1)
+    self.assertEqual(self.store.latest('dev000000001')[0][1],TS+120)
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,568 @@
+#!/usr/bin/env python
+# Append-only traceroute store, replacing the pickled bsdtr dbhash files.
+#
+# The store is a directory of monthly segments (UTC month of the traceroute
+# timestamp). Each segment has:
+#
+#   YYYY-MM.trd   data: packed traceroute records, appended in batches
+#   YYYY-MM.tri   index: sorted runs of (device, timestamp, offset) entries
+#   YYYY-MM.trh   hop index: sorted runs of (hop ip, timestamp, offset) entries
+#   YYYY-MM.tre   length of the data up to its last complete record
+#   YYYY-MM.lock  flock()ed by writers
+#
+# A data record is
+#
+#   <H  record length     <12s device id   <I timestamp   <I srcip   <I dstip
+#   <B  tool length       <B   hop count   tool          then per hop:
+#   <B  hop number        <I   hop ip      <f rtt (NaN if missing)
+#
+# with IPv4 addresses packed as integers, 0 for a hop that didn't answer ('*'
+# or empty, read back as '*'). A traceroute with any other address that isn't dotted-quad IPv4,
+# an IPv6 one say, can't be stored and is rejected with a message rather than
+# stored with a made-up address.
+# Every write() appends one sorted index run per touched segment and syncs
+# each segment once; once a segment has MAX_RUNS runs they are merged into
+# one, so lookups only ever bisect a handful of runs.
+#
+# A writer that dies part way leaves a torn run at the end of an index or a
+# partial record at the end of the data. Readers ignore both, and the next
+# writer cuts them off before appending (see TracerouteStore.repair), so what
+# it appends lands where readers look.
+#
+# Readers take no lock: they mmap the index and bisect the runs in place, then
+# decode only the matching records, so a query over a month of traceroutes
+# streams its results without loading the month. Segments written before the
+# hop index existed need a 'reindex' before hop queries see them.
+import os
+import sys
+import time
+import math
+import mmap
+import fcntl
+import heapq
+import bisect
+import calendar
+import socket
+import struct
+import argparse
+
+REQ_ENV_VARS = ['BDM_TRACEROUTE_DIR']
+
+REC_HEAD = struct.Struct('<H12sIIIBB')
+HOP = struct.Struct('<BIf')
+RUN_HEAD = struct.Struct('<4sI')
+RUN_MAGIC = 'TRIR'
+IDX_ENTRY = struct.Struct('<12sIQ')
+DATA_END = struct.Struct('<Q')
+HOP_ENTRY = struct.Struct('<IIQ')
+INDEXES = {'tri': IDX_ENTRY, 'trh': HOP_ENTRY}
+MAX_RUNS = 16
+MAX_TS = 2**32
+
+config = {}
+store = None
+
+MISSING_IPS = (None,'','*')
+
+def ip_to_int(ip):
+  if ip in MISSING_IPS:
+    return 0
+  try:
+    return struct.unpack('!I',socket.inet_pton(socket.AF_INET,ip))[0]
+  except (socket.error,TypeError):
+    raise ValueError('not an IPv4 address: %r'%(ip,))
+
+def int_to_ip(n):
+  return socket.inet_ntoa(struct.pack('!I',n))
+
+def to_float(val):
+  try:
+    return float(val)
+  except (TypeError,ValueError):
+    return float('nan')
+
+def segment_name(ts):
+  t = time.gmtime(ts)
+  return '%04d-%02d'%(t.tm_year,t.tm_mon)
+
+def encode(key,hops):
+  did,ts,srcip,dstip,tool = key
+  tool = str(tool)[:255]
+  hops = hops[:255]
+  parts = []
+  for hopid,hopip,hoprtt in hops:
+    try:
+      hopnum = min(max(int(hopid),0),255)
+    except (TypeError,ValueError):
+      hopnum = 0
+    parts.append(HOP.pack(hopnum,ip_to_int(hopip),to_float(hoprtt)))
+  body = tool + ''.join(parts)
+  return REC_HEAD.pack(REC_HEAD.size+len(body),str(did)[-12:],int(float(ts)),
+                       ip_to_int(srcip),ip_to_int(dstip),len(tool),len(hops)) + body
+
+def decode(buf,offset=0):
+  (reclen,did,ts,srcip,dstip,toollen,nhops) = REC_HEAD.unpack_from(buf,offset)
+  pos = offset + REC_HEAD.size
+  tool = buf[pos:pos+toollen]
+  pos += toollen
+  hops = []
+  for i in range(0,nhops):
+    hopnum,hopip,hoprtt = HOP.unpack_from(buf,pos)
+    hops.append((hopnum,int_to_ip(hopip) if hopip != 0 else '*',
+                 None if math.isnan(hoprtt) else hoprtt))
+    pos += HOP.size
+  return (did.rstrip('\0'),ts,int_to_ip(srcip),int_to_ip(dstip),tool),hops,reclen
+
+def device_key(did):
+  # device ids are stored as their last 12 characters, NUL padded
+  return struct.pack('12s',str(did)[-12:])
+
+def hop_ips(hops):
+  ips = set()
+  for hop in hops:
+    ip = ip_to_int(hop[1])
+    if ip != 0:
+      ips.add(ip)
+  return ips
+
+def map_file(path):
+  # read-only mapping of a file, or None if it is missing or empty
+  try:
+    fp = open(path,'rb')
+  except IOError:
+    return None
+  try:
+    if os.fstat(fp.fileno()).st_size == 0:
+      return None
+    return mmap.mmap(fp.fileno(),0,access=mmap.ACCESS_READ)
+  finally:
+    fp.close()
+
+def read_runs(buf,entry):
+  # returns a list of (start offset, count) for each complete run in an index
+  runs = []
+  pos = 0
+  while pos + RUN_HEAD.size <= len(buf):
+    magic,count = RUN_HEAD.unpack_from(buf,pos)
+    end = pos + RUN_HEAD.size + count*entry.size
+    if magic != RUN_MAGIC or end > len(buf):
+      break  # a run whose write was interrupted
+    runs.append((pos + RUN_HEAD.size,count))
+    pos = end
+  return runs
+
+# One sorted run of an index, unpacked on demand so that bisect can search it
+# without reading it.
+class IndexRun(object):
+  def __init__(self,buf,start,count,entry):
+    self.buf = buf
+    self.start = start
+    self.count = count
+    self.entry = entry
+
+  def __len__(self):
+    return self.count
+
+  def __getitem__(self,i):
+    if i < 0 or i >= self.count:
+      raise IndexError(i)
+    return self.entry.unpack_from(self.buf,self.start + i*self.entry.size)
+
+  def __iter__(self):
+    for i in xrange(0,self.count):
+      yield self.entry.unpack_from(self.buf,self.start + i*self.entry.size)
+
+  def range(self,lo,hi):
+    # entries e with lo <= e < hi, in order
+    i = bisect.bisect_left(self,lo)
+    while i < self.count:
+      e = self[i]
+      if e >= hi:
+        break
+      yield e
+      i += 1
+
+  def last_before(self,hi):
+    i = bisect.bisect_left(self,hi)
+    if i == 0:
+      return None
+    return self[i-1]
+
+def runs_end(path,entry):
+  # offset just past the last complete run of an index, and the file's size
+  buf = map_file(path)
+  if buf == None:
+    return 0,0
+  runs = read_runs(buf,entry)
+  end = runs[-1][0] + runs[-1][1]*entry.size if len(runs) > 0 else 0
+  size = len(buf)
+  buf.close()
+  return end,size
+
+def records_end(path):
+  # offset just past the last complete record of a data file, by walking the
+  # record headers
+  try:
+    fp = open(path,'rb')
+  except IOError:
+    return 0
+  size = os.fstat(fp.fileno()).st_size
+  end = 0
+  while end + REC_HEAD.size <= size:
+    fp.seek(end)
+    reclen = REC_HEAD.unpack(fp.read(REC_HEAD.size))[0]
+    if reclen < REC_HEAD.size or end + reclen > size:
+      break
+    end += reclen
+  fp.close()
+  return end
+
+def truncate(path,length):
+  fp = open(path,'r+b')
+  fp.truncate(length)
+  fp.flush()
+  os.fsync(fp.fileno())
+  fp.close()
+
+def index_runs(path,entry):
+  buf = map_file(path)
+  if buf == None:
+    return []
+  return [IndexRun(buf,start,count,entry) for start,count in read_runs(buf,entry)]
+
+def is_stored(runs,data,did,ts,rec):
+  # true if the device index runs point at an identical record in data
+  for run in runs:
+    for e in run.range((did,ts,0),(did,ts+1,0)):
+      if data[e[2]:e[2]+len(rec)] == rec:
+        return True
+  return False
+
+def write_run(fp,entry,entries):
+  # writes a run from any iterable of entries, patching the count into the
+  # header afterwards, so fp must be a fresh file rather than one opened 'ab'
+  fp.write(RUN_HEAD.pack(RUN_MAGIC,0))
+  count = 0
+  chunk = []
+  for e in entries:
+    chunk.append(entry.pack(*e))
+    if len(chunk) >= 65536:
+      fp.write(''.join(chunk))
+      count += len(chunk)
+      chunk = []
+  fp.write(''.join(chunk))
+  count += len(chunk)
+  end = fp.tell()
+  fp.seek(end - RUN_HEAD.size - count*entry.size)
+  fp.write(RUN_HEAD.pack(RUN_MAGIC,count))
+  fp.seek(end)
+  return count
+
+class TracerouteStore(object):
+  def __init__(self,root):
+    self.root = root
+    if not os.path.isdir(root):
+      os.makedirs(root)
+
+  def path(self,segment,ext):
+    return os.path.join(self.root,'%s.%s'%(segment,ext))
+
+  def segments(self):
+    return sorted(f[:-4] for f in os.listdir(self.root) if f.endswith('.trd'))
+
+  def write(self,inarr):
+    # inarr is the bsdtr-style dict {(deviceid, ts, srcip, dstip, tool): hops}
+    by_segment = {}
+    for key in inarr:
+      try:
+        rec = encode(key,inarr[key])
+      except (ValueError,struct.error) as e:
+        print 'Not storing traceroute %s: %s'%(str(key),e)
+        continue
+      by_segment.setdefault(segment_name(int(float(key[1]))),[]).append(
+        (device_key(key[0]),int(float(key[1])),hop_ips(inarr[key]),rec))
+    stored = 0
+    for segment in by_segment:
+      stored += self.append(segment,by_segment[segment])
+    return stored
+
+  def data_end(self,segment):
+    # the data length recorded after the last complete data write; segments
+    # written before .tre files existed are walked once instead
+    try:
+      buf = open(self.path(segment,'tre'),'rb').read()
+    except IOError:
+      buf = ''
+    if len(buf) == DATA_END.size:
+      return DATA_END.unpack(buf)[0]
+    return records_end(self.path(segment,'trd'))
+
+  def set_data_end(self,segment,end):
+    # an interrupted write leaves the file short, and data_end falls back to
+    # walking the records
+    fp = open(self.path(segment,'tre'),'wb')
+    fp.write(DATA_END.pack(end))
+    fp.flush()
+    os.fsync(fp.fileno())
+    fp.close()
+
+  def repair(self,segment):
+    # cuts a torn run off the end of each index and anything past the last
+    # complete data write off the data; caller holds the lock. Index entries
+    # are only written once their data is, so none point past the cut.
+    for ext in INDEXES:
+      path = self.path(segment,ext)
+      end,size = runs_end(path,INDEXES[ext])
+      if end < size:
+        truncate(path,end)
+    path = self.path(segment,'trd')
+    if os.path.exists(path):
+      end = self.data_end(segment)
+      if end < os.path.getsize(path):
+        truncate(path,end)
+
+  def append(self,segment,recs):
+    # returns the number of records appended; records already in the segment,
+    # byte for byte, are skipped so re-ingested uploads don't duplicate them
+    lock = open(self.path(segment,'lock'),'a')
+    fcntl.flock(lock,fcntl.LOCK_EX)
+    try:
+      self.repair(segment)
+      runs = index_runs(self.path(segment,'tri'),IDX_ENTRY)
+      if len(runs) > 0:
+        stored = map_file(self.path(segment,'trd'))
+        recs = [r for r in recs if not is_stored(runs,stored,r[0],r[1],r[3])]
+      if len(recs) == 0:
+        return 0
+      data = open(self.path(segment,'trd'),'ab')
+      data.seek(0,os.SEEK_END)
+      offset = data.tell()
+      entries = []
+      hop_entries = []
+      for did,ts,ips,rec in recs:
+        entries.append((did,ts,offset))
+        for ip in ips:
+          hop_entries.append((ip,ts,offset))
+        offset += len(rec)
+      data.write(''.join([rec for did,ts,ips,rec in recs]))
+      data.flush()
+      os.fsync(data.fileno())
+      data.close()
+      self.set_data_end(segment,offset)
+      entries.sort()
+      hop_entries.sort()
+      self.append_run(segment,'tri',entries)
+      self.append_run(segment,'trh',hop_entries)
+    finally:
+      fcntl.flock(lock,fcntl.LOCK_UN)
+      lock.close()
+    return len(recs)
+
+  def append_run(self,segment,ext,entries):
+    entry = INDEXES[ext]
+    path = self.path(segment,ext)
+    idx = open(path,'ab')
+    idx.write(RUN_HEAD.pack(RUN_MAGIC,len(entries)))
+    idx.write(''.join([entry.pack(*e) for e in entries]))
+    idx.flush()
+    os.fsync(idx.fileno())
+    idx.close()
+    if len(index_runs(path,entry)) >= MAX_RUNS:
+      self.compact(segment,ext)
+
+  def compact(self,segment,ext):
+    # merge all runs of one of a segment's indexes into one; caller holds
+    # the lock
+    entry = INDEXES[ext]
+    path = self.path(segment,ext)
+    runs = index_runs(path,entry)
+    self.replace_index(path,entry,heapq.merge(*runs))
+
+  def replace_index(self,path,entry,entries):
+    tmp = path + '.tmp'
+    out = open(tmp,'wb')
+    count = write_run(out,entry,entries)
+    out.flush()
+    os.fsync(out.fileno())
+    out.close()
+    os.rename(tmp,path)
+    return count
+
+  def reindex(self,segment):
+    # rebuild a segment's indexes from its data file, e.g. after a crash
+    # between the data write and the index write
+    lock = open(self.path(segment,'lock'),'a')
+    fcntl.flock(lock,fcntl.LOCK_EX)
+    try:
+      entries = []
+      hop_entries = []
+      for key,hops,offset in self.scan(segment):
+        entries.append((device_key(key[0]),key[1],offset))
+        for ip in hop_ips(hops):
+          hop_entries.append((ip,key[1],offset))
+      entries.sort()
+      hop_entries.sort()
+      self.replace_index(self.path(segment,'tri'),IDX_ENTRY,entries)
+      self.replace_index(self.path(segment,'trh'),HOP_ENTRY,hop_entries)
+      # keeps the records the scan found, complete or not yet indexed
+      self.set_data_end(segment,records_end(self.path(segment,'trd')))
+    finally:
+      fcntl.flock(lock,fcntl.LOCK_UN)
+      lock.close()
+    return len(entries)
+
+  def query(self,ext,key,start=None,end=None):
+    # (key, hops) for every traceroute whose ext index entry matches key,
+    # with start <= timestamp < end, in timestamp order
+    if start == None:
+      start = 0
+    if end == None:
+      end = MAX_TS
+    if end <= start:
+      return
+    first,last = segment_name(start),segment_name(end-1)
+    for segment in self.segments():
+      if segment < first or segment > last:
+        continue
+      # map the index before the data, so every offset it holds is mapped
+      runs = index_runs(self.path(segment,ext),INDEXES[ext])
+      if len(runs) == 0:
+        continue
+      data = map_file(self.path(segment,'trd'))
+      for e in heapq.merge(*[run.range((key,start,0),(key,end,0)) for run in runs]):
+        yield decode(data,e[2])[0:2]
+
+  def by_device(self,did,start=None,end=None):
+    return self.query('tri',device_key(did),start,end)
+
+  def by_hop(self,ip,start=None,end=None):
+    return self.query('trh',ip_to_int(ip),start,end)
+
+  def latest(self,did,since=None):
+    # the most recent (key, hops) for a device, or None if it has none since
+    # the given timestamp
+    key = device_key(did)
+    if since == None:
+      since = 0
+    for segment in reversed(self.segments()):
+      if segment < segment_name(since):
+        break
+      best = None
+      for run in index_runs(self.path(segment,'tri'),IDX_ENTRY):
+        e = run.last_before((key,MAX_TS,0))
+        if e != None and e[0] == key and e[1] >= since and (best == None or e > best):
+          best = e
+      if best != None:
+        return decode(map_file(self.path(segment,'trd')),best[2])[0:2]
+    return None
+
+  def scan(self,segment):
+    # every record of a segment in file order, as (key, hops, offset)
+    fp = open(self.path(segment,'trd'),'rb')
+    offset = 0
+    while True:
+      head = fp.read(REC_HEAD.size)
+      if len(head) < REC_HEAD.size:
+        break
+      reclen = REC_HEAD.unpack(head)[0]
+      if reclen < REC_HEAD.size:
+        break
+      buf = head + fp.read(reclen - REC_HEAD.size)
+      if len(buf) < reclen:
+        break
+      key,hops,reclen = decode(buf)
+      yield key,hops,offset
+      offset += reclen
+    fp.close()
+
+def init():
+  global store
+  for evname in REQ_ENV_VARS:
+    try:
+        config[evname] = os.environ[evname]
+    except KeyError:
+      print(("Environment variable '%s' required and not defined. "
+                "Terminating.") % evname)
+      sys.exit(1)
+  store = TracerouteStore(config['BDM_TRACEROUTE_DIR'])
+
+def write(inarr):
+  if store == None:
+    init()
+  return store.write(inarr)
+
+def convert(dbfiles,dest,batch=10000):
+  # copy traceroutes out of bsdtr's pickled BDM_BSD_FILE-YYYY-MM.db files
+  import dbhash as db
+  import pickle
+  total = 0
+  for dbfile in dbfiles:
+    obj = db.open(dbfile,'r')
+    inarr = {}
+    for ptup in obj.keys():
+      inarr[pickle.loads(ptup)] = pickle.loads(obj[ptup])
+      if len(inarr) >= batch:
+        total += dest.write(inarr)
+        inarr = {}
+    if len(inarr) > 0:
+      total += dest.write(inarr)
+    obj.close()
+    print '%s: %d traceroutes converted so far'%(dbfile,total)
+  return total
+
+def parse_time(val):
+  # epoch seconds, or a UTC date/time as YYYY-MM-DD[THH:MM[:SS]]
+  try:
+    return int(val)
+  except ValueError:
+    pass
+  for fmt in ('%Y-%m-%d','%Y-%m-%dT%H:%M','%Y-%m-%dT%H:%M:%S'):
+    try:
+      return calendar.timegm(time.strptime(val,fmt))
+    except ValueError:
+      pass
+  raise argparse.ArgumentTypeError('bad time %r'%(val))
+
+def format_traceroute(key,hops):
+  did,ts,srcip,dstip,tool = key
+  hopstr = ' '.join(['%d:%s:%s'%(hopnum,hopip,'*' if rtt == None else '%.3f'%(rtt))
+                     for hopnum,hopip,rtt in hops])
+  return '%s\t%s\t%s\t%s\t%s\t%s'%(did,
+      time.strftime('%Y-%m-%dT%H:%M:%S',time.gmtime(ts)),srcip,dstip,tool,hopstr)
+
+if __name__ == '__main__':
+  ap = argparse.ArgumentParser(description='Traceroute store in $BDM_TRACEROUTE_DIR')
+  sub = ap.add_subparsers(dest='command')
+  p = sub.add_parser('convert',help='import bsdtr BDM_BSD_FILE-YYYY-MM.db files')
+  p.add_argument('dbfiles',nargs='+')
+  p = sub.add_parser('reindex',help='rebuild segment indexes from their data')
+  p.add_argument('segments',nargs='*',metavar='YYYY-MM')
+  for name,what in (('device','device id'),('hop','hop IP address')):
+    p = sub.add_parser(name,help='traceroutes by %s'%(what))
+    p.add_argument(name,help=what)
+    p.add_argument('--from',dest='start',type=parse_time,
+                   help='epoch or UTC YYYY-MM-DD[THH:MM[:SS]], inclusive')
+    p.add_argument('--to',dest='end',type=parse_time,help='exclusive')
+  p = sub.add_parser('latest',help="a device's most recent traceroute")
+  p.add_argument('device')
+  p.add_argument('--since',type=parse_time)
+  args = ap.parse_args()
+
+  init()
+  if args.command == 'convert':
+    convert(args.dbfiles,store)
+  elif args.command == 'reindex':
+    for segment in (args.segments or store.segments()):
+      print '%s: %d traceroutes indexed'%(segment,store.reindex(segment))
+  elif args.command == 'latest':
+    tr = store.latest(args.device,args.since)
+    if tr == None:
+      sys.exit(1)
+    print format_traceroute(*tr)
+  else:
+    if args.command == 'device':
+      results = store.by_device(args.device,args.start,args.end)
+    else:
+      results = store.by_hop(args.hop,args.start,args.end)
+    for key,hops in results:
+      print format_traceroute(key,hops)